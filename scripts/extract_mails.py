@@ -1,39 +1,118 @@
-import imaplib
-import email
+import argparse
 import csv
+import email
 import getpass
+import gzip
+import imaplib
+import io
+import json
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from email.header import decode_header, make_header
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 # --- USER CONFIGURATION ---
 IMAP_HOST     = 'imap.gmail.com'
-EMAIL_ACCOUNT = input("Gmail address: ")
-PASSWORD      = getpass.getpass("App password (or Gmail password if IMAP is enabled): ")
-
-print("Connecting to IMAP server...")
-imap = imaplib.IMAP4_SSL(IMAP_HOST)
-imap.login(EMAIL_ACCOUNT, PASSWORD)
-imap.select('INBOX', readonly=True)
-print("Logged in. INBOX selected.")
-
-print("Fetching message list...")
-status, messages = imap.search(None, 'ALL')
-msg_nums = messages[0].split()
-total = len(msg_nums)
-print(f"Found {total} emails. Starting download...")
-
-records = []
-for idx, num in enumerate(msg_nums, start=1):
-    status, msg_data = imap.fetch(num, '(RFC822)')
-    raw = msg_data[0][1]
+MAILBOX       = 'INBOX'
+CSV_FILE      = '../data/raw/gmail_emails.csv'
+FIELDNAMES    = ['sender', 'receivers', 'message']
+
+UID_PATTERN = re.compile(rb'UID (\d+)')
+
+
+def connect(host: str, account: str, password: str, mailbox: str = MAILBOX,
+            port: Optional[int] = None, use_ssl: bool = True) -> Tuple[imaplib.IMAP4, int]:
+    """
+    Log in and select `mailbox` read-only.
+
+    Returns:
+        imaplib.IMAP4: The connection.
+        int: UIDVALIDITY of the mailbox; UIDs are only comparable while it is unchanged.
+    """
+    if use_ssl:
+        imap = imaplib.IMAP4_SSL(host, port or imaplib.IMAP4_SSL_PORT)
+    else:
+        imap = imaplib.IMAP4(host, port or imaplib.IMAP4_PORT)
+    imap.login(account, password)
+    imap.select(mailbox, readonly=True)
+    _, data = imap.response('UIDVALIDITY')
+    return imap, int(data[0])
+
+
+def list_uids(imap: imaplib.IMAP4, after_uid: int = 0) -> List[int]:
+    """UIDs greater than `after_uid`, ascending."""
+    _, data = imap.uid('SEARCH', None, f'UID {after_uid + 1}:*')
+    # "n:*" always matches the newest message, even when its UID is below n
+    return sorted(uid for uid in map(int, data[0].split()) if uid > after_uid)
+
+
+def uid_set(uids: List[int]) -> str:
+    """Compact IMAP sequence set for ascending UIDs, e.g. [1, 2, 3, 7] -> "1:3,7"."""
+    ranges = []
+    start = prev = uids[0]
+    for uid in uids[1:]:
+        if uid != prev + 1:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = uid
+        prev = uid
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+
+def fetch_batch(imap: imaplib.IMAP4, uids: List[int]) -> List[Tuple[int, bytes]]:
+    """
+    Download a batch of messages with a single UID FETCH.
+
+    The UID may come before the message literal or after it, in which case
+    imaplib returns it in the closing bytes element. A message whose UID
+    cannot be found, or a UID that was not asked for, raises ValueError, so
+    the checkpoint never moves past a message that was not written.
+
+    Returns:
+        List[Tuple[int, bytes]]: (uid, raw RFC822 message) in ascending UID order.
+    """
+    _, data = imap.uid('FETCH', uid_set(uids), '(RFC822)')
+    messages = {}
+    raw = None  # literal still waiting for the UID that follows it
+    for item in data:
+        if isinstance(item, tuple):
+            if raw is not None:
+                raise ValueError("UID FETCH response has a message without a UID")
+            match = UID_PATTERN.search(item[0])
+            if match:
+                messages[int(match.group(1))] = item[1]
+            else:
+                raw = item[1]
+        elif raw is not None:
+            match = UID_PATTERN.search(item or b'')
+            if not match:
+                raise ValueError("UID FETCH response has a message without a UID")
+            messages[int(match.group(1))] = raw
+            raw = None
+    if raw is not None:
+        raise ValueError("UID FETCH response has a message without a UID")
+
+    unexpected = set(messages) - set(uids)
+    if unexpected:
+        raise ValueError(f"UID FETCH returned UIDs that were not requested: {uid_set(sorted(unexpected))}")
+    missing = set(uids) - set(messages)
+    if missing:
+        # expunged since the search; there is nothing left to download for these
+        print(f"UIDs {uid_set(sorted(missing))} were not returned, skipping them (deleted since the search?)")
+    return sorted(messages.items())
+
+
+def parse_message(raw: bytes) -> Dict[str, str]:
+    """Decode the headers and plain-text body of a raw message into a CSV record."""
     msg = email.message_from_bytes(raw)
 
     # Decode headers
-    raw_from    = msg.get('From', '')
-    sender      = str(make_header(decode_header(raw_from)))
-    raw_to      = msg.get('To', '')
-    receivers   = str(make_header(decode_header(raw_to)))
-    raw_subject = msg.get('Subject', '')
-    subject     = str(make_header(decode_header(raw_subject)))
+    sender    = str(make_header(decode_header(msg.get('From', ''))))
+    receivers = str(make_header(decode_header(msg.get('To', ''))))
+    subject   = str(make_header(decode_header(msg.get('Subject', ''))))
 
     # Extract plain-text body
     body = ""
@@ -49,27 +128,273 @@ for idx, num in enumerate(msg_nums, start=1):
             if chunk:
                 body = chunk.decode(errors='ignore')
 
-    message_text = subject + "\n\n" + body
-    records.append({
+    return {
         'sender':    sender,
         'receivers': receivers,
-        'message':   message_text
-    })
-
-    # Progress log every 50 emails
-    if idx % 50 == 0 or idx == total:
-        print(f"Processed {idx}/{total} emails")
-
-imap.logout()
-print("Logged out from IMAP server.")
-
-# --- WRITE TO CSV ---
-csv_file = '../data/raw/gmail_emails.csv'
-print(f"Writing {len(records)} records to {csv_file}...")
-with open(csv_file, 'w', newline='', encoding='utf-8-sig') as f:
-    writer = csv.DictWriter(f, fieldnames=['sender','receivers','message'])
-    writer.writeheader()
-    for rec in records:
-        writer.writerow(rec)
-
-print("Done.")
+        'message':   subject + "\n\n" + body
+    }
+
+
+def load_state(path: str) -> dict:
+    """Last run's checkpoint ({'uidvalidity', 'last_uid', ...}), or an empty dict."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path: str, uidvalidity: int, last_uid: int, **extra) -> None:
+    """Write the state atomically so an interrupted run never leaves it half-written."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'uidvalidity': uidvalidity, 'last_uid': last_uid, **extra}, f)
+    os.replace(tmp, path)
+
+
+def fetch_messages(connect_fn, uids: List[int], batch_size: int = 200,
+                   connections: int = 4) -> Iterator[List[Tuple[int, bytes]]]:
+    """
+    Fetch `uids` in batches over several IMAP connections, yielding batches in UID order.
+
+    At most two batches per connection are in flight, so memory stays bounded
+    however far the consumer falls behind.
+
+    Args:
+        connect_fn: Callable returning a logged-in connection, as `connect` does.
+        uids (List[int]): UIDs to download, ascending.
+        batch_size (int): Messages per UID FETCH.
+        connections (int): Concurrent IMAP connections.
+    """
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def fetch(batch):
+        if not hasattr(local, 'imap'):
+            local.imap, _ = connect_fn()
+            with lock:
+                opened.append(local.imap)
+        return fetch_batch(local.imap, batch)
+
+    batches = [uids[i:i + batch_size] for i in range(0, len(uids), batch_size)]
+    try:
+        with ThreadPoolExecutor(connections) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(fetch, batch))
+                if len(pending) >= 2 * connections:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for imap in opened:
+            try:
+                imap.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+
+def parse_batches(batches: Iterable[List[Tuple[int, bytes]]],
+                  parse_workers: int = 1) -> Iterator[Tuple[List[int], List[Dict[str, str]]]]:
+    """
+    Parse fetched batches into CSV records, in a process pool if `parse_workers` > 1.
+
+    Yields:
+        (uids, records) for each non-empty batch.
+    """
+    parser = ProcessPoolExecutor(parse_workers) if parse_workers > 1 else None
+    try:
+        for batch in batches:
+            if not batch:
+                continue
+            raws = [raw for _, raw in batch]
+            records = parser.map(parse_message, raws, chunksize=16) if parser else map(parse_message, raws)
+            yield [uid for uid, _ in batch], list(records)
+    finally:
+        if parser:
+            parser.shutdown()
+
+
+class CsvOutput:
+    """
+    Appends records to a CSV, or to a gzipped CSV when the path ends in .gz.
+
+    The checkpoint is the file size after the last complete batch; resuming
+    truncates anything written after it. Gzip output writes one gzip member
+    per batch, so every checkpoint falls on a member boundary and the file
+    stays readable (by pandas or `zcat`) however the run ended.
+    """
+
+    def __init__(self, path: str, fresh: bool, state: dict):
+        self.path = path
+        self.gzip = path.endswith('.gz')
+        if fresh:
+            with open(path, 'wb'):
+                pass
+            self.write_rows([], header=True)
+        elif 'size' in state and os.path.getsize(path) > state['size']:
+            os.truncate(path, state['size'])
+
+    def write_rows(self, records: List[Dict[str, str]], header: bool = False) -> None:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=FIELDNAMES)
+        if header:
+            writer.writeheader()
+        writer.writerows(records)
+        # utf-8-sig only at the start of a plain file, or the BOM would land mid-file
+        encoding = 'utf-8-sig' if header and not self.gzip else 'utf-8'
+        data = buffer.getvalue().encode(encoding)
+        with open(self.path, 'ab') as f:
+            f.write(gzip.compress(data) if self.gzip else data)
+
+    def write(self, uids: List[int], records: List[Dict[str, str]]) -> bool:
+        """Append a batch; returns True as it is on disk straight away."""
+        self.write_rows(records)
+        return True
+
+    def close(self) -> bool:
+        return False
+
+    def checkpoint(self) -> dict:
+        return {'size': os.path.getsize(self.path)}
+
+
+class ParquetOutput:
+    """
+    Writes records as a directory of Parquet part files, read back with `pd.read_parquet(path)`.
+
+    Records are buffered into parts of `rows_per_file` rows, each written
+    atomically and named after its first UID so they sort in mailbox order.
+    Parts beyond the checkpoint and half-written .tmp parts, left by an
+    interrupted run, are removed.
+    """
+
+    def __init__(self, path: str, fresh: bool, state: dict, rows_per_file: int = 10000):
+        self.path = path
+        self.rows_per_file = rows_per_file
+        self.buffer = []
+        self.first_uid = None
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            # half-written parts from a crash are never valid, whatever their UID
+            if name.startswith('part-') and (fresh or name.endswith('.tmp') or int(name[5:15]) > state.get('last_uid', 0)):
+                os.remove(os.path.join(path, name))
+
+    def write(self, uids: List[int], records: List[Dict[str, str]]) -> bool:
+        """Buffer a batch; returns True when the buffer was written out as a part."""
+        if self.first_uid is None:
+            self.first_uid = uids[0]
+        self.buffer.extend(records)
+        if len(self.buffer) < self.rows_per_file:
+            return False
+        return self.close()
+
+    def close(self) -> bool:
+        """Write out whatever is buffered; returns True if a part was written."""
+        if not self.buffer:
+            return False
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        name = os.path.join(self.path, f"part-{self.first_uid:010d}.parquet")
+        table = pa.Table.from_pylist(self.buffer, schema=pa.schema([(f, pa.string()) for f in FIELDNAMES]))
+        pq.write_table(table, name + '.tmp')
+        os.replace(name + '.tmp', name)
+        self.buffer = []
+        self.first_uid = None
+        return True
+
+    def checkpoint(self) -> dict:
+        return {}
+
+
+def open_output(path: str, fresh: bool, state: dict):
+    """CsvOutput or ParquetOutput, depending on the suffix of `path`."""
+    if path.endswith('.parquet'):
+        return ParquetOutput(path, fresh, state)
+    return CsvOutput(path, fresh, state)
+
+
+def extract(connect_fn, output_file: str = CSV_FILE, state_file: Optional[str] = None,
+            batch_size: int = 200, connections: int = 4, parse_workers: int = 1,
+            full: bool = False) -> int:
+    """
+    Download new messages and append them to `output_file`.
+
+    Runs as a generator pipeline (fetch -> parse -> write), so memory is bounded
+    by the batches in flight rather than by the mailbox. Only UIDs above the
+    last one recorded in `state_file` are fetched, unless the mailbox's
+    UIDVALIDITY changed or `full` is set, in which case the output is rewritten
+    from scratch. The state is updated whenever written rows reach the disk,
+    so an interrupted run resumes where it stopped.
+
+    Args:
+        connect_fn: Callable returning (connection, uidvalidity), as `connect` does.
+        output_file (str): .csv, .csv.gz, or a .parquet directory of part files.
+        state_file (str): JSON checkpoint; defaults to `<output_file>.state.json`.
+        batch_size (int): Messages per UID FETCH.
+        connections (int): Concurrent IMAP connections.
+        parse_workers (int): Processes for MIME parsing; 1 parses in this process.
+        full (bool): Ignore the saved state.
+
+    Returns:
+        int: Number of messages written.
+    """
+    state_file = state_file or output_file.rstrip('/') + '.state.json'
+    imap, uidvalidity = connect_fn()
+    state = {} if full else load_state(state_file)
+    if state.get('uidvalidity') != uidvalidity or not os.path.exists(output_file):
+        state = {}
+    last_uid = state.get('last_uid', 0)
+    uids = list_uids(imap, last_uid)
+    imap.logout()
+
+    fresh = not state
+    print(f"Found {len(uids)} new emails after UID {last_uid}" + (", writing a fresh output" if fresh else ""))
+
+    output = open_output(output_file, fresh, state)
+    if fresh:
+        save_state(state_file, uidvalidity, 0, **output.checkpoint())
+
+    written = 0
+    pipeline = parse_batches(fetch_messages(connect_fn, uids, batch_size, connections), parse_workers)
+    for batch_uids, records in pipeline:
+        written += len(records)
+        if output.write(batch_uids, records):
+            save_state(state_file, uidvalidity, batch_uids[-1], **output.checkpoint())
+        print(f"Processed {written}/{len(uids)} emails")
+    if output.close():
+        save_state(state_file, uidvalidity, uids[-1], **output.checkpoint())
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download mailbox messages over IMAP into a CSV or Parquet dataset.")
+    parser.add_argument('--host', type=str, default=IMAP_HOST, help='IMAP server.')
+    parser.add_argument('--port', type=int, default=None, help='IMAP port (default: 993, or 143 with --no_ssl).')
+    parser.add_argument('--no_ssl', action='store_true', help='Connect without TLS.')
+    parser.add_argument('--mailbox', type=str, default=MAILBOX, help='Mailbox to read.')
+    parser.add_argument('--output_file', type=str, default=CSV_FILE, help='Output: .csv, .csv.gz, or a .parquet directory of part files.')
+    parser.add_argument('--state_file', type=str, default=None, help='Checkpoint of the last UID (default: <output_file>.state.json).')
+    parser.add_argument('--batch_size', type=int, default=200, help='Messages per UID FETCH.')
+    parser.add_argument('--connections', type=int, default=4, help='Concurrent IMAP connections.')
+    parser.add_argument('--parse_workers', type=int, default=os.cpu_count() or 1, help='Processes for MIME parsing.')
+    parser.add_argument('--full', action='store_true', help='Ignore the checkpoint and download everything again.')
+
+    args = parser.parse_args()
+
+    account  = os.environ.get('EMAIL_ACCOUNT') or input("Gmail address: ")
+    password = os.environ.get('EMAIL_PASSWORD') or getpass.getpass("App password (or Gmail password if IMAP is enabled): ")
+
+    def connect_fn():
+        return connect(args.host, account, password, args.mailbox, args.port, not args.no_ssl)
+
+    print("Connecting to IMAP server...")
+    written = extract(connect_fn, args.output_file, args.state_file, args.batch_size,
+                      args.connections, args.parse_workers, args.full)
+    print(f"Wrote {written} records to {args.output_file}")
+    print("Done.")
+
+
+if __name__ == '__main__':
+    main()
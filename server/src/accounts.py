@@ -0,0 +1,171 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+
+from gmail_client import ClassifierClient, GmailMonitor, TokenBucket, HISTORY_STATE_PATH
+from auth import TOKEN_PATH
+
+# Directory of per-account OAuth tokens, one <account>.json each; unset means the single TOKEN_PATH account
+TOKEN_DIR = os.environ.get("TOKEN_DIR")
+# Directory for the per-account history checkpoints in TOKEN_DIR mode
+HISTORY_STATE_DIR = os.environ.get("HISTORY_STATE_DIR", "history_state")
+# This replica's name and the names of every replica sharing the accounts
+REPLICA_NAME = os.environ.get("REPLICA_NAME", socket.gethostname())
+REPLICA_NAMES = [name for name in os.environ.get("REPLICA_NAMES", REPLICA_NAME).split(",") if name]
+# Concurrent polls across all accounts
+POLL_WORKERS = int(os.environ.get("POLL_WORKERS", "4"))
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """
+    Consistent hashing of accounts onto replicas.
+
+    Every replica is placed on the ring at `vnodes` points; an account belongs
+    to the first replica point at or after its own hash. Adding or removing a
+    replica only moves the accounts that hashed next to it.
+    """
+
+    def __init__(self, nodes, vnodes=100):
+        self.ring = sorted(
+            (self._hash(f"{node}#{i}"), node)
+            for node in nodes
+            for i in range(vnodes)
+        )
+        self.keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def node_for(self, key):
+        index = bisect.bisect(self.keys, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+def discover_accounts(token_dir=TOKEN_DIR):
+    """Account name -> token path, from `token_dir`, or the single TOKEN_PATH account"""
+    if not token_dir:
+        return {"default": TOKEN_PATH}
+    return {
+        name[:-len(".json")]: os.path.join(token_dir, name)
+        for name in sorted(os.listdir(token_dir))
+        if name.endswith(".json")
+    }
+
+
+class AccountManager:
+    """
+    Runs one GmailMonitor per account owned by this replica.
+
+    Every monitor keeps its own pipeline and label cache. Polling is scheduled
+    across a shared pool of POLL_WORKERS tasks, which picks whichever account
+    is due next, each account pacing itself with its adaptive interval and its
+    own token bucket. A shared worker only detects: an account whose pipeline
+    is full parks the overflow in its own backlog and skips polls until that
+    drains, so slow accounts never hold the pool. Classifier calls share one
+    connection pool.
+    """
+
+    def __init__(self, accounts=None, replica=REPLICA_NAME, replicas=None, poll_workers=POLL_WORKERS,
+                 state_dir=None, classifier=None):
+        accounts = accounts if accounts is not None else discover_accounts()
+        self.replica = replica
+        self.ring = HashRing(replicas or REPLICA_NAMES)
+        self.poll_workers = poll_workers
+        self.owns_classifier = classifier is None
+        self.classifier = classifier or ClassifierClient()
+        state_dir = state_dir if state_dir is not None else (HISTORY_STATE_DIR if TOKEN_DIR else None)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        self.monitors = {
+            account: GmailMonitor(
+                account,
+                token_path=token_path,
+                state_path=os.path.join(state_dir, f"{account}.json") if state_dir else HISTORY_STATE_PATH,
+                classifier=self.classifier,
+                rate_limiter=TokenBucket(),
+            )
+            for account, token_path in accounts.items()
+            if self.ring.node_for(account) == self.replica
+        }
+        self.running = False
+        self.task = None
+        self._wake = None
+
+    async def start(self):
+        """Authenticate every owned account and start polling; accounts that fail are skipped"""
+        self.running = True
+        self._wake = asyncio.Event()
+        active = []
+        for monitor in self.monitors.values():
+            try:
+                if not monitor.service:
+                    await monitor.google_call(monitor.authenticate)
+                await monitor.google_call(monitor.resume_history)
+            except Exception as e:
+                logger.error(f"Not monitoring {monitor.account}: {e}")
+                continue
+            monitor.monitoring = True
+            monitor.start_pipeline()
+            active.append(monitor)
+        if not active:
+            # nothing to poll, so do not report monitoring as on
+            self.running = False
+            return []
+        self.task = asyncio.create_task(self.run(active))
+        return [monitor.account for monitor in active]
+
+    async def run(self, monitors):
+        if not monitors:
+            return
+        schedule = asyncio.PriorityQueue()
+        for order, monitor in enumerate(monitors):
+            schedule.put_nowait((time.monotonic(), order, monitor))
+
+        async def worker():
+            while True:
+                due, order, monitor = await schedule.get()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=max(0.0, due - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+                if not self.running:
+                    # hand the entry on so workers still waiting on the queue wake up too
+                    schedule.put_nowait((due, order, monitor))
+                    return
+                delay = await monitor.poll_and_schedule()
+                schedule.put_nowait((time.monotonic() + delay, order, monitor))
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.poll_workers, len(monitors)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*(monitor.drain_pipeline() for monitor in monitors))
+            for monitor in monitors:
+                monitor.monitoring = False
+            if self.owns_classifier:
+                await self.classifier.aclose()
+
+    async def stop(self):
+        """Stop polling and drain every account's pipeline"""
+        self.running = False
+        if self._wake is not None:
+            self._wake.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+
+    def status(self):
+        return {
+            "replica": self.replica,
+            "replicas": sorted({node for _, node in self.ring.ring}),
+            "accounts": {account: monitor.status() for account, monitor in self.monitors.items()},
+        }
@@ -1,7 +1,7 @@
 import logging
-import asyncio
-from gmail_client import GmailMonitor
-from fastapi import FastAPI, Request, HTTPException
+from accounts import AccountManager
+from backfill import Backfill
+from fastapi import FastAPI, HTTPException
 from auth import router as auth_router
 
 # Configure logging
@@ -15,35 +15,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Instantiate Gmail monitor
-gmail_monitor = GmailMonitor()
-
-# @asynccontextmanager
-# async def lifespan(app: FastAPI):
-#     # Startup
-#     try:
-#         gmail_monitor.authenticate()
-#         gmail_monitor.get_initial_history_id()
-#         # Start monitoring in background
-#         asyncio.create_task(gmail_monitor.monitor_emails())
-#         logger.info("Gmail monitoring started")
-#     except Exception as e:
-#         logger.error(f"Failed to start Gmail monitoring: {e}")
-#
-#     yield
-#
-#     # Shutdown
-#     gmail_monitor.stop_monitoring()
-#     logger.info("Gmail monitoring stopped")
-
-
+# Monitors for every account this replica owns
+manager = AccountManager()
+# Backfill jobs by account
+backfills = {}
 
 # FastAPI app
 app = FastAPI(
     title="Gmail Email Logger",
     description="Monitor and log incoming Gmail emails",
     version="1.0.0",
-    # lifespan=lifespan
 )
 
 # Register auth routes
@@ -52,40 +33,75 @@ app.include_router(auth_router)
 
 @app.get("/")
 async def root():
-    return {"message": "Gmail Email Logger is running", "monitoring": gmail_monitor.monitoring}
+    return {"message": "Gmail Email Logger is running", "monitoring": manager.running}
 
 
 @app.get("/status")
 async def get_status():
+    accounts = manager.status()
+    monitors = list(manager.monitors.values())
     return {
-        "monitoring": gmail_monitor.monitoring,
-        "authenticated": gmail_monitor.service is not None,
-        "last_history_id": gmail_monitor.last_history_id
+        "monitoring": manager.running,
+        "authenticated": bool(monitors) and all(m.service is not None for m in monitors),
+        # single-account fields, kept from before accounts were sharded
+        "last_history_id": monitors[0].last_history_id if len(monitors) == 1 else None,
+        **accounts
     }
 
 
 @app.get("/start-monitoring")
 async def start_monitoring():
-    if gmail_monitor.monitoring:
+    if manager.running:
         return {"message": "Monitoring is already active"}
 
-    try:
-        if not gmail_monitor.service:
-            gmail_monitor.authenticate()
+    started = await manager.start()
+    if manager.monitors and not started:
+        await manager.stop()
+        raise HTTPException(status_code=500, detail="No account could be authenticated")
+    return {"message": "Monitoring started successfully", "accounts": started}
+
+
+@app.post("/stop-monitoring")
+async def stop_monitoring():
+    # returns once everything already detected has been labeled
+    await manager.stop()
+    return {"message": "Monitoring stopped"}
 
-        gmail_monitor.get_initial_history_id()
 
-        asyncio.create_task(gmail_monitor.monitor_emails())
-        return {"message": "Monitoring started successfully"}
+@app.post("/backfill/start")
+async def start_backfill(account: str = "default", query: str = ""):
+    monitor = manager.monitors.get(account)
+    if monitor is None:
+        raise HTTPException(status_code=404, detail=f"Account {account} is not handled by this replica")
+    backfill = backfills.get(account)
+    if backfill is not None and backfill.running:
+        return {"message": "Backfill is already running", **backfill.status()}
+
+    try:
+        if not monitor.service:
+            await monitor.google_call(monitor.authenticate)
     except Exception as e:
-        logger.error(f"Failed to start monitoring: {e}")
+        logger.error(f"Failed to start backfill: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    # resumes from the account's checkpoint when the query is unchanged
+    backfill = backfills[account] = Backfill(monitor, query=query)
+    backfill.start()
+    return {"message": "Backfill started", **backfill.status()}
 
 
-@app.post("/stop-monitoring")
-async def stop_monitoring():
-    gmail_monitor.stop_monitoring()
-    return {"message": "Monitoring stopped"}
+@app.post("/backfill/stop")
+async def stop_backfill(account: str = "default"):
+    backfill = backfills.get(account)
+    if backfill is None:
+        raise HTTPException(status_code=404, detail=f"No backfill for {account}")
+    # returns once the current page is labeled and checkpointed
+    await backfill.stop()
+    return {"message": "Backfill stopped", **backfill.status()}
+
+
+@app.get("/backfill/status")
+async def backfill_status():
+    return {account: backfill.status() for account, backfill in backfills.items()}
 
 
 if __name__ == "__main__":
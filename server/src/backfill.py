@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from gmail_client import (
+    ACCOUNT_REQUESTS_PER_SECOND, GMAIL_BATCH_RETRIES, PREDICTION_URL,
+    GmailMonitor, LabelBatcher, RateMeter, TokenBucket,
+)
+
+# Messages per messages().list page (Gmail allows up to 500)
+BACKFILL_PAGE_SIZE = min(int(os.environ.get("BACKFILL_PAGE_SIZE", "500")), 500)
+# Texts per /predict_batch call; keep at or below the classifier's MAX_PREDICT_BATCH
+BACKFILL_CLASSIFY_BATCH = int(os.environ.get("BACKFILL_CLASSIFY_BATCH", "100"))
+# Gmail allows 250 quota units per user per second and a messages.get costs 5
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+MESSAGE_GET_UNITS = 5
+# The backfill has its own budget, on top of the live monitor's ACCOUNT_REQUESTS_PER_SECOND,
+# so it is capped at whatever quota the monitor leaves (40 messages/s by default)
+MAX_BACKFILL_MESSAGES_PER_SECOND = (
+    GMAIL_QUOTA_UNITS_PER_SECOND - ACCOUNT_REQUESTS_PER_SECOND * MESSAGE_GET_UNITS) / MESSAGE_GET_UNITS
+# Target throughput in messages per second
+BACKFILL_MESSAGES_PER_SECOND = float(os.environ.get("BACKFILL_MESSAGES_PER_SECOND", "30"))
+# Default Gmail search for the messages to backfill
+BACKFILL_QUERY = os.environ.get("BACKFILL_QUERY", "")
+# Where each account's backfill position is kept
+BACKFILL_STATE_DIR = os.environ.get("BACKFILL_STATE_DIR", "backfill_state")
+# Batch endpoint of the classifier, next to PREDICTION_URL by default
+BATCH_PREDICTION_URL = os.environ.get(
+    "EMAIL_CLASSIFIER_BATCH_URL",
+    PREDICTION_URL[:-len("/predict")] + "/predict_batch" if PREDICTION_URL.endswith("/predict") else PREDICTION_URL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillCheckpoint:
+    """
+    Position of a backfill in messages().list, saved after every finished page.
+
+    The saved page token is the first page not yet fully labeled, so a crash
+    repeats at most one page (adding a label twice is harmless). A checkpoint
+    for a different query is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+
+    def load(self, query):
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get('query') == query:
+                self.state = state
+                return self.state
+        self.state = {'query': query, 'page_token': None, 'pages': 0, 'messages': 0, 'skipped': 0, 'complete': False}
+        return self.state
+
+    def save(self, **changes):
+        self.state.update(changes)
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+
+class Backfill:
+    """
+    Labels the messages already in a mailbox.
+
+    Pages through messages().list for `query`, fetches metadata for each page
+    with Gmail batch requests, classifies it through the classifier's
+    /predict_batch and applies the labels with batchModify before the page is
+    checkpointed. Gmail calls run on the monitor's API thread, one at a time,
+    while the chunks of a page are classified concurrently. Fetches are paced
+    to `rate` messages per second by the backfill's own token bucket, separate
+    from the live monitor's, with `rate` capped at
+    MAX_BACKFILL_MESSAGES_PER_SECOND so both fit in the account's Gmail quota.
+    `stop` finishes the current page first.
+    """
+
+    def __init__(self, monitor, query=BACKFILL_QUERY, state_path=None, page_size=BACKFILL_PAGE_SIZE,
+                 classify_batch=BACKFILL_CLASSIFY_BATCH, rate=BACKFILL_MESSAGES_PER_SECOND,
+                 batch_url=BATCH_PREDICTION_URL):
+        self.monitor = monitor
+        self.query = query
+        self.page_size = page_size
+        self.classify_batch = classify_batch
+        self.batch_url = batch_url
+        if state_path is None:
+            os.makedirs(BACKFILL_STATE_DIR, exist_ok=True)
+            state_path = os.path.join(BACKFILL_STATE_DIR, f"{monitor.account}.json")
+        self.checkpoint = BackfillCheckpoint(state_path)
+        if rate > MAX_BACKFILL_MESSAGES_PER_SECOND:
+            logger.warning(f"Backfill rate {rate}/s exceeds the quota left by live monitoring, "
+                           f"using {MAX_BACKFILL_MESSAGES_PER_SECOND}/s")
+            rate = MAX_BACKFILL_MESSAGES_PER_SECOND
+        self.rate = rate
+        self.pacer = TokenBucket(rate, burst=max(rate, classify_batch))
+        self.labeler = LabelBatcher(lambda: monitor.service, monitor.label_cache, max_batch=1000,
+                                    executor=monitor.google)
+        self.throughput = RateMeter()
+        self.running = False
+        self.task = None
+        self.error = None
+
+    async def run(self):
+        """Backfill until the mailbox is exhausted or `stop` is called; returns messages labeled"""
+        state = self.checkpoint.load(self.query)
+        self.running = True
+        self.error = None
+        labeled = 0
+        try:
+            while self.running and not state['complete']:
+                message_ids, next_token = await self.list_page(state['page_token'])
+                page_labeled, skipped = await self.process(message_ids)
+                labeled += page_labeled
+                self.checkpoint.save(
+                    page_token=next_token,
+                    pages=state['pages'] + 1,
+                    messages=state['messages'] + page_labeled,
+                    skipped=state.get('skipped', 0) + skipped,
+                    complete=next_token is None,
+                )
+                logger.info(f"Backfill of {self.monitor.account}: page {state['pages']} done, "
+                            f"{state['messages']} messages labeled so far")
+        except Exception as e:
+            self.error = str(e)
+            logger.exception(f"Backfill of {self.monitor.account} stopped")
+            raise
+        finally:
+            self.running = False
+        return labeled
+
+    async def list_page(self, page_token):
+        page = await self.monitor.google_call(self.list_request, page_token)
+        return [message['id'] for message in page.get('messages', [])], page.get('nextPageToken')
+
+    def list_request(self, page_token):
+        return self.monitor.service.users().messages().list(
+            userId='me', q=self.query or None, maxResults=self.page_size, pageToken=page_token
+        ).execute()
+
+    async def process(self, message_ids):
+        """
+        Fetch, classify and label one page.
+
+        Raises if any message is still failing with a retryable error, so the
+        page is not checkpointed and a resumed backfill tries it again.
+
+        Returns:
+            int: Messages labeled.
+            int: Messages skipped because they were deleted or rejected for good.
+        """
+        chunks = [message_ids[start:start + self.classify_batch]
+                  for start in range(0, len(message_ids), self.classify_batch)]
+        skipped = sum(await asyncio.gather(*(self.classify_chunk(chunk) for chunk in chunks)))
+
+        labeled = 0
+        for attempt in range(GMAIL_BATCH_RETRIES + 1):
+            labeled += await self.monitor.google_call(self.labeler.flush)
+            if not self.labeler.pending_count:
+                break
+            # retryable batchModify failures were queued again
+            await asyncio.sleep(2 ** attempt)
+        if self.labeler.pending_count:
+            raise RuntimeError(f"{self.labeler.pending_count} labels could not be applied")
+        self.throughput.add(labeled)
+        return labeled, skipped
+
+    async def classify_chunk(self, message_ids):
+        """Fetch and classify a chunk, queueing its labels; returns how many messages were skipped"""
+        await self.pacer.acquire(len(message_ids))
+        # the fetches of a page queue up on the account's API thread, shared with live monitoring
+        found, unfinished = await self.monitor.google_call(self.monitor.get_messages_details, message_ids)
+        if unfinished:
+            raise RuntimeError(f"{len(unfinished)} messages could not be fetched, e.g. {unfinished[0]}")
+        skipped = len(message_ids) - len(found)
+        if skipped:
+            logger.warning(f"Backfill of {self.monitor.account}: skipping {skipped} deleted or inaccessible messages")
+        if not found:
+            return skipped
+        result = await self.monitor.classifier.post(
+            {'texts': [details['snippet'] + details['subject'] for details in found]}, url=self.batch_url)
+        for details, prediction in zip(found, result['predictions']):
+            self.labeler.queue(prediction['prediction'], [details['message_id']])
+        return skipped
+
+    def start(self):
+        self.running = True
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        """Stop after the current page, which is checkpointed"""
+        self.running = False
+        if self.task is not None:
+            try:
+                await self.task
+            except Exception:
+                pass
+            self.task = None
+
+    def status(self):
+        return {
+            "running": self.running,
+            "query": self.query,
+            "rate": self.rate,
+            "pages": self.checkpoint.state.get('pages', 0),
+            "messages_labeled": self.checkpoint.state.get('messages', 0),
+            "messages_skipped": self.checkpoint.state.get('skipped', 0),
+            "complete": self.checkpoint.state.get('complete', False),
+            "messages_per_minute": self.throughput.per_minute(),
+            "error": self.error,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Label the messages already in a Gmail mailbox")
+    parser.add_argument("--account", default="default", help="Account name, used for the checkpoint file")
+    parser.add_argument("--token", default=None, help="OAuth token file (default: GOOGLE_TOKEN_PATH)")
+    parser.add_argument("--query", default=BACKFILL_QUERY, help="Gmail search selecting the messages")
+    parser.add_argument("--rate", type=float, default=BACKFILL_MESSAGES_PER_SECOND,
+                        help=f"Messages per second, at most {MAX_BACKFILL_MESSAGES_PER_SECOND:g}")
+    parser.add_argument("--state", default=None, help="Checkpoint file (default: BACKFILL_STATE_DIR/<account>.json)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    async def run():
+        monitor = GmailMonitor(args.account, token_path=args.token)
+        monitor.authenticate()
+        backfill = Backfill(monitor, query=args.query, state_path=args.state, rate=args.rate)
+        start = time.monotonic()
+        try:
+            labeled = await backfill.run()
+        finally:
+            await monitor.classifier.aclose()
+        logger.info(f"Labeled {labeled} messages in {time.monotonic() - start:.0f}s")
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 import logging
 import json
 import asyncio
+import functools
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import requests
+import httplib2
+import httpx
 import os
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request as GoogleRequest
@@ -12,21 +19,109 @@ from auth import SCOPES, TOKEN_PATH
 
 # Prediction endpoint URL from env
 PREDICTION_URL = os.environ.get("EMAIL_CLASSIFIER_URL", 'https://email-classifier.thankfulwater-706eddc2.centralindia.azurecontainerapps.io/predict')
+# Classifier calls: per-attempt timeout (s), attempts after the first, and requests in flight
+CLASSIFIER_TIMEOUT = float(os.environ.get("CLASSIFIER_TIMEOUT", "10"))
+CLASSIFIER_RETRIES = int(os.environ.get("CLASSIFIER_RETRIES", "3"))
+CLASSIFIER_CONCURRENCY = int(os.environ.get("CLASSIFIER_CONCURRENCY", "8"))
+# Requests per Gmail batch call; Gmail accepts up to 100 but recommends at most 50
+GMAIL_BATCH_SIZE = min(int(os.environ.get("GMAIL_BATCH_SIZE", "50")), 100)
+# Times a batch item that hit a rate limit or server error is retried
+GMAIL_BATCH_RETRIES = int(os.environ.get("GMAIL_BATCH_RETRIES", "3"))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+METADATA_HEADERS = ['From', 'Subject', 'Date']
+# Label name -> ID lookups are reloaded after this many seconds
+LABEL_CACHE_TTL = float(os.environ.get("LABEL_CACHE_TTL", "3600"))
+# Pending labels are applied once this many messages are waiting (batchModify takes up to 1000)...
+LABEL_BATCH_SIZE = min(int(os.environ.get("LABEL_BATCH_SIZE", "100")), 1000)
+# ...or once the oldest has waited this long
+LABEL_FLUSH_SECONDS = float(os.environ.get("LABEL_FLUSH_SECONDS", "5"))
+# Capacity of each queue between pipeline stages; a full queue holds back polling
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "500"))
+# Workers per stage
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "2"))
+CLASSIFY_WORKERS = int(os.environ.get("CLASSIFY_WORKERS", str(CLASSIFIER_CONCURRENCY)))
+LABEL_WORKERS = int(os.environ.get("LABEL_WORKERS", "1"))
+# Seconds between history polls: the interval doubles while the mailbox is idle, up to
+# POLL_MAX_INTERVAL, and drops back to POLL_MIN_INTERVAL as soon as mail arrives
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", "60"))
+# Where the last fully processed history ID is kept across restarts
+HISTORY_STATE_PATH = os.environ.get("HISTORY_STATE_PATH", "history_state.json")
+# Gmail requests per second allowed for each account, and the burst it may save up
+ACCOUNT_REQUESTS_PER_SECOND = float(os.environ.get("ACCOUNT_REQUESTS_PER_SECOND", "10"))
+ACCOUNT_BURST = float(os.environ.get("ACCOUNT_BURST", "100"))
 
 logger = logging.getLogger(__name__)
 
 class GmailMonitor:
-    def __init__(self):
+    def __init__(self, account='default', token_path=None, state_path=None, classifier=None, rate_limiter=None):
+        self.account = account
+        self.token_path = token_path or TOKEN_PATH
         self.service = None
         self.credentials = None
         self.last_history_id = None
         self.monitoring = False
+        self.label_cache = LabelCache()
+        self.checkpoint = HistoryCheckpoint(state_path or HISTORY_STATE_PATH)
+        self.throughput = RateMeter()
+        # the Gmail service sits on one httplib2.Http, which is not thread-safe, so every
+        # API call for this account goes through this single thread
+        self.google = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"gmail-{account}")
+        self.labeler = LabelBatcher(lambda: self.service, self.label_cache, on_done=self.message_done,
+                                    executor=self.google)
+        # a classifier shared between accounts is closed by whoever created it
+        self.owns_classifier = classifier is None
+        self.classifier = classifier or ClassifierClient()
+        self.rate_limiter = rate_limiter
+        self.queues = {}
+        self.stage_stats = {}
+        self.workers = []
+        # message ID -> failed attempts, for messages waiting to be retried
+        self.retry_attempts = {}
+        self.retry_tasks = set()
+        self.task = None
+        self._wake = None
+        self.poll_interval = POLL_MIN_INTERVAL
+        self.last_poll_at = None
+
+    def message_done(self, message_ids):
+        """A message left the pipeline: advance the checkpoint and count it"""
+        self.checkpoint.done(message_ids)
+        self.throughput.add(len(message_ids))
+        for message_id in message_ids:
+            self.retry_attempts.pop(message_id, None)
+
+    def retry_later(self, stage, items, message_ids):
+        """
+        Put items back on a stage's queue after a backoff.
+
+        The messages stay outstanding meanwhile, so during a Gmail or
+        classifier outage the checkpoint waits instead of skipping them.
+        """
+        attempt = max(self.retry_attempts.get(message_id, 0) for message_id in message_ids) + 1
+        for message_id in message_ids:
+            self.retry_attempts[message_id] = attempt
+        self.stage_stats[stage]['retried'] += len(items)
+        delay = min(POLL_MAX_INTERVAL, POLL_MIN_INTERVAL * 2 ** (attempt - 1))
+
+        async def requeue():
+            await asyncio.sleep(delay)
+            for item in items:
+                await self.queues[stage].put(item)
+
+        task = asyncio.create_task(requeue())
+        self.retry_tasks.add(task)
+        task.add_done_callback(self.retry_tasks.discard)
+
+    async def google_call(self, fn, *args):
+        """Run a blocking call that uses `self.service` on the account's API thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.google, functools.partial(fn, *args))
 
     def authenticate(self):
         """Authenticate with Gmail API using stored token.json"""
         creds = None
-        if os.path.exists(TOKEN_PATH):
-            creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+        if os.path.exists(self.token_path):
+            creds = Credentials.from_authorized_user_file(self.token_path, SCOPES)
         # Refresh or prompt if needed
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
@@ -41,151 +136,697 @@ class GmailMonitor:
         try:
             profile = self.service.users().getProfile(userId='me').execute()
             self.last_history_id = profile['historyId']
+            self.checkpoint.reset(self.last_history_id)
             logger.info(f"Initial history ID: {self.last_history_id}")
         except HttpError as error:
             logger.error(f"Error getting profile: {error}")
 
-    def get_message_details(self, message_id):
-        """Get detailed information about a specific message"""
-        try:
-            message = self.service.users().messages().get(
-                userId='me',
-                id=message_id,
-                format='metadata',
-                metadataHeaders=['From', 'Subject', 'Date']
-            ).execute()
-
-            headers = message['payload'].get('headers', [])
-            details = {
-                'message_id': message_id,
-                'thread_id': message['threadId'],
-                'snippet': message.get('snippet', ''),
-                'from': '',
-                'subject': '',
-                'date': '',
-                'timestamp': datetime.now().isoformat()
-            }
-
-            for header in headers:
-                name = header['name'].lower()
-                if name == 'from':
-                    details['from'] = header['value']
-                elif name == 'subject':
-                    details['subject'] = header['value']
-                elif name == 'date':
-                    details['date'] = header['value']
-
-            return details
-
-        except HttpError as error:
-            logger.error(f"Error getting message details: {error}")
-            return None
-
-    def check_new_emails(self):
-        """Check for new emails since last check"""
+    def resume_history(self):
+        """Continue from the saved checkpoint, or start from now if there is none"""
+        saved = self.checkpoint.load()
+        if saved:
+            self.last_history_id = saved
+            logger.info(f"Resuming from saved history ID: {saved}")
+        else:
+            self.get_initial_history_id()
+
+    def get_messages_details(self, message_ids):
+        """
+        Get details for many messages through Gmail batch requests.
+
+        IDs are deduplicated and fetched GMAIL_BATCH_SIZE per HTTP call. Each
+        item succeeds or fails on its own: messages deleted in the meantime are
+        skipped, rate-limited or failed items are retried with backoff, and
+        anything else is logged and dropped.
+
+        Returns:
+            list: Details of the messages that could be fetched, in input order.
+            list: IDs still failing with a retryable error after the retries.
+        """
+        pending = list(dict.fromkeys(message_ids))
+        results = {}
+
+        for attempt in range(GMAIL_BATCH_RETRIES + 1):
+            retry = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = parse_message_details(response)
+                elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                    logger.info(f"Message {request_id} no longer exists, skipping")
+                elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                    retry.append(request_id)
+                else:
+                    logger.error(f"Error getting message details for {request_id}: {exception}")
+
+            for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=callback)
+                for message_id in pending[start:start + GMAIL_BATCH_SIZE]:
+                    batch.add(
+                        self.service.users().messages().get(
+                            userId='me',
+                            id=message_id,
+                            format='metadata',
+                            metadataHeaders=METADATA_HEADERS
+                        ),
+                        request_id=message_id
+                    )
+                batch.execute()
+
+            if not retry:
+                break
+            if attempt == GMAIL_BATCH_RETRIES:
+                logger.error(f"{len(retry)} messages still failing after {GMAIL_BATCH_RETRIES} retries")
+                break
+            time.sleep(2 ** attempt)
+            pending = retry
+
+        found = [results[message_id] for message_id in dict.fromkeys(message_ids) if message_id in results]
+        return found, retry
+
+    def list_history_page(self, page_token=None):
+        """
+        One page of history since last_history_id.
+
+        Returns:
+            list: IDs of the messages added in this page.
+            str: Token of the next page, or None on the last one.
+            str: History ID the listing reached.
+        """
+        history = self.service.users().history().list(
+            userId='me',
+            startHistoryId=self.last_history_id,
+            historyTypes=['messageAdded'],
+            pageToken=page_token
+        ).execute()
+        message_ids = [
+            message_added['message']['id']
+            for record in history.get('history', [])
+            for message_added in record.get('messagesAdded', [])
+        ]
+        return message_ids, history.get('nextPageToken'), history['historyId']
+
+    async def list_added_message_ids(self):
+        """
+        Page through history since last_history_id and collect the added message IDs.
+
+        Every page is a separate request and takes its own rate-limit token.
+
+        Returns:
+            list: Unique message IDs, oldest first.
+            str: History ID to resume from next time.
+        """
+        message_ids = []
+        page_token = None
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire(1)
+            page_ids, page_token, history_id = await self.google_call(self.list_history_page, page_token)
+            message_ids.extend(page_ids)
+            if not page_token:
+                # a message appears once per history record that touched it
+                return list(dict.fromkeys(message_ids)), history_id
+
+    async def poll(self):
+        """
+        Detect stage: queue the IDs of messages added since the last poll.
+
+        Returns:
+            int: Number of new messages.
+        """
         try:
             if not self.last_history_id:
-                self.get_initial_history_id()
-                return []
-
-            history = self.service.users().history().list(
-                userId='me',
-                startHistoryId=self.last_history_id
-            ).execute()
-
-            new_emails = []
-
-            if 'history' in history:
-                for record in history['history']:
-                    if 'messagesAdded' in record:
-                        for message_added in record['messagesAdded']:
-                            message_id = message_added['message']['id']
-                            details = self.get_message_details(message_id)
-                            if details:
-                                new_emails.append(details)
-                                logger.info(
-                                    f"New email detected: From: {details['from']}, Subject: {details['subject']}")
-
-                self.last_history_id = history['historyId']
-
-            return new_emails
-
+                await self.google_call(self.resume_history)
+                return 0
+            message_ids, history_id = await self.list_added_message_ids()
+            self.last_poll_at = time.monotonic()
+            self.checkpoint.begin(history_id, message_ids)
+            fetch, backlog = self.queues['fetch'], self.queues.get('detect')
+            for message_id in message_ids:
+                if backlog is not None and (fetch.full() or not backlog.empty()):
+                    # never wait here: the account's own feed worker moves these on as fetch frees up
+                    backlog.put_nowait(message_id)
+                else:
+                    await fetch.put(message_id)
+            self.stage_stats['detect']['processed'] += len(message_ids)
+            self.last_history_id = history_id
+            return len(message_ids)
         except HttpError as error:
             if error.resp.status == 404:
                 logger.warning("History ID expired, getting new one")
-                self.get_initial_history_id()
-                return []
+                await self.google_call(self.get_initial_history_id)
+                return 0
+            raise
+
+    async def feed_worker(self):
+        """Detect stage backlog: move IDs a poll could not queue into fetch as it frees up"""
+        backlog = self.queues['detect']
+        while True:
+            message_id = await backlog.get()
+            try:
+                await self.queues['fetch'].put(message_id)
+            finally:
+                backlog.task_done()
+
+    async def fetch_worker(self):
+        """Fetch stage: look up metadata for up to GMAIL_BATCH_SIZE queued IDs at a time"""
+        inbox = self.queues['fetch']
+        while True:
+            message_ids = [await inbox.get()]
+            while len(message_ids) < GMAIL_BATCH_SIZE and not inbox.empty():
+                message_ids.append(inbox.get_nowait())
+            try:
+                if self.rate_limiter:
+                    # every request inside a batch counts against the account's quota
+                    await self.rate_limiter.acquire(len(message_ids))
+                found, unfinished = await self.google_call(self.get_messages_details, message_ids)
+                if unfinished:
+                    self.retry_later('fetch', unfinished, unfinished)
+                # deleted or unfetchable messages end here
+                self.message_done(set(message_ids) - set(unfinished) - {details['message_id'] for details in found})
+                for details in found:
+                    logger.info(f"📧 NEW EMAIL LOGGED: {json.dumps(details, indent=2)}")
+                    await self.queues['classify'].put(details)
+                self.stage_stats['fetch']['processed'] += len(message_ids)
+            except Exception as e:
+                logger.exception(f"Error fetching {len(message_ids)} messages")
+                self.stage_stats['fetch']['errors'] += len(message_ids)
+                if is_retryable(e):
+                    self.retry_later('fetch', message_ids, message_ids)
+                else:
+                    self.message_done(message_ids)
+            finally:
+                for _ in message_ids:
+                    inbox.task_done()
+
+    async def classify(self, details):
+        """Classify stage"""
+        try:
+            result = await self.classifier.predict(details['snippet'] + details['subject'])
+        except Exception as e:
+            if is_retryable(e):
+                # the client already retried; wait out the outage rather than lose the label
+                self.retry_later('classify', [details], [details['message_id']])
             else:
-                logger.error(f"Error checking emails: {error}")
-                return []
+                self.message_done([details['message_id']])
+            raise
+        await self.queues['label'].put((details['message_id'], result['prediction']))
+
+    async def label(self, item):
+        """Label stage: hand the prediction to the batchModify labeler"""
+        message_id, label_name = item
+        if self.labeler.add(message_id, label_name):
+            await self.google_call(self.labeler.flush)
+
+    async def stage_worker(self, name, handle):
+        inbox = self.queues[name]
+        while True:
+            item = await inbox.get()
+            try:
+                await handle(item)
+                self.stage_stats[name]['processed'] += 1
+            except Exception:
+                logger.exception(f"Error in {name} stage")
+                self.stage_stats[name]['errors'] += 1
+            finally:
+                inbox.task_done()
+
+    def pipeline_stats(self):
+        """Queue depth, processed and failed items per stage"""
+        return {
+            name: dict(stats, queued=self.queues[name].qsize() if name in self.queues else 0)
+            for name, stats in self.stage_stats.items()
+        }
+
+    def start_pipeline(self):
+        """Create the stage queues and their workers; `poll` feeds them"""
+        self.queues = {name: asyncio.Queue(PIPELINE_QUEUE_SIZE) for name in ('fetch', 'classify', 'label')}
+        # holds at most one poll's overflow, since no poll runs while it is non-empty
+        self.queues['detect'] = asyncio.Queue()
+        self.stage_stats = {name: {'processed': 0, 'errors': 0, 'retried': 0}
+                            for name in ('detect', 'fetch', 'classify', 'label')}
+        self.workers = (
+            [asyncio.create_task(self.feed_worker())]
+            + [asyncio.create_task(self.fetch_worker()) for _ in range(FETCH_WORKERS)]
+            + [asyncio.create_task(self.stage_worker('classify', self.classify)) for _ in range(CLASSIFY_WORKERS)]
+            + [asyncio.create_task(self.stage_worker('label', self.label)) for _ in range(LABEL_WORKERS)]
+            + [asyncio.create_task(self.labeler.run())]
+        )
+
+    async def drain_pipeline(self):
+        """Finish everything already queued, then stop the workers"""
+        # drain in stage order so nothing is left behind in a later queue
+        for name in ('detect', 'fetch', 'classify', 'label'):
+            await self.queues[name].join()
+        # messages still waiting for a retry stay outstanding and are picked up after a restart
+        for task in list(self.retry_tasks) + self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        # apply whatever was classified before the loop stopped
+        await self.google_call(self.labeler.flush)
+        if self.owns_classifier:
+            await self.classifier.aclose()
+        logger.info(f"Email monitoring drained for {self.account}")
+
+    def backlogged(self):
+        """True while the last poll's messages are still waiting for room in the fetch queue"""
+        backlog = self.queues.get('detect')
+        return backlog is not None and not backlog.empty()
+
+    async def poll_and_schedule(self):
+        """
+        Poll once and work out how long to wait before the next poll.
+
+        Polling never waits for the pipeline: while the account is backlogged
+        the poll is skipped and retried after POLL_MIN_INTERVAL, so a slow
+        account cannot hold one of the scheduler's shared workers.
+        """
+        if self.backlogged():
+            return POLL_MIN_INTERVAL
+        try:
+            found = await self.poll()
+            self.poll_interval = next_poll_interval(self.poll_interval, found)
+        except Exception as e:
+            logger.error(f"Error in monitoring loop for {self.account}: {e}")
+            self.stage_stats['detect']['errors'] += 1
+            self.poll_interval = next_poll_interval(self.poll_interval, 0, failed=True)
+        return self.poll_interval
 
     async def monitor_emails(self):
-        """Continuously monitor for new emails"""
+        """
+        Continuously monitor for new emails.
+
+        Runs detect -> fetch -> classify -> label as stages connected by bounded
+        queues, each with its own workers. When the fetch queue fills up, the
+        rest of a poll waits in the detect backlog and polling pauses until it
+        has drained, so a burst slows polling instead of piling up tasks.
+        After `stop_monitoring`, everything already detected is drained through
+        the pipeline before this returns.
+        """
         logger.info("Starting email monitoring...")
         self.monitoring = True
+        self._wake = asyncio.Event()
+        self.start_pipeline()
 
-        while self.monitoring:
-            try:
-                new_emails = self.check_new_emails()
-                if new_emails:
-                    for email in new_emails:
-                        logger.info(f"📧 NEW EMAIL LOGGED: {json.dumps(email, indent=2)}")
-                        asyncio.create_task(get_prediction(self.service, email['message_id'], email['snippet'] + email['subject']))
-
-                await asyncio.sleep(10)
-
-            except Exception as e:
-                logger.error(f"Error in monitoring loop: {e}")
-                await asyncio.sleep(30)
+        try:
+            while self.monitoring:
+                delay = await self.poll_and_schedule()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.drain_pipeline()
+
+    def status(self):
+        """Per-account view for /status: position, lag and throughput"""
+        return {
+            "monitoring": self.monitoring,
+            "authenticated": self.service is not None,
+            "last_history_id": self.last_history_id,
+            "committed_history_id": self.checkpoint.committed,
+            "poll_interval": self.poll_interval,
+            "seconds_since_poll": round(time.monotonic() - self.last_poll_at, 1) if self.last_poll_at else None,
+            "messages_in_flight": self.checkpoint.outstanding(),
+            "messages_per_minute": self.throughput.per_minute(),
+            "labels_applied": self.labeler.labeled,
+            "labels_pending": self.labeler.pending_count,
+            "pipeline": self.pipeline_stats(),
+        }
 
     def stop_monitoring(self):
-        """Stop email monitoring"""
+        """Stop polling; monitor_emails drains the pipeline and then returns"""
         self.monitoring = False
+        if self._wake is not None:
+            self._wake.set()
         logger.info("Email monitoring stopped")
 
-async def get_prediction(service, message_id, message):
-    """Send text to prediction endpoint and trigger label addition"""
-    url = PREDICTION_URL
-    payload = {'text': message}
-    headers = {'Content-Type': 'application/json'}
-    response = requests.post(url, json=payload, headers=headers)
-
-    if response.ok:
-        result = response.json()
-        print(result)
-        asyncio.create_task(add_label_to_email(service, message_id, result['prediction']))
-        return result
-    else:
-        print(f'Error: {response.status_code} - {response.text}')
-
-async def add_label_to_email(service, message_id, label_name):
-    """Add a label to a specific email in Gmail"""
-    try:
+def is_retryable(error):
+    """Whether a failed Gmail or classifier call may succeed later: 429, 5xx or a network error"""
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUSES
+    return isinstance(error, (httpx.TransportError, httplib2.HttpLib2Error, OSError))
+
+def parse_message_details(message):
+    """Flatten a metadata-format Gmail message into the details dict the monitor logs"""
+    headers = message['payload'].get('headers', [])
+    details = {
+        'message_id': message['id'],
+        'thread_id': message['threadId'],
+        'snippet': message.get('snippet', ''),
+        'from': '',
+        'subject': '',
+        'date': '',
+        'timestamp': datetime.now().isoformat()
+    }
+
+    for header in headers:
+        name = header['name'].lower()
+        if name == 'from':
+            details['from'] = header['value']
+        elif name == 'subject':
+            details['subject'] = header['value']
+        elif name == 'date':
+            details['date'] = header['value']
+
+    return details
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate=ACCOUNT_REQUESTS_PER_SECOND, burst=ACCOUNT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.burst)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class RateMeter:
+    """Events per minute over a sliding window"""
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def add(self, count=1):
+        with self.lock:
+            self.events.append((time.monotonic(), count))
+
+    def per_minute(self):
+        with self.lock:
+            cutoff = time.monotonic() - self.window
+            while self.events and self.events[0][0] < cutoff:
+                self.events.popleft()
+            return round(sum(count for _, count in self.events) * 60.0 / self.window, 1)
+
+
+def next_poll_interval(current, found, failed=False):
+    """
+    Seconds to wait before the next history poll.
+
+    Mail arriving resets the interval to POLL_MIN_INTERVAL; an idle poll or an
+    error doubles it, up to POLL_MAX_INTERVAL.
+    """
+    if found and not failed:
+        return POLL_MIN_INTERVAL
+    return min(POLL_MAX_INTERVAL, max(current, POLL_MIN_INTERVAL) * 2)
+
+
+class HistoryCheckpoint:
+    """
+    Durable record of the last history ID whose messages are all processed.
+
+    Each poll registers the message IDs it found together with the history ID
+    it reached. Messages are marked done as they leave the pipeline (labeled,
+    deleted, or dropped after a non-retryable error); retryable failures stay
+    outstanding until a retry gets through. Once every message of a poll, and of
+    every poll before it, is done, that poll's history ID is written to
+    `path` atomically. A restart resumes from there: nothing that arrived
+    while the service was down is skipped, and at most the unfinished polls
+    are processed again (adding a label twice is harmless).
+    """
+
+    def __init__(self, path=HISTORY_STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.polls = deque()  # [history_id, set of outstanding message IDs]
+        self.owner = {}
+        self.committed = None
+
+    def load(self):
+        """The saved history ID, or None"""
+        if not self.path or not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            self.committed = json.load(f).get('history_id')
+        return self.committed
+
+    def save(self, history_id):
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'history_id': history_id}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        self.committed = history_id
+
+    def begin(self, history_id, message_ids):
+        """Register a poll that reached `history_id` and found `message_ids`"""
+        with self.lock:
+            poll = [history_id, set(message_ids)]
+            for message_id in message_ids:
+                self.owner[message_id] = poll
+            self.polls.append(poll)
+            self._commit()
+
+    def done(self, message_ids):
+        """Mark messages as having left the pipeline"""
+        with self.lock:
+            for message_id in message_ids:
+                poll = self.owner.pop(message_id, None)
+                if poll is not None:
+                    poll[1].discard(message_id)
+            self._commit()
+
+    def _commit(self):
+        history_id = None
+        while self.polls and not self.polls[0][1]:
+            history_id = self.polls.popleft()[0]
+        if history_id is not None and history_id != self.committed:
+            self.save(history_id)
+
+    def reset(self, history_id):
+        """Start over from `history_id`, forgetting polls in flight"""
+        with self.lock:
+            self.polls.clear()
+            self.owner.clear()
+            self.save(history_id)
+
+    def outstanding(self):
+        with self.lock:
+            return sum(len(poll[1]) for poll in self.polls)
+
+
+class LabelCache:
+    """
+    Label name -> ID map for one mailbox, loaded with a single labels().list call.
+
+    The map is reloaded when it is older than `ttl` or a name is missing, and
+    missing labels are created. Lookups are serialized by a lock, so two
+    classifications of the same new label create it only once; a 409 from a
+    label created elsewhere in the meantime is resolved by reloading.
+    """
+
+    def __init__(self, ttl=LABEL_CACHE_TTL):
+        self.ttl = ttl
+        self.ids = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self, service):
         labels = service.users().labels().list(userId='me').execute()
-        label_id = None
-
-        for label in labels['labels']:
-            if label['name'] == label_name:
-                label_id = label['id']
-                break
-
-        if not label_id:
-            label_id = create_label(service, label_name)
-            if not label_id:
-                return
-
-        service.users().messages().modify(
-            userId='me',
-            id=message_id,
-            body={'addLabelIds': [label_id]}
-        ).execute()
-
-        logging.info(f"Successfully added label '{label_name}' to message {message_id}")
-        return
+        self.ids = {label['name']: label['id'] for label in labels.get('labels', [])}
+        self.loaded_at = time.monotonic()
+
+    def get_id(self, service, label_name):
+        """ID of `label_name`, creating the label if the mailbox does not have it"""
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.refresh(service)
+            if label_name not in self.ids:
+                # may have been created since the last load
+                self.refresh(service)
+            if label_name not in self.ids:
+                label_id = create_label(service, label_name)
+                if label_id is None:
+                    # a 409 means someone else created it first
+                    self.refresh(service)
+                    label_id = self.ids.get(label_name)
+                if label_id is None:
+                    return None
+                self.ids[label_name] = label_id
+            return self.ids[label_name]
+
+
+class LabelBatcher:
+    """
+    Collects (message, label) pairs and applies them with messages().batchModify.
+
+    Pending message IDs are grouped by label and flushed, one batchModify per
+    label, once LABEL_BATCH_SIZE messages are waiting or the oldest has waited
+    LABEL_FLUSH_SECONDS. Items that fail with a retryable error go back into the
+    queue for the next flush. `on_done` is called with the IDs of messages that
+    leave the batcher, labeled or dropped. Time-triggered flushes run on
+    `executor` (the default thread pool if None).
+    """
+
+    def __init__(self, service_fn, label_cache, max_batch=LABEL_BATCH_SIZE, max_wait=LABEL_FLUSH_SECONDS, on_done=None,
+                 executor=None):
+        self.service_fn = service_fn
+        # where `run` flushes; the owner's API thread, so flushes never overlap its other calls
+        self.executor = executor
+        self.label_cache = label_cache
+        self.on_done = on_done or (lambda message_ids: None)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = {}
+        self.pending_count = 0
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.labeled = 0
+        self.flushes = 0
+
+    def add(self, message_id, label_name):
+        """Queue a label; returns True once the size trigger is reached and a flush is due"""
+        return self.queue(label_name, [message_id]) >= self.max_batch
+
+    def queue(self, label_name, message_ids):
+        with self.lock:
+            self.pending.setdefault(label_name, []).extend(message_ids)
+            self.pending_count += len(message_ids)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            return self.pending_count
+
+    def due(self):
+        with self.lock:
+            return self.pending_count >= self.max_batch or (
+                self.oldest is not None and time.monotonic() - self.oldest >= self.max_wait)
+
+    def flush(self):
+        """Apply every pending label; returns the number of messages labeled"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.pending_count = 0
+            self.oldest = None
+        if not pending:
+            return 0
+
+        service = self.service_fn()
+        labeled = 0
+        for label_name, message_ids in pending.items():
+            # IDs not yet labeled; on an error exactly these are requeued or dropped
+            remaining = message_ids
+            try:
+                label_id = self.label_cache.get_id(service, label_name)
+                if label_id is None:
+                    logger.error(f"No label ID for '{label_name}', dropping {len(message_ids)} messages")
+                    self.on_done(message_ids)
+                    continue
+                while remaining:
+                    chunk = remaining[:1000]
+                    service.users().messages().batchModify(
+                        userId='me',
+                        body={'ids': chunk, 'addLabelIds': [label_id]}
+                    ).execute()
+                    remaining = remaining[1000:]
+                    labeled += len(chunk)
+                    self.on_done(chunk)
+                logger.info(f"Added label '{label_name}' to {len(message_ids)} messages")
+            except Exception as error:
+                # whatever went wrong, every swapped-out ID is either requeued or reported as done
+                logger.error(f"Error adding label '{label_name}': {error}")
+                if is_retryable(error):
+                    self.queue(label_name, remaining)
+                else:
+                    self.on_done(remaining)
+
+        with self.lock:
+            self.labeled += labeled
+            self.flushes += 1
+        return labeled
+
+    async def run(self):
+        """Flush on the time trigger until cancelled"""
+        while True:
+            await asyncio.sleep(min(self.max_wait, 1.0))
+            if self.due():
+                try:
+                    await asyncio.get_running_loop().run_in_executor(self.executor, self.flush)
+                except Exception as error:
+                    # a failed flush must not stop the time trigger for everything queued after it
+                    logger.error(f"Label flush failed: {error}")
+
+
+class ClassifierClient:
+    """
+    Async client for EMAIL_CLASSIFIER_URL with pooled keep-alive connections.
+
+    At most `concurrency` requests are in flight; each attempt has `timeout`
+    seconds. Connection errors, timeouts, 429 and 5xx responses are retried
+    up to `retries` times with full-jitter exponential backoff, honouring the
+    classifier's Retry-After when it sheds load.
+    """
+
+    def __init__(self, url=PREDICTION_URL, timeout=CLASSIFIER_TIMEOUT, retries=CLASSIFIER_RETRIES,
+                 concurrency=CLASSIFIER_CONCURRENCY, transport=None):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.concurrency = concurrency
+        self.transport = transport
+        self.client = None
+        self.semaphore = None
+
+    def _client(self):
+        # created on first use so it binds to the running event loop
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+                transport=self.transport,
+            )
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.client
+
+    async def post(self, payload, url=None):
+        """POST `payload` to the classifier (or another `url` on it) and return the decoded JSON"""
+        client = self._client()
+        url = url or self.url
+        for attempt in range(self.retries + 1):
+            delay = None
+            try:
+                async with self.semaphore:
+                    response = await client.post(url, json=payload)
+                if response.status_code not in RETRYABLE_STATUSES:
+                    response.raise_for_status()
+                    return response.json()
+                error = httpx.HTTPStatusError(f"{response.status_code} from classifier", request=response.request, response=response)
+                retry_after = response.headers.get('Retry-After', '')
+                delay = float(retry_after) if retry_after.replace('.', '', 1).isdigit() else None
+            except httpx.TransportError as e:
+                error = e
+            if attempt == self.retries:
+                raise error
+            backoff = random.uniform(0, min(30, 0.5 * 2 ** attempt))
+            await asyncio.sleep(max(delay or 0, backoff))
+
+    async def predict(self, text):
+        return await self.post({'text': text})
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
 
-    except HttpError as error:
-        logging.error(f"Error adding label to message: {error}")
-        return
 
 def create_label(service, label_name):
     """Create a new label in Gmail if it doesn't exist"""
@@ -205,5 +846,8 @@ def create_label(service, label_name):
         return result['id']
 
     except HttpError as error:
-        logging.error(f"Error creating label: {error}")
+        if error.resp.status == 409:
+            logging.info(f"Label {label_name} already exists")
+        else:
+            logging.error(f"Error creating label: {error}")
         return None
@@ -0,0 +1,113 @@
+import sys
+import os
+import asyncio
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from accounts import AccountManager, HashRing, discover_accounts
+from gmail_client import TokenBucket
+
+
+def test_hash_ring_spreads_accounts_and_moves_few_on_resize():
+    accounts = [f"user{i}@example.com" for i in range(1000)]
+    three = HashRing(["a", "b", "c"])
+    owners = {account: three.node_for(account) for account in accounts}
+    for node in "abc":
+        assert 200 < list(owners.values()).count(node) < 470
+
+    four = HashRing(["a", "b", "c", "d"])
+    moved = [account for account in accounts if four.node_for(account) != owners[account]]
+    # only accounts taken over by the new replica change hands
+    assert all(four.node_for(account) == "d" for account in moved)
+    assert len(moved) < 400
+
+
+def test_discover_accounts_reads_token_dir(tmp_path):
+    for name in ("bob.json", "alice.json", "notes.txt"):
+        (tmp_path / name).write_text("{}")
+    assert discover_accounts(str(tmp_path)) == {
+        "alice": str(tmp_path / "alice.json"),
+        "bob": str(tmp_path / "bob.json"),
+    }
+
+
+def test_token_bucket_paces_after_burst():
+    async def run():
+        bucket = TokenBucket(rate=100, burst=5)
+        start = time.monotonic()
+        await bucket.acquire(5)
+        assert time.monotonic() - start < 0.02
+        await bucket.acquire(5)
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.04
+
+
+class FakeMonitor:
+    def __init__(self, account, interval, fail=False):
+        self.account = account
+        self.interval = interval
+        self.fail = fail
+        self.service = None
+        self.monitoring = False
+        self.polls = 0
+        self.drained = False
+
+    async def google_call(self, fn, *args):
+        return fn(*args)
+
+    def authenticate(self):
+        if self.fail:
+            raise RuntimeError("no token")
+        self.service = object()
+
+    def resume_history(self):
+        pass
+
+    def start_pipeline(self):
+        pass
+
+    async def poll_and_schedule(self):
+        self.polls += 1
+        return self.interval
+
+    async def drain_pipeline(self):
+        self.drained = True
+
+    def status(self):
+        return {"polls": self.polls}
+
+
+def test_manager_schedules_accounts_by_their_own_interval(tmp_path):
+    class Classifier:
+        async def aclose(self):
+            pass
+
+    manager = AccountManager(accounts={}, replica="r1", replicas=["r1"], poll_workers=2,
+                             state_dir=str(tmp_path), classifier=Classifier())
+    busy, quiet, broken = FakeMonitor("busy", 0.01), FakeMonitor("quiet", 10), FakeMonitor("broken", 0.01, fail=True)
+    manager.monitors = {m.account: m for m in (busy, quiet, broken)}
+
+    async def run():
+        assert await manager.start() == ["busy", "quiet"]
+        await asyncio.sleep(0.2)
+        await manager.stop()
+
+    asyncio.run(run())
+    assert busy.polls > 5
+    assert quiet.polls == 1
+    assert broken.polls == 0
+    assert busy.drained and quiet.drained and not broken.drained
+    assert not busy.monitoring
+
+
+def test_manager_is_not_running_without_active_accounts(tmp_path):
+    manager = AccountManager(accounts={}, replica="r1", replicas=["r1"], state_dir=str(tmp_path), classifier=object())
+    manager.monitors = {"broken": FakeMonitor("broken", 0.01, fail=True)}
+
+    async def run():
+        assert await manager.start() == []
+        assert not manager.running and manager.task is None
+        await manager.stop()
+
+    asyncio.run(run())
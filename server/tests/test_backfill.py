@@ -0,0 +1,131 @@
+import sys
+import os
+import asyncio
+import json
+import threading
+
+import httpx
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from backfill import MAX_BACKFILL_MESSAGES_PER_SECOND, Backfill
+from gmail_client import ClassifierClient, GmailMonitor
+from test_gmail_client import Call, FakeBatch, FakeLabelService, FakeRequest, FakeService
+
+
+class MailboxService(FakeLabelService):
+    """messages().list pages over a fixed mailbox, batched gets and batchModify."""
+
+    def __init__(self, ids, page_size):
+        super().__init__({})
+        self.ids = ids
+        self.page_size = page_size
+        self.listed = []
+        self.threads = set()
+        self.messages_fake = FakeService([])
+
+    def messages(self):
+        service = self
+
+        class Messages:
+            def list(self, userId, q, maxResults, pageToken=None):
+                service.listed.append(pageToken)
+                service.threads.add(threading.current_thread().name)
+                start = int(pageToken or 0)
+                page = {'messages': [{'id': i} for i in service.ids[start:start + service.page_size]]}
+                if start + service.page_size < len(service.ids):
+                    page['nextPageToken'] = str(start + service.page_size)
+                return Call(page)
+
+            def get(self, userId, id, format, metadataHeaders):
+                return FakeRequest(id)
+
+            def batchModify(self, userId, body):
+                service.threads.add(threading.current_thread().name)
+                return service.batchModify(userId, body)
+        return Messages()
+
+    def new_batch_http_request(self, callback):
+        self.threads.add(threading.current_thread().name)
+        return FakeBatch(self.messages_fake, callback)
+
+
+def classifier(fail_on=None):
+    requests = []
+
+    def handler(request):
+        texts = json.loads(request.content)['texts']
+        requests.append((request.url.path, len(texts)))
+        if fail_on and any(fail_on in text for text in texts):
+            return httpx.Response(400)
+        return httpx.Response(200, json={'predictions': [{'prediction': 'club'} for _ in texts]})
+
+    client = ClassifierClient(url='http://classifier/predict', retries=0, transport=httpx.MockTransport(handler))
+    return client, requests
+
+
+def test_backfill_checkpoints_pages_and_resumes_after_crash(tmp_path):
+    ids = [f"m{i}" for i in range(10)]
+    state = str(tmp_path / "backfill.json")
+    gm = GmailMonitor()
+    gm.service = MailboxService(ids, page_size=4)
+
+    # the classifier rejects the second page, as if the job died there
+    gm.classifier, requests = classifier(fail_on='Subject m5')
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(Backfill(gm, state_path=state, page_size=4, classify_batch=2, rate=1000,
+                             batch_url='http://classifier/predict_batch').run())
+    with open(state) as f:
+        assert json.load(f)['page_token'] == '4'
+    assert {path for path, _ in requests} == {'/predict_batch'}
+    assert max(size for _, size in requests) == 2
+
+    gm.classifier, _ = classifier()
+    backfill = Backfill(gm, state_path=state, page_size=4, classify_batch=2, rate=1000,
+                        batch_url='http://classifier/predict_batch')
+    asyncio.run(backfill.run())
+
+    # the finished first page is not listed again
+    assert gm.service.listed == [None, '4', '4', '8']
+    labeled = [m for call in gm.service.calls if isinstance(call, tuple) for m in call[2]]
+    assert sorted(labeled) == sorted(ids)
+    # list, fetch and label calls all ran on the account's one API thread
+    assert len(gm.service.threads) == 1
+    status = backfill.status()
+    assert status['complete'] and status['pages'] == 3 and status['messages_labeled'] == 10
+
+
+def test_backfill_does_not_checkpoint_past_unfetched_messages(monkeypatch, tmp_path):
+    import gmail_client
+    monkeypatch.setattr(gmail_client.time, "sleep", lambda s: None)
+
+    ids = [f"m{i}" for i in range(6)] + ["gone"]
+    state = str(tmp_path / "backfill.json")
+    gm = GmailMonitor()
+    gm.service = MailboxService(ids, page_size=4)
+    gm.service.messages_fake.failures = {'m5': 503, 'gone': 404}
+    gm.classifier, _ = classifier()
+
+    def backfill():
+        return Backfill(gm, state_path=state, page_size=4, classify_batch=4, rate=1000,
+                        batch_url='http://classifier/predict_batch')
+
+    # m5 keeps failing after the batch retries, so its page stays unfinished
+    with pytest.raises(RuntimeError, match="could not be fetched"):
+        asyncio.run(backfill().run())
+    with open(state) as f:
+        assert json.load(f)['page_token'] == '4'
+
+    del gm.service.messages_fake.failures['m5']
+    resumed = backfill()
+    asyncio.run(resumed.run())
+    status = resumed.status()
+    # the deleted message is skipped, and only labeled messages are counted
+    assert status['complete'] and status['messages_labeled'] == 6 and status['messages_skipped'] == 1
+
+
+def test_backfill_rate_is_capped_by_the_quota_live_monitoring_leaves(tmp_path):
+    gm = GmailMonitor()
+    assert MAX_BACKFILL_MESSAGES_PER_SECOND == 40
+    assert Backfill(gm, state_path=str(tmp_path / "b.json"), rate=1000).rate == 40
+    assert Backfill(gm, state_path=str(tmp_path / "b.json"), rate=30).rate == 30
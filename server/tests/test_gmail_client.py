@@ -1,6 +1,12 @@
 import sys
 import os
+import asyncio
+import threading
+
+import httplib2
+import httpx
 import pytest
+from googleapiclient.errors import HttpError
 # ensure src directory is on path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
 from gmail_client import GmailMonitor
@@ -21,3 +27,434 @@ def test_authenticate_no_token(monkeypatch):
     with pytest.raises(Exception) as excinfo:
         gm.authenticate()
     assert "Please authenticate via /auth_url" in str(excinfo.value)
+
+
+class FakeRequest:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.items = []
+
+    def add(self, request, request_id):
+        self.items.append((request, request_id))
+
+    def execute(self):
+        self.service.batch_sizes.append(len(self.items))
+        for request, request_id in self.items:
+            status = self.service.failures.get(request.message_id)
+            if status:
+                if status == 429:
+                    # rate limited once, fine on retry
+                    del self.service.failures[request.message_id]
+                self.callback(request_id, None, HttpError(httplib2.Response({'status': status}), b'error'))
+            else:
+                self.callback(request_id, {
+                    'id': request.message_id,
+                    'threadId': 't' + request.message_id,
+                    'payload': {'headers': [{'name': 'Subject', 'value': 'Subject ' + request.message_id}]},
+                }, None)
+
+
+class FakeService:
+    """Stands in for the discovery client: history pages plus batched messages().get."""
+
+    def __init__(self, pages, failures=None):
+        self.pages = pages
+        self.failures = failures or {}
+        self.batch_sizes = []
+        self.page_tokens = []
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, startHistoryId, historyTypes, pageToken=None):
+        self.page_tokens.append(pageToken)
+        page = self.pages[int(pageToken or 0)]
+        return type('Call', (), {'execute': lambda _: page})()
+
+    def get(self, userId, id, format, metadataHeaders):
+        return FakeRequest(id)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+def history_page(ids, history_id, next_token=None):
+    page = {'historyId': history_id,
+            'history': [{'messagesAdded': [{'message': {'id': i}}]} for i in ids]}
+    if next_token:
+        page['nextPageToken'] = next_token
+    return page
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.tokens = 0
+
+    async def acquire(self, tokens=1):
+        self.tokens += tokens
+
+
+def test_poll_paginates_dedups_and_charges_every_page(tmp_path):
+    gm = GmailMonitor(state_path=str(tmp_path / "state.json"), rate_limiter=CountingLimiter())
+    gm.last_history_id = '100'
+    gm.service = FakeService(
+        [history_page(['a', 'b', 'a'], '105', next_token='1'),
+         history_page(['c', 'gone', 'busy', 'b'], '110')],
+    )
+    gm.queues = {'fetch': asyncio.Queue()}
+    gm.stage_stats = {'detect': {'processed': 0, 'errors': 0}}
+
+    assert asyncio.run(gm.poll()) == 5
+    assert gm.service.page_tokens == [None, '1']
+    assert gm.rate_limiter.tokens == 2
+    queued = [gm.queues['fetch'].get_nowait() for _ in range(gm.queues['fetch'].qsize())]
+    assert queued == ['a', 'b', 'c', 'gone', 'busy']
+    assert gm.last_history_id == '110'
+    assert gm.checkpoint.outstanding() == 5
+
+
+def test_poll_never_waits_for_a_full_pipeline(tmp_path):
+    import gmail_client
+
+    gm = GmailMonitor(state_path=str(tmp_path / "state.json"))
+    gm.last_history_id = '100'
+    gm.service = FakeService([history_page(['a', 'b', 'c'], '105')])
+
+    async def run():
+        gm.queues = {'fetch': asyncio.Queue(1), 'detect': asyncio.Queue()}
+        gm.stage_stats = {'detect': {'processed': 0, 'errors': 0}}
+        # returns at once with the overflow parked in the detect backlog
+        assert await asyncio.wait_for(gm.poll(), 1) == 3
+        assert gm.queues['fetch'].get_nowait() == 'a'
+        assert gm.backlogged() and gm.queues['detect'].qsize() == 2
+
+        # no Gmail call while backlogged, just a short retry
+        assert await gm.poll_and_schedule() == gmail_client.POLL_MIN_INTERVAL
+        assert gm.service.page_tokens == [None]
+
+        feeder = asyncio.create_task(gm.feed_worker())
+        fed = [await gm.queues['fetch'].get() for _ in range(2)]
+        await gm.queues['detect'].join()
+        feeder.cancel()
+        assert fed == ['b', 'c'] and not gm.backlogged()
+        await gm.poll_and_schedule()
+        assert gm.service.page_tokens == [None, None]
+
+    asyncio.run(run())
+
+
+def test_batched_details_skip_deleted_and_retry_rate_limited(monkeypatch):
+    import gmail_client
+    monkeypatch.setattr(gmail_client, "GMAIL_BATCH_SIZE", 2)
+    monkeypatch.setattr(gmail_client.time, "sleep", lambda s: None)
+
+    gm = GmailMonitor()
+    gm.service = FakeService([], failures={'gone': 404, 'busy': 429, 'down': 503})
+    details, unfinished = gm.get_messages_details(['a', 'b', 'a', 'c', 'gone', 'busy', 'down'])
+
+    assert [d['message_id'] for d in details] == ['a', 'b', 'c', 'busy']
+    assert details[0]['subject'] == 'Subject a'
+    # the 503 keeps failing, so it is handed back instead of dropped
+    assert unfinished == ['down']
+    # 6 unique ids in batches of 2, then the failed ones for each retry
+    assert gm.service.batch_sizes == [2, 2, 2, 2, 1, 1]
+
+
+class Call:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeLabelService:
+    """labels().list/create and messages().batchModify, recording every call."""
+
+    def __init__(self, label_ids):
+        self.label_ids = dict(label_ids)
+        self.calls = []
+
+    def users(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId):
+        self.calls.append('list')
+        return Call({'labels': [{'name': n, 'id': i} for n, i in self.label_ids.items()]})
+
+    def create(self, userId, body):
+        self.calls.append('create')
+        self.label_ids[body['name']] = 'id_' + body['name']
+        return Call({'id': self.label_ids[body['name']]})
+
+    def batchModify(self, userId, body):
+        self.calls.append(('batchModify', body['addLabelIds'][0], tuple(body['ids'])))
+        return Call({})
+
+
+def test_labeler_groups_by_label_and_caches_ids():
+    from gmail_client import LabelBatcher, LabelCache
+
+    service = FakeLabelService({'club': 'L1'})
+    labeler = LabelBatcher(lambda: service, LabelCache(), max_batch=3, max_wait=60)
+    assert not labeler.add('m1', 'club')
+    assert not labeler.add('m2', 'talks')
+    assert labeler.pending_count == 2 and service.calls == []
+    assert labeler.add('m3', 'club')  # size trigger
+    labeler.flush()
+
+    assert ('batchModify', 'L1', ('m1', 'm3')) in service.calls
+    assert ('batchModify', 'id_talks', ('m2',)) in service.calls
+    assert labeler.labeled == 3 and labeler.pending_count == 0
+
+    labeler.add('m4', 'talks')
+    labeler.flush()
+    # one load, one reload for the unknown label, one create; the next flush is all cache hits
+    assert [c for c in service.calls if not isinstance(c, tuple)] == ['list', 'list', 'create']
+
+
+def test_labeler_requeues_transport_errors_and_keeps_flushing():
+    from gmail_client import LabelBatcher, LabelCache
+
+    service = FakeLabelService({'club': 'L1', 'talks': 'L2'})
+    errors = {'L1': TimeoutError('read timed out'), 'L2': ValueError('bad response')}
+
+    def batch_modify(userId, body):
+        error = errors.pop(body['addLabelIds'][0], None)
+        if error:
+            raise error
+        return FakeLabelService.batchModify(service, userId, body)
+
+    service.batchModify = batch_modify
+    done = []
+    labeler = LabelBatcher(lambda: service, LabelCache(), max_batch=10, max_wait=0.01, on_done=done.extend)
+    labeler.queue('club', ['m1', 'm2'])
+    labeler.queue('talks', ['m3'])
+
+    # the timeout is requeued, the unexpected error is reported as done instead of vanishing
+    assert labeler.flush() == 0
+    assert labeler.pending == {'club': ['m1', 'm2']} and done == ['m3']
+
+    def failing_then_real_flush(original=labeler.flush):
+        labeler.flush = original
+        raise RuntimeError('executor blew up')
+
+    labeler.flush = failing_then_real_flush
+
+    async def run():
+        task = asyncio.create_task(labeler.run())
+        while labeler.pending_count:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    # the failed flush is logged and the time trigger carries on
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert sorted(done) == ['m1', 'm2', 'm3'] and labeler.labeled == 2
+
+
+def test_label_cache_resolves_concurrent_creation():
+    from gmail_client import LabelCache
+
+    service = FakeLabelService({})
+
+    def create_conflict(userId, body):
+        # another worker created the label between our reload and create
+        service.label_ids[body['name']] = 'theirs'
+        raise HttpError(httplib2.Response({'status': 409}), b'exists')
+
+    service.create = create_conflict
+    assert LabelCache().get_id(service, 'club') == 'theirs'
+
+
+def test_classifier_client_retries_and_limits_concurrency(monkeypatch):
+    import gmail_client
+    monkeypatch.setattr(gmail_client.random, "uniform", lambda a, b: 0)
+
+    state = {'calls': 0, 'in_flight': 0, 'peak': 0}
+
+    async def handler(request):
+        state['calls'] += 1
+        if state['calls'] == 1:
+            return httpx.Response(503, headers={'Retry-After': '0'})
+        state['in_flight'] += 1
+        state['peak'] = max(state['peak'], state['in_flight'])
+        await asyncio.sleep(0.01)
+        state['in_flight'] -= 1
+        return httpx.Response(200, json={'prediction': 'club'})
+
+    client = gmail_client.ClassifierClient(url='http://classifier/predict', retries=2, concurrency=2,
+                                           transport=httpx.MockTransport(handler))
+
+    async def run():
+        try:
+            return await asyncio.gather(*(client.predict(f"text {i}") for i in range(6)))
+        finally:
+            await client.aclose()
+
+    results = asyncio.run(run())
+    assert [r['prediction'] for r in results] == ['club'] * 6
+    assert state['calls'] == 7  # one 503, retried
+    assert state['peak'] <= 2
+
+
+def test_classifier_client_gives_up_after_retries(monkeypatch):
+    import gmail_client
+    monkeypatch.setattr(gmail_client.random, "uniform", lambda a, b: 0)
+
+    client = gmail_client.ClassifierClient(url='http://classifier/predict', retries=1,
+                                           transport=httpx.MockTransport(lambda request: httpx.Response(500)))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.predict("text"))
+
+
+class PipelineService(FakeLabelService):
+    """History, batched metadata and labels in one fake, as the monitor sees the API."""
+
+    def __init__(self, new_ids):
+        super().__init__({})
+        self.history_pages = [history_page(new_ids, '2')]
+        self.messages_fake = FakeService([])
+        self.threads = set()
+
+    def batchModify(self, userId, body):
+        self.threads.add(threading.current_thread().name)
+        return super().batchModify(userId, body)
+
+    def history(self):
+        service = self
+
+        class History:
+            def list(self, userId, startHistoryId, historyTypes, pageToken=None):
+                service.threads.add(threading.current_thread().name)
+                page = service.history_pages.pop(0) if service.history_pages else history_page([], '2')
+                return Call(page)
+        return History()
+
+    def get(self, userId, id, format, metadataHeaders):
+        return FakeRequest(id)
+
+    def new_batch_http_request(self, callback):
+        self.threads.add(threading.current_thread().name)
+        return FakeBatch(self.messages_fake, callback)
+
+
+def test_pipeline_drains_on_stop(monkeypatch):
+    import gmail_client
+    monkeypatch.setattr(gmail_client, "PIPELINE_QUEUE_SIZE", 2)
+    monkeypatch.setattr(gmail_client, "POLL_MIN_INTERVAL", 0.01)
+    monkeypatch.setattr(gmail_client, "POLL_MAX_INTERVAL", 0.02)
+    monkeypatch.setattr(gmail_client, "CLASSIFY_WORKERS", 2)
+
+    ids = [f"m{i}" for i in range(7)]
+    gm = GmailMonitor()
+    gm.last_history_id = '1'
+    gm.service = PipelineService(ids)
+    gm.labeler.max_batch = 1000  # only the drain flushes
+    gm.classifier = gmail_client.ClassifierClient(
+        url='http://classifier/predict',
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, json={'prediction': 'club'})))
+
+    async def run():
+        task = asyncio.create_task(gm.monitor_emails())
+        while gm.stage_stats.get('detect', {}).get('processed', 0) < len(ids):
+            await asyncio.sleep(0.01)
+        gm.stop_monitoring()
+        await task
+
+    asyncio.run(run())
+
+    labeled = [m for call in gm.service.calls if isinstance(call, tuple) for m in call[2]]
+    assert sorted(labeled) == ids
+    # polls, fetches and label flushes never share the httplib2 connection across threads
+    assert len(gm.service.threads) == 1 and gm.service.threads.pop().startswith('gmail-')
+    stats = gm.pipeline_stats()
+    assert stats['classify']['processed'] == len(ids)
+    assert all(s['queued'] == 0 and s['errors'] == 0 for s in stats.values())
+
+    # every message is labeled, so the poll's history ID is on disk and a restart resumes from it
+    assert gm.checkpoint.committed == '2'
+    restarted = GmailMonitor()
+    restarted.resume_history()
+    assert restarted.last_history_id == '2'
+
+
+def test_classifier_outage_holds_back_the_checkpoint(monkeypatch, tmp_path):
+    import gmail_client
+    monkeypatch.setattr(gmail_client, "POLL_MIN_INTERVAL", 0.01)
+    monkeypatch.setattr(gmail_client, "POLL_MAX_INTERVAL", 0.02)
+    monkeypatch.setattr(gmail_client.random, "uniform", lambda a, b: 0)
+
+    state = str(tmp_path / "state.json")
+    gm = GmailMonitor(state_path=state)
+    gm.checkpoint.reset('1')
+    gm.last_history_id = '1'
+    gm.service = PipelineService(['m1', 'm2'])
+    gm.classifier = gmail_client.ClassifierClient(
+        url='http://classifier/predict', retries=0,
+        transport=httpx.MockTransport(lambda request: httpx.Response(503)))
+
+    async def run():
+        task = asyncio.create_task(gm.monitor_emails())
+        while gm.stage_stats.get('classify', {}).get('retried', 0) < 4:
+            await asyncio.sleep(0.01)
+        gm.stop_monitoring()
+        await task
+
+    asyncio.run(run())
+
+    # nothing was labeled, so a restart must start before these messages again
+    assert gm.checkpoint.outstanding() == 2
+    assert gm.checkpoint.committed == '1'
+    restarted = GmailMonitor(state_path=state)
+    restarted.resume_history()
+    assert restarted.last_history_id == '1'
+
+
+def test_checkpoint_commits_only_fully_processed_polls(tmp_path):
+    from gmail_client import HistoryCheckpoint
+
+    path = str(tmp_path / "history.json")
+    checkpoint = HistoryCheckpoint(path)
+    checkpoint.begin('10', ['a', 'b'])
+    checkpoint.begin('11', ['c'])
+    checkpoint.begin('12', [])
+
+    checkpoint.done(['c'])
+    assert checkpoint.committed is None  # 'a' and 'b' from the earlier poll are still in flight
+    checkpoint.done(['a'])
+    assert checkpoint.committed is None
+    checkpoint.done(['b'])
+    assert checkpoint.committed == '12'
+    assert HistoryCheckpoint(path).load() == '12'
+
+
+def test_poll_interval_backs_off_when_idle_and_tightens_on_mail(monkeypatch):
+    import gmail_client
+    monkeypatch.setattr(gmail_client, "POLL_MIN_INTERVAL", 2)
+    monkeypatch.setattr(gmail_client, "POLL_MAX_INTERVAL", 10)
+
+    interval = 2
+    intervals = []
+    for found in [0, 0, 0, 0, 5, 0]:
+        interval = gmail_client.next_poll_interval(interval, found)
+        intervals.append(interval)
+    assert intervals == [4, 8, 10, 10, 2, 4]
+    assert gmail_client.next_poll_interval(2, 3, failed=True) == 4
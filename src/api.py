@@ -1,5 +1,14 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import asyncio
+import os
+import threading
+
+import numpy as np
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict
 
 import sys
 
@@ -8,13 +17,57 @@ print(sys.version)     # full version string
 
 # import inference
 from . import inference
+from .batching import MicroBatcher, QueueFullError
 
 print("MODEL_LOADED", flush=True)
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load and warm up the models in the background so /ready can report progress
+    threading.Thread(target=inference.registry.load, daemon=True).start()
+    batcher.start()
+    explain_batcher.start()
+    yield
+    batcher.stop()
+    explain_batcher.stop()
+
+
+# Upper bound on texts accepted by one /predict_batch call
+MAX_PREDICT_BATCH = int(os.environ.get("MAX_PREDICT_BATCH", "256"))
+# Seconds clients are told to wait when the inference queue is full
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", "1"))
+
+batcher = MicroBatcher(inference.predict_proba, workers=inference.INFERENCE_WORKERS)
+# /explain gets its own bounded queue and one worker, so a burst of it sheds load instead of crowding out /predict
+explain_batcher = MicroBatcher(inference.explain_batch, workers=1)
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, exc: QueueFullError):
+    # shed load instead of letting requests pile up behind the workers
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Inference queue is full, retry later"},
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
 
 class Message(BaseModel):
     text: str
 
+class MessageBatch(BaseModel):
+    texts: List[str]
+
+class ReloadRequest(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    model_path: Optional[str] = None
+    encoder_name: Optional[str] = None
+    encoder_backend: Optional[str] = None
+    # "" turns the cascade off
+    cascade_path: Optional[str] = None
+
 label = {
     0: "Academics",
     1: "Clubs",
@@ -27,9 +80,79 @@ label = {
 async def read_root():
     return {"message": "Hello, FastAPI"}
 
+@app.get("/ready")
+async def ready():
+    if not inference.registry.ready:
+        # error stays None while the first load is still running
+        return JSONResponse(status_code=503, content={"ready": False, "error": inference.registry.load_error})
+    return {
+        "ready": True,
+        "model_path": inference.registry.model_path,
+        "encoder_name": inference.registry.encoder_name,
+        "encoder_backend": inference.registry.encoder_backend,
+        # set when a reload failed and the previous models are still serving
+        "error": inference.registry.load_error,
+    }
+
+@app.post("/reload")
+async def reload(request: ReloadRequest):
+    # The old models keep serving until the new pair is loaded and warmed up, or for good if loading fails
+    try:
+        await asyncio.to_thread(
+            inference.registry.load, request.model_path, request.encoder_name, request.encoder_backend,
+            request.cascade_path,
+        )
+    except Exception:
+        raise HTTPException(status_code=500, detail=f"Reload failed: {inference.registry.load_error}")
+    return {
+        "model_path": inference.registry.model_path,
+        "encoder_name": inference.registry.encoder_name,
+        "encoder_backend": inference.registry.encoder_backend,
+        "cascade_path": inference.registry.cascade_path,
+    }
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "batching": batcher.stats(),
+        "explain_batching": explain_batcher.stats(),
+        "embedding_cache": inference.cache.stats(),
+        "cascade": inference.cascade.stats(),
+    }
+
 @app.post("/predict")
 async def predict(message: Message):
     # Here you would call your prediction function
     # For demonstration, we return a dummy response
-    prediction = inference.predict(message.text)
+    probabilities = await batcher.predict([message.text])
+    prediction = int(np.argmax(probabilities[0]))
     return {"prediction": label[prediction], "id": prediction}
+
+@app.post("/explain")
+async def explain(message: Message):
+    try:
+        scores = (await explain_batcher.predict([message.text]))[0]
+    except inference.PrototypesNotLoadedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"closest_prototype": next(iter(scores), None), "prototype_scores": scores}
+
+@app.post("/predict_batch")
+async def predict_batch(batch: MessageBatch):
+    if len(batch.texts) > MAX_PREDICT_BATCH:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {len(batch.texts)} texts exceeds the limit of {MAX_PREDICT_BATCH}"
+        )
+    if not batch.texts:
+        return {"predictions": []}
+
+    probabilities = await batcher.predict(batch.texts)
+    predictions = []
+    for row in probabilities:
+        idx = int(np.argmax(row))
+        predictions.append({
+            "prediction": label[idx],
+            "id": idx,
+            "probabilities": {label[i]: float(p) for i, p in enumerate(row)},
+        })
+    return {"predictions": predictions}
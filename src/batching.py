@@ -0,0 +1,196 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+MAX_BATCH_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "32"))
+MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "5"))
+# Requests allowed to wait for a worker before new ones are rejected
+MAX_QUEUE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "256"))
+
+
+class QueueFullError(Exception):
+    """Raised by `MicroBatcher.submit` when the request queue is at capacity."""
+
+
+class _Request:
+    __slots__ = ("texts", "future")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent prediction requests into one batched forward pass.
+
+    Callers submit a list of texts and get a future for its rows of the
+    probability matrix. Each of `workers` background threads drains the queue
+    until it holds `max_batch_size` texts or `max_wait_ms` has passed since the
+    first request of the batch, runs `handler` once on the concatenated texts
+    and splits the result (anything sliced by row, one row per text) back to
+    each caller. At most `max_queue` requests
+    may wait; beyond that `submit` raises `QueueFullError` so callers can shed
+    load instead of piling it up.
+    """
+
+    def __init__(
+            self,
+            handler: Callable[[List[str]], np.ndarray],
+            max_batch_size: int = MAX_BATCH_SIZE,
+            max_wait_ms: float = MAX_WAIT_MS,
+            workers: int = 1,
+            max_queue: int = MAX_QUEUE,
+    ):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue(maxsize=max_queue)
+        self._threads: List[threading.Thread] = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._histogram: Dict[int, int] = {}
+        self._rejected = 0
+
+    def start(self) -> None:
+        """Start the worker threads if they are not running yet."""
+        with self._start_lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run, name=f"micro-batcher-{len(self._threads)}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Ask the workers to exit once the requests already queued are served."""
+        with self._start_lock:
+            alive = [t for t in self._threads if t.is_alive()]
+            for _ in alive:
+                self._queue.put(None)
+            for thread in alive:
+                thread.join()
+            self._threads = []
+
+    def submit(self, texts: List[str]) -> Future:
+        """
+        Queue texts for prediction.
+
+        Args:
+            texts (List[str]): Texts to classify.
+
+        Returns:
+            Future: Resolves to an array of shape (len(texts), num_classes).
+
+        Raises:
+            QueueFullError: If `max_queue` requests are already waiting.
+        """
+        self.start()
+        request = _Request(list(texts))
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            raise QueueFullError(f"{self.max_queue} requests already queued")
+        return request.future
+
+    async def predict(self, texts: List[str]) -> np.ndarray:
+        """Awaitable wrapper around `submit` for use from request handlers."""
+        return await asyncio.wrap_future(self.submit(texts))
+
+    def stats(self) -> dict:
+        """Queue depth and batch-size histogram since startup."""
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self.max_queue,
+                "workers": self.workers,
+                "rejected": self._rejected,
+                "batches": self._batches,
+                "items": self._items,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_ms,
+                # bucket "n" counts batches with size in (n/2, n]
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._histogram.items())},
+            }
+
+    def _collect(self, first: _Request) -> (List[_Request], Optional[_Request], bool):
+        """
+        Gather requests following `first` until the batch is full or the wait expires.
+
+        Returns the batch, a request that did not fit and must open the next
+        batch, and whether a stop sentinel was seen.
+        """
+        batch = [first]
+        size = len(first.texts)
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, None, True
+            if size + len(request.texts) > self.max_batch_size:
+                return batch, request, False
+            batch.append(request)
+            size += len(request.texts)
+        return batch, None, False
+
+    def _run(self) -> None:
+        carry: Optional[_Request] = None
+        stopping = False
+        while True:
+            first = carry if carry is not None else (None if stopping else self._queue.get())
+            if first is None:
+                return
+            batch, carry, stop_seen = self._collect(first)
+            if stop_seen and stopping:
+                # that sentinel belongs to another worker
+                self._queue.put(None)
+            stopping = stopping or stop_seen
+            self._process(batch)
+
+    def _process(self, batch: List[_Request]) -> None:
+        # drop requests whose caller went away; the rest can no longer be cancelled
+        batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        texts = [text for request in batch for text in request.texts]
+        self._record(len(texts))
+        try:
+            probabilities = self.handler(texts)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        offset = 0
+        for request in batch:
+            n = len(request.texts)
+            request.future.set_result(probabilities[offset:offset + n])
+            offset += n
+
+    def _record(self, size: int) -> None:
+        bucket = 1
+        while bucket < size:
+            bucket *= 2
+        with self._stats_lock:
+            self._batches += 1
+            self._items += size
+            self._histogram[bucket] = self._histogram.get(bucket, 0) + 1
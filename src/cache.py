@@ -0,0 +1,212 @@
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """
+    Canonical form of a text for cache lookups: NFC unicode and collapsed whitespace.
+
+    The SBERT tokenizer splits on whitespace anyway, so this does not change the
+    embedding, but it lets re-sent copies of the same email share one entry.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def content_key(text: str, model_name: str) -> str:
+    """
+    Content address of an embedding: a hash of the encoder name and the normalized text.
+
+    Args:
+        text (str): The raw text.
+        model_name (str): Name of the encoder that produces the embedding.
+
+    Returns:
+        str: Hex SHA-256 digest.
+    """
+    payload = model_name + "\0" + normalize_text(text)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SqliteEmbeddingStore:
+    """
+    Persistent key → float32 vector table backed by a single sqlite file.
+
+    Each row records which writer added it (`origin`), so one job can sweep
+    its own stale embeddings from a store it shares with others.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, origin TEXT)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")}
+        if "origin" not in columns:
+            # stores created before origins were recorded
+            self._conn.execute("ALTER TABLE embeddings ADD COLUMN origin TEXT")
+        self._conn.commit()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Return the stored vectors for whichever of `keys` are present."""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            # stay well below sqlite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray], origin: Optional[str] = None) -> None:
+        """Insert or replace vectors, recording `origin` as their writer."""
+        rows = [(key, np.asarray(vec, dtype=np.float32).tobytes(), origin) for key, vec in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, origin) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def mark_live(self, keys: Iterable[str]) -> None:
+        """
+        Record keys that are still in use; `sweep` deletes everything else.
+
+        Marks live in a temporary table on this connection, so a full mailbox
+        can be marked chunk by chunk without holding every key in memory.
+        """
+        with self._lock:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_keys (key TEXT PRIMARY KEY)")
+            self._conn.executemany("INSERT OR IGNORE INTO live_keys (key) VALUES (?)", ((k,) for k in keys))
+
+    def sweep(self, origin: Optional[str] = None) -> int:
+        """
+        Delete every embedding not marked with `mark_live` since the last sweep.
+
+        Args:
+            origin (str): Only consider embeddings this writer added; None sweeps them all.
+
+        Returns:
+            int: Number of embeddings removed.
+        """
+        with self._lock:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_keys (key TEXT PRIMARY KEY)")
+            stale = "key NOT IN (SELECT key FROM live_keys)"
+            if origin is None:
+                removed = self._conn.execute(f"DELETE FROM embeddings WHERE {stale}").rowcount
+            else:
+                removed = self._conn.execute(
+                    f"DELETE FROM embeddings WHERE origin = ? AND {stale}", (origin,)
+                ).rowcount
+            self._conn.execute("DROP TABLE live_keys")
+            self._conn.commit()
+        return removed
+
+    def compact(self) -> None:
+        """Reclaim the space left by deleted embeddings."""
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    Bounded in-memory LRU of embeddings with an optional persistent tier.
+
+    Lookups check memory first, then the store; store hits are promoted into
+    memory. New entries are written to both tiers.
+    """
+
+    def __init__(self, max_entries: int = 10000, store: Optional[SqliteEmbeddingStore] = None):
+        self.max_entries = max_entries
+        self.store = store
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up embeddings by key, counting hits and misses.
+
+        Args:
+            keys (Iterable[str]): Content keys from `content_key`.
+
+        Returns:
+            Dict[str, np.ndarray]: Embeddings for the keys that were found.
+        """
+        keys = list(keys)
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                vec = self._entries.get(key)
+                if vec is None:
+                    missing.append(key)
+                else:
+                    self._entries.move_to_end(key)
+                    found[key] = vec
+            self.hits += len(found)
+
+        if missing and self.store is not None:
+            from_disk = self.store.get_many(missing)
+            if from_disk:
+                with self._lock:
+                    self.disk_hits += len(from_disk)
+                    self._insert(from_disk)
+                found.update(from_disk)
+
+        with self._lock:
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        """Add freshly computed embeddings to the cache."""
+        if not items:
+            return
+        with self._lock:
+            self._insert(items)
+        if self.store is not None:
+            self.store.put_many(items)
+
+    def _insert(self, items: Dict[str, np.ndarray]) -> None:
+        if self.max_entries <= 0:
+            return
+        for key, vec in items.items():
+            self._entries[key] = vec
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "persistent": self.store.path if self.store is not None else None,
+            }
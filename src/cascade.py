@@ -0,0 +1,276 @@
+import argparse
+import random
+import threading
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+try:
+    from .head import NumpyHead, _softmax
+except ImportError:  # run as a script from src/
+    from head import NumpyHead, _softmax
+
+# Hashed feature space of the first stage: word unigrams and bigrams
+N_FEATURES = 2 ** 18
+NGRAM_RANGE = (1, 2)
+
+
+class HashedLinearModel:
+    """
+    Multinomial logistic regression over hashed word n-grams.
+
+    The hashing vectorizer is stateless, so the model is just a (num_classes,
+    n_features) weight matrix and a bias: a prediction is one sparse
+    matrix product, with no encoder and no vocabulary to load. Columns of
+    `predict_proba` follow the same label encoding as the SBERT head, and
+    `classes` names them so serving can check the two line up.
+    """
+
+    def __init__(self, coef: np.ndarray, intercept: np.ndarray, classes: Sequence[str],
+                 n_features: int = N_FEATURES, ngram_range: Tuple[int, int] = NGRAM_RANGE):
+        self.coef = np.asarray(coef, dtype=np.float32)
+        self.intercept = np.asarray(intercept, dtype=np.float32)
+        self.classes = [str(c) for c in classes]
+        if len(self.classes) != self.coef.shape[0]:
+            raise ValueError(f"{len(self.classes)} class names for {self.coef.shape[0]} weight rows")
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features, ngram_range=self.ngram_range, alternate_sign=False, norm="l2"
+        )
+
+    @property
+    def num_classes(self) -> int:
+        return self.coef.shape[0]
+
+    @classmethod
+    def fit(cls, texts: Sequence[str], y: np.ndarray, classes: Sequence[str], n_features: int = N_FEATURES,
+            ngram_range: Tuple[int, int] = NGRAM_RANGE, C: float = 10.0) -> "HashedLinearModel":
+        """
+        Train on labels `y` encoded as positions in `classes`.
+
+        Classes missing from `y` get a zero row with a very low bias, so they are
+        never predicted but the column layout still matches the head.
+        """
+        from sklearn.linear_model import LogisticRegression
+
+        num_classes = len(classes)
+        model = cls(np.zeros((num_classes, n_features)), np.zeros(num_classes), classes, n_features, ngram_range)
+        X = model.vectorizer.transform(texts)
+        clf = LogisticRegression(C=C, max_iter=1000)
+        clf.fit(X, y)
+
+        coef = np.zeros((num_classes, n_features), dtype=np.float32)
+        intercept = np.full(num_classes, -1e4, dtype=np.float32)
+        if len(clf.classes_) == 2:
+            # binary logistic regression has one row; as softmax logits that is [0, z]
+            coef[clf.classes_[1]], intercept[clf.classes_[1]] = clf.coef_[0], clf.intercept_[0]
+            intercept[clf.classes_[0]] = 0.0
+        else:
+            coef[clf.classes_], intercept[clf.classes_] = clf.coef_, clf.intercept_
+        model.coef, model.intercept = coef, intercept
+        return model
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Args:
+            texts (Sequence[str]): Raw email texts.
+
+        Returns:
+            np.ndarray: Class probabilities of shape (len(texts), num_classes).
+        """
+        X = self.vectorizer.transform(texts)
+        return _softmax(np.asarray(X @ self.coef.T) + self.intercept)
+
+    def save(self, path: str) -> None:
+        np.savez(path, coef=self.coef, intercept=self.intercept, classes=np.array(self.classes),
+                 n_features=np.array(self.n_features), ngram_range=np.array(self.ngram_range))
+
+    @classmethod
+    def load(cls, path: str) -> "HashedLinearModel":
+        with np.load(path, allow_pickle=False) as data:
+            if "classes" not in data.files:
+                raise ValueError(f"{path} does not record its classes; retrain it with 'cascade.py train'")
+            return cls(data["coef"], data["intercept"], list(data["classes"]), int(data["n_features"]),
+                       tuple(int(n) for n in data["ngram_range"]))
+
+
+def confident(probs: np.ndarray, threshold: float, min_margin: float = 0.0) -> np.ndarray:
+    """
+    Rows the first stage may answer on its own: top probability at least
+    `threshold` and at least `min_margin` ahead of the runner-up.
+    """
+    top = np.sort(probs, axis=1)[:, ::-1]
+    runner_up = top[:, 1] if probs.shape[1] > 1 else np.zeros(len(probs))
+    return (top[:, 0] >= threshold) & (top[:, 0] - runner_up >= min_margin)
+
+
+class Cascade:
+    """
+    Routes a batch through the cheap first stage and sends only the ambiguous
+    rows on to the full SBERT + head path.
+
+    A `shadow_rate` fraction of the short-circuited rows is also run through
+    the full path. The full answer is returned for those, and how often it
+    disagrees with the first stage estimates the accuracy given up by
+    short-circuiting, measured against the full path.
+    """
+
+    def __init__(self, threshold: float = 0.9, min_margin: float = 0.0, shadow_rate: float = 0.0):
+        self.threshold = threshold
+        self.min_margin = min_margin
+        self.shadow_rate = shadow_rate
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._short_circuited = 0
+        self._shadowed = 0
+        self._disagreements = 0
+
+    def reset(self) -> None:
+        """Zero the counters, e.g. when either stage is swapped for a new model."""
+        with self._lock:
+            self._requests = 0
+            self._short_circuited = 0
+            self._shadowed = 0
+            self._disagreements = 0
+
+    def predict_proba(self, texts: List[str], fast: HashedLinearModel,
+                      full: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        probs = fast.predict_proba(texts)
+        easy = confident(probs, self.threshold, self.min_margin)
+        shadow = easy & np.array([random.random() < self.shadow_rate for _ in texts], dtype=bool)
+        needs_full = ~easy | shadow
+
+        disagreements = 0
+        if needs_full.any():
+            rows = np.flatnonzero(needs_full)
+            full_probs = full([texts[i] for i in rows])
+            disagreements = int((probs[rows].argmax(axis=1) != full_probs.argmax(axis=1))[shadow[rows]].sum())
+            probs[rows] = full_probs
+
+        with self._lock:
+            self._requests += len(texts)
+            self._short_circuited += int(easy.sum())
+            self._shadowed += int(shadow.sum())
+            self._disagreements += disagreements
+        return probs
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            fraction = self._short_circuited / self._requests if self._requests else 0.0
+            disagreement = self._disagreements / self._shadowed if self._shadowed else None
+            return {
+                "threshold": self.threshold,
+                "min_margin": self.min_margin,
+                "requests": self._requests,
+                "short_circuited": self._short_circuited,
+                "short_circuit_fraction": fraction,
+                "shadowed": self._shadowed,
+                "shadow_disagreement": disagreement,
+                # the share of all answers that differ from what the full path would have said
+                "estimated_accuracy_loss": fraction * disagreement if disagreement is not None else None,
+            }
+
+
+def evaluate(fast_probs: np.ndarray, full_probs: np.ndarray, y: np.ndarray,
+             thresholds: Sequence[float], min_margin: float = 0.0) -> List[Dict[str, float]]:
+    """
+    Offline sweep of the cascade threshold on labeled data.
+
+    Returns:
+        List[Dict[str, float]]: Per threshold, the fraction short-circuited, the
+        accuracy of the full path and of the cascade, and the loss between them.
+    """
+    full_pred = full_probs.argmax(axis=1)
+    full_accuracy = float((full_pred == y).mean())
+    rows = []
+    for threshold in thresholds:
+        easy = confident(fast_probs, threshold, min_margin)
+        pred = np.where(easy, fast_probs.argmax(axis=1), full_pred)
+        accuracy = float((pred == y).mean())
+        rows.append({
+            "threshold": threshold,
+            "short_circuit_fraction": float(easy.mean()),
+            "agreement_with_full": float((pred == full_pred).mean()),
+            "full_accuracy": full_accuracy,
+            "cascade_accuracy": accuracy,
+            "accuracy_loss": full_accuracy - accuracy,
+        })
+    return rows
+
+
+def _load_split(data: str):
+    """Texts, encoded labels, label names, train/test positions and the frame of a preprocessed file"""
+    try:
+        from .train import load_processed_data, split_indices
+    except ImportError:
+        from train import load_processed_data, split_indices
+    from sklearn.preprocessing import LabelEncoder
+
+    df, embeddings = load_processed_data(data, columns=['message'])
+    le = LabelEncoder()
+    # same encoding and split as train.py, so columns match the head and the test rows are unseen
+    y = le.fit_transform(df['label'])
+    train_idx, test_idx = split_indices(y)
+    return df, embeddings, y, list(le.classes_), train_idx, test_idx
+
+
+def train_main(args) -> None:
+    df, _, y, classes, train_idx, test_idx = _load_split(args.data)
+    texts = df['message'].astype(str).to_numpy()
+    model = HashedLinearModel.fit(texts[train_idx], y[train_idx], classes, n_features=args.n_features, C=args.C)
+    model.save(args.output)
+    accuracy = (model.predict_proba(texts[test_idx]).argmax(axis=1) == y[test_idx]).mean()
+    print(f"Saved first stage to {args.output}; held-out accuracy {accuracy:.4f}")
+
+
+def eval_main(args) -> None:
+    try:
+        from .train import load_features
+    except ImportError:
+        from train import load_features
+
+    df, embeddings, y, _, _, test_idx = _load_split(args.data)
+    test = df.iloc[test_idx]
+    fast = HashedLinearModel.load(args.fast_model)
+    if args.model_path.endswith(".npz"):
+        head = NumpyHead.load(args.model_path)
+    else:
+        from tensorflow.keras.models import load_model
+        head = load_model(args.model_path)
+
+    fast_probs = fast.predict_proba(test['message'].astype(str).tolist())
+    full_probs = np.asarray(head.predict_on_batch(load_features(test, embeddings)))
+    thresholds = [float(t) for t in args.thresholds.split(",")]
+    print(f"{'threshold':>9} {'short-circuit':>13} {'agreement':>9} {'full acc':>8} {'cascade acc':>11} {'loss':>7}")
+    for row in evaluate(fast_probs, full_probs, y[test_idx], thresholds, args.min_margin):
+        print(f"{row['threshold']:>9.2f} {row['short_circuit_fraction']:>13.3f} {row['agreement_with_full']:>9.3f} "
+              f"{row['full_accuracy']:>8.4f} {row['cascade_accuracy']:>11.4f} {row['accuracy_loss']:>7.4f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train and evaluate the cheap first stage of the inference cascade.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train = sub.add_parser("train", help="Fit the hashed n-gram model on preprocessed data")
+    train.add_argument("--data", required=True, help="Output of preprocess.py (.parquet or .pkl)")
+    train.add_argument("--output", default="cascade.npz", help="Where to save the first stage")
+    train.add_argument("--n_features", type=int, default=N_FEATURES, help="Hashed feature dimensions")
+    train.add_argument("--C", type=float, default=10.0, help="Inverse regularization strength")
+    train.set_defaults(func=train_main)
+
+    evaluate_parser = sub.add_parser("eval", help="Short-circuit rate and accuracy loss per threshold")
+    evaluate_parser.add_argument("--data", required=True, help="Output of preprocess.py (.parquet or .pkl)")
+    evaluate_parser.add_argument("--fast_model", required=True, help="First stage saved by 'train'")
+    evaluate_parser.add_argument("--model_path", required=True, help="Classifier head (.keras or .npz)")
+    evaluate_parser.add_argument("--thresholds", default="0.5,0.6,0.7,0.8,0.9,0.95,0.99")
+    evaluate_parser.add_argument("--min_margin", type=float, default=0.0)
+    evaluate_parser.set_defaults(func=eval_main)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
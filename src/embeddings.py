@@ -1,42 +1,289 @@
+import numpy as np
 import pandas as pd
 import torch
 from sentence_transformers import SentenceTransformer
 from torch import Tensor
+from typing import List, Optional, Tuple
 import argparse
+import hashlib
+import json
+import os
+
+try:
+    from .cache import SqliteEmbeddingStore, content_key, normalize_text
+except ImportError:  # run as a script from src/
+    from cache import SqliteEmbeddingStore, content_key, normalize_text
+
+TRUNCATION_STRATEGIES = ("head", "head_tail")
+
+def is_parquet(file_path: str) -> bool:
+    """True for a .parquet file or a directory of Parquet part files (see scripts/extract_mails.py)."""
+    return file_path.rstrip("/").endswith(".parquet")
+
+def parquet_files(file_path: str) -> List[str]:
+    """The Parquet files behind `file_path`, in row order."""
+    if os.path.isdir(file_path):
+        return [os.path.join(file_path, name) for name in sorted(os.listdir(file_path)) if name.endswith(".parquet")]
+    return [file_path]
 
 def load_data(file_path: str) -> pd.DataFrame:
     """
-    Load data from a CSV file into a DataFrame.
+    Load data from a CSV (optionally gzipped) or Parquet file into a DataFrame.
 
     Args:
-        file_path (str): Path to the CSV file.
+        file_path (str): Path to the CSV file, or a Parquet file or directory.
 
     Returns:
         pd.DataFrame: DataFrame containing the loaded data.
     """
-    df = pd.read_csv(file_path)
+    if is_parquet(file_path):
+        df = pd.concat([pd.read_parquet(f) for f in parquet_files(file_path)], ignore_index=True)
+    else:
+        df = pd.read_csv(file_path)
     if 'message' not in df.columns:
         raise ValueError("DataFrame must contain a 'message' column.")
     return df
 
-def get_embeddings(df: pd.DataFrame, model_name: str = "all-MiniLM-L6-v2") -> Tensor:
+def truncate_texts(
+        texts: List[str],
+        tokenizer,
+        max_tokens: int,
+        strategy: str = "head",
+        head_ratio: float = 0.25,
+) -> Tuple[List[str], List[int]]:
+    """
+    Cut every text to at most `max_tokens` tokens and report its token count.
+
+    Cuts are made on token boundaries of the original string (via the fast
+    tokenizer's offset mapping), so the kept text is unchanged. With "head_tail"
+    the first `head_ratio` of the budget comes from the start of the email and
+    the rest from its end, which keeps both the subject and the sign-off.
+
+    Args:
+        texts (List[str]): Texts to truncate.
+        tokenizer: A HuggingFace fast tokenizer.
+        max_tokens (int): Token budget per text, excluding special tokens.
+        strategy (str): "head" or "head_tail".
+        head_ratio (float): Share of the budget taken from the head for "head_tail".
+
+    Returns:
+        Tuple[List[str], List[int]]: Truncated texts and their token counts.
+    """
+    if strategy not in TRUNCATION_STRATEGIES:
+        raise ValueError(f"Unknown truncation strategy {strategy!r}, expected one of {TRUNCATION_STRATEGIES}")
+
+    encoded = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, truncation=False)
+    truncated, lengths = [], []
+    for text, offsets in zip(texts, encoded["offset_mapping"]):
+        n = len(offsets)
+        if n <= max_tokens:
+            truncated.append(text)
+            lengths.append(n)
+            continue
+        if strategy == "head":
+            truncated.append(text[:offsets[max_tokens - 1][1]])
+        else:
+            head = max(1, int(max_tokens * head_ratio))
+            tail = max_tokens - head
+            kept = text[:offsets[head - 1][1]]
+            if tail:
+                kept += " " + text[offsets[n - tail][0]:]
+            truncated.append(kept)
+        lengths.append(max_tokens)
+    return truncated, lengths
+
+
+def length_buckets(lengths: List[int], batch_size: int, max_batch_tokens: Optional[int] = None) -> List[np.ndarray]:
+    """
+    Group indices into batches of similar token length.
+
+    Indices are sorted by length and cut greedily so that a batch holds at most
+    `batch_size` texts and, if `max_batch_tokens` is set, its padded size
+    (texts × longest text) stays within that budget. Short emails therefore
+    travel in large batches and long ones in small batches.
+
+    Args:
+        lengths (List[int]): Token count of each text.
+        batch_size (int): Maximum texts per batch.
+        max_batch_tokens (int): Optional padded-token budget per batch.
+
+    Returns:
+        List[np.ndarray]: Index arrays, one per batch.
+    """
+    order = np.argsort(np.asarray(lengths), kind="stable")
+    batches, current = [], []
+    for idx in order:
+        longest = max(lengths[idx], 1)  # sorted ascending, so the newest index is the longest
+        over_budget = max_batch_tokens is not None and current and (len(current) + 1) * longest > max_batch_tokens
+        if len(current) == batch_size or over_budget:
+            batches.append(np.array(current))
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(np.array(current))
+    return batches
+
+
+def encode_bucketed(
+        model: SentenceTransformer,
+        texts: List[str],
+        batch_size: int = 32,
+        max_seq_length: Optional[int] = None,
+        truncation: str = "head",
+        max_batch_tokens: Optional[int] = None,
+        show_progress_bar: bool = False,
+) -> np.ndarray:
+    """
+    Encode texts with explicit truncation and length-bucketed batches.
+
+    Texts are truncated to `max_seq_length` tokens (capped at the model's own
+    limit), grouped by token count so batches carry little padding, encoded
+    one bucket at a time and returned in the original order.
+
+    Args:
+        model (SentenceTransformer): The encoder.
+        texts (List[str]): Texts to encode.
+        batch_size (int): Maximum texts per batch.
+        max_seq_length (int): Token limit including special tokens. Defaults to the model's.
+        truncation (str): "head" or "head_tail", see `truncate_texts`.
+        max_batch_tokens (int): Optional padded-token budget per batch.
+        show_progress_bar (bool): Print progress over buckets.
+
+    Returns:
+        np.ndarray: Embeddings of shape (len(texts), D).
+    """
+    if not texts:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    limit = model.max_seq_length
+    max_seq_length = min(max_seq_length or limit, limit)
+    # [CLS] and [SEP] take two positions
+    truncated, lengths = truncate_texts(texts, model.tokenizer, max_seq_length - 2, truncation)
+
+    embeddings = None
+    buckets = length_buckets(lengths, batch_size, max_batch_tokens)
+    for i, idx in enumerate(buckets, start=1):
+        batch = model.encode([truncated[j] for j in idx], batch_size=len(idx))
+        if embeddings is None:
+            embeddings = np.empty((len(texts), batch.shape[1]), dtype=batch.dtype)
+        embeddings[idx] = batch
+        if show_progress_bar and (i % 50 == 0 or i == len(buckets)):
+            print(f"Encoded {i}/{len(buckets)} batches")
+    return embeddings
+
+
+# Origin recorded for the embeddings this job adds to a store (see SqliteEmbeddingStore)
+STORE_ORIGIN = "embeddings.py"
+
+
+def store_key(model: SentenceTransformer, model_name: str, max_seq_length: Optional[int] = None, truncation: str = "head") -> str:
+    """
+    Identify the embedding space for store lookups: model, backend and truncation settings.
+
+    Uses the same layout as the serving cache keys in `inference.py`, so both can share a store.
+    Rows this job writes are tagged STORE_ORIGIN, and `--gc` only sweeps those,
+    so it never deletes what the serving cache put in a shared store.
+    """
+    effective = min(max_seq_length or model.max_seq_length, model.max_seq_length)
+    return f"{model_name}@torch/{effective}/{truncation}"
+
+
+def encode_with_store(
+        model: SentenceTransformer,
+        texts: List[str],
+        store: Optional[SqliteEmbeddingStore],
+        model_key: str,
+        stats: dict,
+        **encode_kwargs,
+) -> np.ndarray:
+    """
+    Encode texts, reusing embeddings already in `store` and adding the new ones.
+
+    Args:
+        model (SentenceTransformer): The encoder.
+        texts (List[str]): Texts to encode.
+        store (SqliteEmbeddingStore): Persistent store, or None to always encode.
+        model_key (str): See `store_key`.
+        stats (dict): Running 'reused' / 'computed' counters, updated in place.
+        **encode_kwargs: Passed to `encode_bucketed`.
+
+    Returns:
+        np.ndarray: Embeddings of shape (len(texts), D), in input order.
+    """
+    if store is None:
+        stats['computed'] = stats.get('computed', 0) + len(texts)
+        return encode_bucketed(model, texts, **encode_kwargs)
+
+    keys = [content_key(text, model_key) for text in texts]
+    found = store.get_many(set(keys))
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in pending:
+            pending[key] = normalize_text(text)
+    stats['reused'] = stats.get('reused', 0) + sum(key in found for key in keys)
+    stats['computed'] = stats.get('computed', 0) + len(pending)
+
+    if pending:
+        computed = encode_bucketed(model, list(pending.values()), **encode_kwargs)
+        fresh = dict(zip(pending.keys(), computed))
+        store.put_many(fresh, origin=STORE_ORIGIN)
+        found.update(fresh)
+    store.mark_live(keys)
+    return np.stack([found[key] for key in keys])
+
+
+def finish_store(store: Optional[SqliteEmbeddingStore], stats: dict, gc: bool = False, compact: bool = False) -> None:
+    """Report reuse, then optionally drop embeddings of messages that are gone and compact the store."""
+    print(f"Reused {stats.get('reused', 0)} embeddings, computed {stats.get('computed', 0)}")
+    if store is None:
+        return
+    if gc:
+        print(f"Removed {store.sweep(origin=STORE_ORIGIN)} embeddings of messages no longer in the input")
+    if compact:
+        store.compact()
+    store.close()
+
+
+def get_embeddings(
+        df: pd.DataFrame,
+        model_name: str = "all-MiniLM-L6-v2",
+        batch_size: int = 32,
+        max_seq_length: Optional[int] = None,
+        truncation: str = "head",
+        max_batch_tokens: Optional[int] = None,
+        store: Optional[SqliteEmbeddingStore] = None,
+        stats: Optional[dict] = None,
+) -> Tensor:
     """
-    Generate embeddings for the 'text' column in the DataFrame using a specified SentenceTransformer model.
+    Generate embeddings for the 'message' column in the DataFrame using a specified SentenceTransformer model.
 
     Args:
-        df (pd.DataFrame): DataFrame containing a 'text' column.
+        df (pd.DataFrame): DataFrame containing a 'message' column.
         model_name (str): Name of the SentenceTransformer model to use.
+        batch_size (int): Maximum texts per batch.
+        max_seq_length (int): Token limit per message. Defaults to the model's.
+        truncation (str): "head" or "head_tail".
+        max_batch_tokens (int): Optional padded-token budget per batch.
+        store (SqliteEmbeddingStore): Optional store of previously computed embeddings.
+        stats (dict): Optional dict that receives 'reused' / 'computed' counts.
 
     Returns:
-        pd.DataFrame: DataFrame with an additional 'embeddings' column containing the embeddings.
+        Tensor: Embeddings of shape (len(df), D), in row order.
     """
     model = SentenceTransformer(model_name)
-    embeddings = model.encode(
-        df['message'].tolist(),
+    embeddings = encode_with_store(
+        model,
+        df['message'].astype(str).tolist(),
+        store,
+        store_key(model, model_name, max_seq_length, truncation),
+        stats if stats is not None else {},
+        batch_size=batch_size,
+        max_seq_length=max_seq_length,
+        truncation=truncation,
+        max_batch_tokens=max_batch_tokens,
         show_progress_bar=True,
-        convert_to_tensor=True
     )
-    return embeddings
+    return torch.from_numpy(embeddings)
 
 def save_embeddings(embeddings: Tensor, file_path: str) -> None:
     """
@@ -48,17 +295,209 @@ def save_embeddings(embeddings: Tensor, file_path: str) -> None:
     """
     torch.save(embeddings, file_path)
 
+def manifest_path(output_file: str) -> str:
+    """Path of the progress manifest kept next to a streamed embeddings file."""
+    return output_file + ".manifest.json"
+
+
+def read_manifest(output_file: str) -> Optional[dict]:
+    """Load the progress manifest of a streamed embeddings file, if there is one."""
+    path = manifest_path(output_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(output_file: str, manifest: dict) -> None:
+    """Atomically replace the progress manifest."""
+    path = manifest_path(output_file)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def read_chunks(file_path: str, chunk_size: int, columns: Optional[List[str]] = None):
+    """
+    Yield DataFrames of up to `chunk_size` rows from a CSV (optionally gzipped) or Parquet input.
+
+    Chunks come out in the same sizes on every run over the same input, so
+    row offsets line up when `stream_embeddings` resumes.
+    """
+    if not is_parquet(file_path):
+        yield from pd.read_csv(file_path, usecols=columns, chunksize=chunk_size)
+        return
+    import pyarrow.parquet as pq
+
+    for path in parquet_files(file_path):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+
+
+def count_rows(file_path: str, chunk_size: int) -> int:
+    """Count the messages in the input without holding it in memory."""
+    if is_parquet(file_path):
+        import pyarrow.parquet as pq
+
+        # row counts are in the Parquet footers, no data needs reading
+        return sum(pq.ParquetFile(path).metadata.num_rows for path in parquet_files(file_path))
+    return sum(len(chunk) for chunk in read_chunks(file_path, chunk_size, columns=['message']))
+
+
+def input_fingerprint(file_path: str) -> str:
+    """Hash of the size and modification time of every file behind the input, to notice it changing."""
+    paths = parquet_files(file_path) if is_parquet(file_path) else [file_path]
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def stream_embeddings(
+        input_file: str,
+        output_file: str,
+        model_name: str = "all-MiniLM-L6-v2",
+        chunk_size: int = 10000,
+        dtype: str = "float32",
+        store: Optional[SqliteEmbeddingStore] = None,
+        stats: Optional[dict] = None,
+        fresh: bool = False,
+        **encode_kwargs,
+) -> np.memmap:
+    """
+    Encode a message file chunk by chunk into a memory-mapped .npy file, resuming after a crash.
+
+    Row i of the output is the embedding of row i of the input. After every chunk
+    the array is flushed and a manifest next to it records how many rows are
+    done, so a rerun with the same arguments continues from the last completed
+    chunk. Peak memory is one chunk of messages and embeddings. A resume refuses
+    to continue if the settings or the input changed in between, since rows from
+    both would end up mixed in one array.
+
+    Args:
+        input_file (str): CSV, .csv.gz or Parquet file/directory with a 'message' column.
+        output_file (str): Path of the .npy file to write.
+        model_name (str): Name of the SentenceTransformer model to use.
+        chunk_size (int): Rows read and encoded per chunk.
+        dtype (str): "float32" or "float16".
+        store (SqliteEmbeddingStore): Optional store of previously computed embeddings.
+        stats (dict): Optional dict that receives 'reused' / 'computed' counts.
+        fresh (bool): Ignore an unfinished earlier run and start over.
+        **encode_kwargs: Passed to `encode_bucketed` (batch_size, max_seq_length, ...).
+
+    Returns:
+        np.memmap: The finished embeddings, opened read-only.
+    """
+    model = SentenceTransformer(model_name)
+    stats = stats if stats is not None else {}
+    model_key = store_key(model, model_name, encode_kwargs.get('max_seq_length'), encode_kwargs.get('truncation', 'head'))
+    settings = {
+        "input_file": os.path.abspath(input_file),
+        "input_fingerprint": input_fingerprint(input_file),
+        "model_name": model_name,
+        "max_seq_length": min(encode_kwargs.get('max_seq_length') or model.max_seq_length, model.max_seq_length),
+        "truncation": encode_kwargs.get('truncation', 'head'),
+        "chunk_size": chunk_size,
+        "dtype": dtype,
+        "dim": model.get_sentence_embedding_dimension(),
+    }
+
+    manifest = None if fresh else read_manifest(output_file)
+    if manifest is not None and os.path.exists(output_file):
+        mismatched = [k for k, v in settings.items() if manifest.get(k) != v]
+        if mismatched == ["input_fingerprint"]:
+            raise ValueError(f"{input_file} changed since {output_file} was started; rerun with --fresh")
+        if mismatched:
+            raise ValueError(f"{output_file} was started with different settings ({', '.join(mismatched)}); "
+                             f"rerun with --fresh to start over")
+        out = np.load(output_file, mmap_mode="r+")
+        print(f"Resuming at row {manifest['completed_rows']}/{manifest['rows']}")
+    else:
+        rows = count_rows(input_file, chunk_size)
+        out = np.lib.format.open_memmap(output_file, mode="w+", dtype=dtype, shape=(rows, settings["dim"]))
+        manifest = dict(settings, rows=rows, completed_rows=0, completed_chunks=0, complete=False)
+        write_manifest(output_file, manifest)
+
+    end = 0
+    for i, chunk in enumerate(read_chunks(input_file, chunk_size)):
+        # Parquet chunks stop at file boundaries, so offsets are accumulated
+        start = end
+        end = start + len(chunk)
+        if 'message' not in chunk.columns:
+            raise ValueError("DataFrame must contain a 'message' column.")
+        texts = chunk['message'].astype(str).tolist()
+        if end <= manifest["completed_rows"]:
+            if store is not None:
+                store.mark_live(content_key(text, model_key) for text in texts)
+            continue
+
+        out[start:end] = encode_with_store(model, texts, store, model_key, stats, **encode_kwargs)
+        out.flush()
+        manifest.update(completed_rows=end, completed_chunks=i + 1)
+        write_manifest(output_file, manifest)
+        print(f"Encoded {end}/{manifest['rows']} messages")
+
+    manifest["complete"] = True
+    write_manifest(output_file, manifest)
+    del out
+    return np.load(output_file, mmap_mode="r")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Generate embeddings for email messages.")
-    parser.add_argument('--input_file', type=str, required=True, help='Path to the input CSV file containing email messages.')
+    parser.add_argument('--input_file', type=str, required=True, help='Messages to encode: CSV, .csv.gz, or Parquet file/directory from scripts/extract_mails.py.')
     parser.add_argument('--output_file', type=str, required=True, help='Path to save the generated embeddings.')
     parser.add_argument('--model_name', type=str, default='all-MiniLM-L6-v2', help='Name of the SentenceTransformer model to use.')
+    parser.add_argument('--batch_size', type=int, default=32, help='Maximum messages per batch.')
+    parser.add_argument('--max_seq_length', type=int, default=None, help="Token limit per message (defaults to the model's).")
+    parser.add_argument('--truncation', type=str, default='head', choices=TRUNCATION_STRATEGIES, help='Keep the start of long messages, or their start and end.')
+    parser.add_argument('--max_batch_tokens', type=int, default=None, help='Optional padded-token budget per batch.')
+    parser.add_argument('--stream', action='store_true', help='Encode in chunks into a resumable memory-mapped .npy file.')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Rows per chunk in --stream mode.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='Storage dtype in --stream mode.')
+    parser.add_argument('--fresh', action='store_true', help='In --stream mode, start over instead of resuming an unfinished run.')
+    parser.add_argument('--store', type=str, default=None, help='sqlite embedding store; only messages not already in it are encoded.')
+    parser.add_argument('--gc', action='store_true', help='Drop every embedding this job stored that this run did not use (messages no longer in the input); serving-cache entries in a shared store are kept.')
+    parser.add_argument('--compact', action='store_true', help='Reclaim free space in the store after the run.')
 
     args = parser.parse_args()
 
+    store = SqliteEmbeddingStore(args.store) if args.store else None
+    stats = {}
+
+    if args.stream:
+        stream_embeddings(
+            args.input_file,
+            args.output_file,
+            args.model_name,
+            chunk_size=args.chunk_size,
+            dtype=args.dtype,
+            store=store,
+            stats=stats,
+            fresh=args.fresh,
+            batch_size=args.batch_size,
+            max_seq_length=args.max_seq_length,
+            truncation=args.truncation,
+            max_batch_tokens=args.max_batch_tokens,
+        )
+        finish_store(store, stats, gc=args.gc, compact=args.compact)
+        return
+
     df = load_data(args.input_file)
-    embeddings = get_embeddings(df, args.model_name)
+    embeddings = get_embeddings(
+        df,
+        args.model_name,
+        batch_size=args.batch_size,
+        max_seq_length=args.max_seq_length,
+        truncation=args.truncation,
+        max_batch_tokens=args.max_batch_tokens,
+        store=store,
+        stats=stats,
+    )
     save_embeddings(embeddings, args.output_file)
+    finish_store(store, stats, gc=args.gc, compact=args.compact)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
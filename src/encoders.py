@@ -0,0 +1,202 @@
+import argparse
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from sentence_transformers import SentenceTransformer
+
+try:
+    from .head import NumpyHead
+except ImportError:  # run as a script from src/
+    from head import NumpyHead
+
+# "torch" is the original fp32 PyTorch path; the ONNX backends run through onnxruntime
+# (the `sentence-transformers[onnx]` extra in requirements.txt).
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+# Instruction set targeted by dynamic int8 quantization (arm64, avx2, avx512, avx512_vnni)
+QUANTIZATION_CONFIG = os.environ.get("ENCODER_QUANTIZATION", "avx2")
+
+
+# Path, inside an exported model directory, of the int8 ONNX graph
+QUANTIZED_FILE_SUFFIX = "int8"
+QUANTIZED_FILE_NAME = f"onnx/model_{QUANTIZED_FILE_SUFFIX}.onnx"
+
+
+def load_encoder(model_name: str, backend: str = "torch") -> SentenceTransformer:
+    """
+    Load a SentenceTransformer on the requested backend.
+
+    Args:
+        model_name (str): Hub name or local path. For "onnx-int8" this should be a
+            directory produced by `export_encoder(..., quantize=True)`.
+        backend (str): One of ENCODER_BACKENDS.
+
+    Returns:
+        SentenceTransformer: The encoder; `encode` behaves the same on every backend.
+    """
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    if backend == "onnx":
+        return SentenceTransformer(model_name, backend="onnx")
+    if backend == "onnx-int8":
+        return SentenceTransformer(
+            model_name,
+            backend="onnx",
+            model_kwargs={"file_name": QUANTIZED_FILE_NAME},
+        )
+    raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {ENCODER_BACKENDS}")
+
+
+def export_encoder(
+        model_name: str,
+        output_dir: str,
+        quantize: bool = True,
+        quantization_config: str = QUANTIZATION_CONFIG,
+) -> None:
+    """
+    Export a SentenceTransformer to ONNX, optionally with a dynamically int8-quantized copy.
+
+    The output directory is a regular SentenceTransformer model directory holding
+    the PyTorch weights and, under `onnx/`, the ONNX graphs, so it can be passed
+    as ENCODER_NAME with any backend.
+
+    Args:
+        model_name (str): Hub name or local path of the model to export.
+        output_dir (str): Directory to write the exported model to.
+        quantize (bool): Also write the int8 graph.
+        quantization_config (str): Quantization target (arm64, avx2, avx512, avx512_vnni).
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model = SentenceTransformer(model_name, backend="onnx")
+    model.save(output_dir)
+    if quantize:
+        export_dynamic_quantized_onnx_model(
+            model, quantization_config, output_dir, file_suffix=QUANTIZED_FILE_SUFFIX
+        )
+    # written last so config.json describes the transformer for both backends
+    SentenceTransformer(model_name).save(output_dir)
+    print(f"Exported {model_name} to {output_dir}")
+
+
+def measure(encoder: SentenceTransformer, texts: List[str], batch_size: int = 32, single: int = 50) -> Dict[str, object]:
+    """
+    Encode `texts` and time both batched throughput and single-text latency.
+
+    Returns:
+        Dict[str, object]: Embeddings plus throughput (texts/s) and p50/p95 latency (ms).
+    """
+    encoder.encode(texts[:batch_size], batch_size=batch_size)  # warm-up
+
+    start = time.perf_counter()
+    embeddings = encoder.encode(texts, batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for text in texts[:single]:
+        t0 = time.perf_counter()
+        encoder.encode([text])
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    return {
+        "embeddings": embeddings,
+        "throughput": len(texts) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def compare_backends(
+        texts: List[str],
+        model_name: str,
+        backends: List[str],
+        classifier=None,
+        batch_size: int = 32,
+) -> pd.DataFrame:
+    """
+    Compare encoder backends against the torch reference on the same texts.
+
+    Parity is reported as the cosine similarity between each backend's embeddings
+    and torch's, and, if a classifier is given, the fraction of texts that get
+    the same predicted label as with torch embeddings.
+
+    Args:
+        texts (List[str]): Held-out texts.
+        model_name (str): Model to load for every backend.
+        backends (List[str]): Backends to compare; "torch" is always included as the reference.
+        classifier: Optional model exposing `predict_on_batch`.
+        batch_size (int): Batch size for the throughput measurement.
+
+    Returns:
+        pd.DataFrame: One row per backend.
+    """
+    backends = ["torch"] + [b for b in backends if b != "torch"]
+    reference = None
+    rows = []
+    for backend in backends:
+        result = measure(load_encoder(model_name, backend), texts, batch_size=batch_size)
+        emb = np.asarray(result["embeddings"], dtype=np.float32)
+        emb_n = emb / np.linalg.norm(emb, axis=1, keepdims=True)
+        row = {
+            "backend": backend,
+            "throughput_texts_per_s": result["throughput"],
+            "p50_ms": result["p50_ms"],
+            "p95_ms": result["p95_ms"],
+        }
+        if classifier is not None:
+            preds = np.asarray(classifier.predict_on_batch(emb)).argmax(axis=1)
+        if reference is None:
+            reference = (emb_n, preds if classifier is not None else None)
+        cosine = (emb_n * reference[0]).sum(axis=1)
+        row["mean_cosine"] = float(cosine.mean())
+        row["min_cosine"] = float(cosine.min())
+        if classifier is not None:
+            row["label_agreement"] = float((preds == reference[1]).mean())
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and benchmark SentenceTransformer encoder backends.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="Export the encoder to ONNX (and int8).")
+    export.add_argument('--model_name', type=str, default='all-MiniLM-L6-v2', help='Name of the SentenceTransformer model to export.')
+    export.add_argument('--output_dir', type=str, required=True, help='Directory to write the exported model to.')
+    export.add_argument('--no_quantize', action='store_true', help='Skip the int8 export.')
+    export.add_argument('--quantization', type=str, default=QUANTIZATION_CONFIG, help='Quantization target: arm64, avx2, avx512 or avx512_vnni.')
+
+    compare = sub.add_parser("compare", help="Check parity and speed of backends on a held-out set.")
+    compare.add_argument('--input_file', type=str, required=True, help="CSV with a 'message' column of held-out emails.")
+    compare.add_argument('--model_name', type=str, required=True, help='Exported model directory (see `export`).')
+    compare.add_argument('--backends', nargs='+', default=list(ENCODER_BACKENDS), help='Backends to compare.')
+    compare.add_argument('--classifier', type=str, default=None, help='Optional .keras/.npz classifier for label agreement.')
+    compare.add_argument('--limit', type=int, default=2000, help='Number of messages to use.')
+    compare.add_argument('--batch_size', type=int, default=32, help='Batch size for the throughput measurement.')
+    compare.add_argument('--min_agreement', type=float, default=0.99, help='Fail if any backend agrees with torch on fewer labels.')
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_encoder(args.model_name, args.output_dir, quantize=not args.no_quantize, quantization_config=args.quantization)
+        return
+
+    texts = pd.read_csv(args.input_file)['message'].astype(str).head(args.limit).tolist()
+    classifier = None
+    if args.classifier:
+        if args.classifier.endswith(".npz"):
+            classifier = NumpyHead.load(args.classifier)
+        else:
+            from tensorflow.keras.models import load_model
+            classifier = load_model(args.classifier)
+
+    report = compare_backends(texts, args.model_name, args.backends, classifier, args.batch_size)
+    print(report.to_string(index=False))
+    if classifier is not None and (report["label_agreement"] < args.min_agreement).any():
+        raise SystemExit(f"Label agreement with torch below {args.min_agreement}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def _relu(x: np.ndarray) -> np.ndarray:
+    return np.maximum(x, 0)
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def _linear(x: np.ndarray) -> np.ndarray:
+    return x
+
+
+ACTIVATIONS = {
+    "relu": _relu,
+    "softmax": _softmax,
+    "linear": _linear,
+}
+
+# Layers that are the identity at inference time
+PASSTHROUGH_LAYERS = {"Dropout", "InputLayer"}
+# Label names of a head's output columns live next to it, e.g. model.keras.classes.json
+CLASSES_SUFFIX = ".classes.json"
+
+
+def save_classes(model_path: str, classes: Sequence[str]) -> None:
+    """Record the label of each output column of the head at `model_path`."""
+    with open(model_path + CLASSES_SUFFIX, "w") as f:
+        json.dump([str(c) for c in classes], f)
+
+
+def load_classes(model_path: str) -> Optional[List[str]]:
+    """Labels of the head's output columns, or None for heads saved without them."""
+    if not os.path.exists(model_path + CLASSES_SUFFIX):
+        return None
+    with open(model_path + CLASSES_SUFFIX) as f:
+        return json.load(f)
+
+
+class NumpyHead:
+    """
+    NumPy forward pass for the Dense classifier head built by `train.build_model`.
+
+    Holds one (kernel, bias, activation) triple per Dense layer and mirrors the
+    parts of the Keras model API that inference uses, so it can stand in for
+    the Keras model without importing TensorFlow.
+    """
+
+    def __init__(self, layers: List[Tuple[np.ndarray, np.ndarray, str]]):
+        for _, _, activation in layers:
+            if activation not in ACTIVATIONS:
+                raise ValueError(f"Unsupported activation: {activation}")
+        self.layers = layers
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyHead":
+        """
+        Load a head exported with `export_keras_head`.
+
+        Args:
+            path (str): Path to the .npz file.
+
+        Returns:
+            NumpyHead: The loaded head.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            num_layers = int(data["num_layers"])
+            layers = [
+                (data[f"kernel_{i}"], data[f"bias_{i}"], str(data[f"activation_{i}"]))
+                for i in range(num_layers)
+            ]
+        return cls(layers)
+
+    def predict_on_batch(self, x: np.ndarray) -> np.ndarray:
+        """
+        Run the forward pass.
+
+        Args:
+            x (np.ndarray): Embeddings of shape (N, D).
+
+        Returns:
+            np.ndarray: Class probabilities of shape (N, num_classes).
+        """
+        h = np.asarray(x, dtype=np.float32)
+        for kernel, bias, activation in self.layers:
+            h = ACTIVATIONS[activation](h @ kernel + bias)
+        return h
+
+    def predict(self, x: np.ndarray, **kwargs) -> np.ndarray:
+        """Keras-compatible alias of `predict_on_batch`; extra arguments are ignored."""
+        return self.predict_on_batch(x)
+
+
+def export_keras_head(model, output_path: str) -> NumpyHead:
+    """
+    Dump the Dense layers of a trained Keras model to a compact .npz file.
+
+    Args:
+        model: A Keras Sequential model made of Dense, Dropout and Input layers.
+        output_path (str): Where to write the .npz file.
+
+    Returns:
+        NumpyHead: The exported head, for parity checks.
+    """
+    layers = []
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind in PASSTHROUGH_LAYERS:
+            continue
+        if kind != "Dense":
+            raise ValueError(f"Cannot export layer {layer.name} of type {kind}")
+        kernel, bias = layer.get_weights()
+        activation = layer.get_config()["activation"]
+        if isinstance(activation, dict):
+            activation = activation.get("config", {}).get("name", activation.get("class_name"))
+        layers.append((kernel.astype(np.float32), bias.astype(np.float32), str(activation)))
+
+    head = NumpyHead(layers)
+    arrays = {"num_layers": np.array(len(layers))}
+    for i, (kernel, bias, activation) in enumerate(layers):
+        arrays[f"kernel_{i}"] = kernel
+        arrays[f"bias_{i}"] = bias
+        arrays[f"activation_{i}"] = np.array(activation)
+    np.savez(output_path, **arrays)
+    return head
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a trained Keras classifier head to NumPy weights.")
+    parser.add_argument('--model_path', type=str, required=True, help='Path to the trained .keras model.')
+    parser.add_argument('--output_file', type=str, required=True, help='Path to write the .npz weights.')
+    parser.add_argument('--check_samples', type=int, default=1000, help='Random inputs used to check parity with Keras (0 to skip).')
+
+    args = parser.parse_args()
+
+    from tensorflow.keras.models import load_model
+
+    model = load_model(args.model_path)
+    head = export_keras_head(model, args.output_file)
+    classes = load_classes(args.model_path)
+    if classes is not None:
+        save_classes(args.output_file, classes)
+    print(f"Exported {len(head.layers)} Dense layers to {args.output_file}")
+
+    if args.check_samples:
+        rng = np.random.default_rng(42)
+        x = rng.standard_normal((args.check_samples, model.input_shape[-1])).astype(np.float32)
+        x /= np.linalg.norm(x, axis=1, keepdims=True)  # SBERT embeddings are unit length
+        expected = np.asarray(model.predict_on_batch(x))
+        actual = head.predict_on_batch(x)
+        max_diff = float(np.abs(expected - actual).max())
+        agreement = float((expected.argmax(axis=1) == actual.argmax(axis=1)).mean())
+        print(f"Parity on {args.check_samples} inputs: max abs diff {max_diff:.2e}, argmax agreement {agreement:.4f}")
+        if max_diff > 1e-4:
+            raise SystemExit("NumPy head does not match the Keras model")
+
+
+if __name__ == "__main__":
+    main()
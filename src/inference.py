@@ -1,27 +1,325 @@
 import torch
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from tensorflow.keras.models import load_model
 import os
+import sys
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+from .encoders import load_encoder
+from .embeddings import encode_bucketed
+from .cache import EmbeddingCache, SqliteEmbeddingStore, content_key, normalize_text
+from .head import NumpyHead, load_classes
+from .cascade import Cascade, HashedLinearModel
+from .prototypes import PrototypeMatrix, load_prototype_matrix
+
 MODEL_PATH = os.environ["MODEL_PATH"]
+ENCODER_NAME = os.environ.get("ENCODER_NAME", "all-MiniLM-L6-v2")
+# torch, onnx or onnx-int8 (see encoders.py)
+ENCODER_BACKEND = os.environ.get("ENCODER_BACKEND", "torch")
+WARMUP_TEXT = "Warm-up request for the email classifier."
+# Token limit per email (capped at the encoder's own limit) and which part of long emails to keep
+MAX_SEQ_LENGTH = int(os.environ.get("MAX_SEQ_LENGTH", "256"))
+TRUNCATION = os.environ.get("TRUNCATION", "head")
+# Optional padded-token budget per forward pass; long emails in a batch are then split off
+MAX_BATCH_TOKENS = int(os.environ["MAX_BATCH_TOKENS"]) if os.environ.get("MAX_BATCH_TOKENS") else None
+# Embeddings kept in memory; 0 disables the in-memory tier
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000"))
+# Optional sqlite file that persists embeddings across restarts
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH")
+# Worker threads that run batches concurrently (see batching.MicroBatcher)
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+# Intra-op threads per worker; by default the cores are split evenly between workers
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)))
+# Optional first stage (see cascade.py); emails it is confident about skip the encoder and the head
+CASCADE_MODEL_PATH = os.environ.get("CASCADE_MODEL_PATH")
+CASCADE_THRESHOLD = float(os.environ.get("CASCADE_THRESHOLD", "0.9"))
+CASCADE_MIN_MARGIN = float(os.environ.get("CASCADE_MIN_MARGIN", "0"))
+# Fraction of short-circuited emails also sent down the full path to measure the accuracy cost
+CASCADE_SHADOW_RATE = float(os.environ.get("CASCADE_SHADOW_RATE", "0.02"))
+
+
+class PrototypesNotLoadedError(Exception):
+    """Raised by `explain_batch` when the prototype matrix is unavailable."""
+
+
+def configure_threads(num_threads: int) -> None:
+    """
+    Size the torch and (if it is loaded) TensorFlow intra-op thread pools.
+
+    With several inference workers each running its own forward pass, letting
+    every framework grab all cores oversubscribes the CPU. TensorFlow only
+    accepts this before its runtime starts, so it is applied right after the
+    import in `load_classifier`.
+
+    Args:
+        num_threads (int): Threads each forward pass may use.
+    """
+    torch.set_num_threads(num_threads)
+    if "tensorflow" in sys.modules:
+        import tensorflow as tf
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError:
+            # the TensorFlow runtime is already running, e.g. on a reload
+            pass
+
+
+configure_threads(INFERENCE_THREADS)
+
+
+def load_classifier(model_path: str):
+    """
+    Load the classifier head.
+
+    `.npz` files exported by `head.py` run on NumPy alone; anything else is
+    treated as a Keras model, which pulls in TensorFlow.
+
+    Args:
+        model_path (str): Path to a `.npz` export or a `.keras` model.
+
+    Returns:
+        A model exposing `predict_on_batch`.
+    """
+    if model_path.endswith(".npz"):
+        return NumpyHead.load(model_path)
+
+    from tensorflow.keras.models import load_model
+    configure_threads(INFERENCE_THREADS)
+    return load_model(model_path)
+
+
+class LoadedModels(NamedTuple):
+    encoder: SentenceTransformer
+    classifier: object
+    encoder_name: str
+    encoder_backend: str
+    model_path: str
+    fast: Optional[HashedLinearModel] = None
+    prototypes: Optional[PrototypeMatrix] = None
+
+    @property
+    def encoder_key(self) -> str:
+        """Identifies the embedding space, for cache keys."""
+        return f"{self.encoder_name}@{self.encoder_backend}"
+
+
+def check_cascade_classes(fast: HashedLinearModel, cascade_path: str, model_path: str, num_classes: int) -> None:
+    """
+    Refuse a first stage whose columns do not mean the same labels as the head's.
+
+    Both are trained on label-encoded data, so the columns line up only if the
+    label names match in order; heads saved before their classes were recorded
+    can only be checked by count.
+    """
+    head_classes = load_classes(model_path)
+    if head_classes is None:
+        print(f"Classifier {model_path} does not record its classes; checking the cascade by count only", flush=True)
+        if fast.num_classes != num_classes:
+            raise ValueError(
+                f"Cascade model {cascade_path} has {fast.num_classes} classes, the classifier has {num_classes}"
+            )
+    elif fast.classes != head_classes:
+        raise ValueError(
+            f"Cascade model {cascade_path} predicts {fast.classes}, the classifier predicts {head_classes}"
+        )
+
+
+class ModelRegistry:
+    """
+    Process-wide holder for the SentenceTransformer encoder and the classifier head.
+
+    Both models are loaded once and kept behind a single reference, so a reload
+    swaps the pair atomically: requests already in flight finish on the old
+    models while new requests pick up the new ones. A failed load leaves the
+    current models in place and records the error in `load_error`.
+    """
+
+    def __init__(
+            self,
+            model_path: str = MODEL_PATH,
+            encoder_name: str = ENCODER_NAME,
+            encoder_backend: str = ENCODER_BACKEND,
+            cascade_path: Optional[str] = CASCADE_MODEL_PATH,
+    ):
+        self.model_path = model_path
+        self.encoder_name = encoder_name
+        self.encoder_backend = encoder_backend
+        self.cascade_path = cascade_path
+        self._models: Optional[LoadedModels] = None
+        self._load_lock = threading.RLock()
+        # why the last load failed, or None once a load succeeds
+        self.load_error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        """True once both models are loaded and warmed up."""
+        return self._models is not None
+
+    def load(
+            self,
+            model_path: Optional[str] = None,
+            encoder_name: Optional[str] = None,
+            encoder_backend: Optional[str] = None,
+            cascade_path: Optional[str] = None,
+    ) -> None:
+        """
+        Load the encoder and classifier, run a warm-up prediction and swap them in.
+
+        Args:
+            model_path (str): Path to the classifier (.keras or .npz). Defaults to the current one.
+            encoder_name (str): SentenceTransformer model name. Defaults to the current one.
+            encoder_backend (str): Encoder backend. Defaults to the current one.
+            cascade_path (str): First stage of the cascade. Defaults to the current one; "" disables it.
+        """
+        model_path = model_path or self.model_path
+        encoder_name = encoder_name or self.encoder_name
+        encoder_backend = encoder_backend or self.encoder_backend
+        cascade_path = (self.cascade_path if cascade_path is None else cascade_path) or None
 
-model = load_model(MODEL_PATH)
+        with self._load_lock:
+            try:
+                models = self._build(model_path, encoder_name, encoder_backend, cascade_path)
+            except Exception as e:
+                # kept for /ready; the models already loaded, if any, keep serving
+                self.load_error = f"{type(e).__name__}: {e}"
+                print(f"Loading classifier {model_path} with encoder {encoder_name} failed: {self.load_error}",
+                      flush=True)
+                raise
+            self._models = models
+            self.model_path = model_path
+            self.encoder_name = encoder_name
+            self.encoder_backend = encoder_backend
+            self.cascade_path = cascade_path
+            self.load_error = None
+            # the short-circuit and disagreement rates describe the models they were measured on
+            cascade.reset()
+        print(f"Loaded encoder {encoder_name} ({encoder_backend}) and classifier {model_path}", flush=True)
 
-def get_embeddings(text: str) -> torch.Tensor:
+    @staticmethod
+    def _build(model_path: str, encoder_name: str, encoder_backend: str,
+               cascade_path: Optional[str]) -> LoadedModels:
+        encoder = load_encoder(encoder_name, encoder_backend)
+        classifier = load_classifier(model_path)
+
+        # the first forward pass builds kernels and caches; pay for it here
+        warmup = encoder.encode([WARMUP_TEXT])
+        num_classes = np.asarray(classifier.predict_on_batch(warmup)).shape[1]
+
+        fast = None
+        if cascade_path:
+            fast = HashedLinearModel.load(cascade_path)
+            check_cascade_classes(fast, cascade_path, model_path, num_classes)
+
+        try:
+            # built with this encoder only the first time the phrases or the model change
+            prototypes = load_prototype_matrix(model_name=encoder_name, encoder=encoder, backend=encoder_backend)
+        except (OSError, ValueError) as e:
+            print(f"Prototype explanations disabled: {e}", flush=True)
+            prototypes = None
+
+        return LoadedModels(encoder, classifier, encoder_name, encoder_backend, model_path, fast, prototypes)
+
+    def get(self) -> LoadedModels:
+        """
+        Return the current encoder and classifier, loading them on first use.
+        """
+        models = self._models
+        if models is None:
+            with self._load_lock:
+                if self._models is None:
+                    self.load()
+                models = self._models
+        return models
+
+
+cascade = Cascade(CASCADE_THRESHOLD, CASCADE_MIN_MARGIN, CASCADE_SHADOW_RATE)
+registry = ModelRegistry()
+cache = EmbeddingCache(
+    max_entries=EMBEDDING_CACHE_SIZE,
+    store=SqliteEmbeddingStore(EMBEDDING_CACHE_PATH) if EMBEDDING_CACHE_PATH else None,
+)
+
+
+def encode(texts: List[str], sentence_model: SentenceTransformer, model_key: str) -> np.ndarray:
+    """
+    Embed texts, reusing cached embeddings and encoding only unseen texts in one batch.
+
+    Args:
+        texts (List[str]): The input texts.
+        sentence_model (SentenceTransformer): Encoder used for cache misses.
+        model_key (str): Identifies the encoder, backend and truncation; part of the cache key.
+
+    Returns:
+        np.ndarray: Embeddings of shape (len(texts), D).
+    """
+    keys = [content_key(text, model_key) for text in texts]
+    found = cache.get_many(set(keys))
+
+    # duplicates within the batch are encoded once
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in pending:
+            pending[key] = normalize_text(text)
+    if pending:
+        computed = encode_bucketed(
+            sentence_model,
+            list(pending.values()),
+            batch_size=len(pending),
+            max_seq_length=MAX_SEQ_LENGTH,
+            truncation=TRUNCATION,
+            max_batch_tokens=MAX_BATCH_TOKENS,
+        )
+        fresh = dict(zip(pending.keys(), computed))
+        cache.put_many(fresh)
+        found.update(fresh)
+
+    return np.stack([found[key] for key in keys])
+
+
+def get_embeddings(text: str, sentence_model: Optional[SentenceTransformer] = None) -> torch.Tensor:
     """
     Generate embeddings for a given text using a pre-trained SentenceTransformer model.
 
     Args:
         text (str): The input text to generate embeddings for.
+        sentence_model (SentenceTransformer): Encoder to use. Defaults to the registry's.
 
     Returns:
         torch.Tensor: The generated embeddings.
     """
-    sentence_model = SentenceTransformer("all-MiniLM-L6-v2")
+    if sentence_model is None:
+        sentence_model = registry.get().encoder
     embedding = sentence_model.encode(text)
     embedding = embedding.reshape(1, -1)
     return embedding
 
+def full_proba(texts: List[str], models: LoadedModels) -> np.ndarray:
+    """
+    Classify a batch of texts with one encode call and one classifier forward pass.
+    """
+    embeddings = encode(texts, models.encoder, f"{models.encoder_key}/{MAX_SEQ_LENGTH}/{TRUNCATION}")
+    return np.asarray(models.classifier.predict_on_batch(embeddings))
+
+def predict_proba(texts: List[str]) -> np.ndarray:
+    """
+    Classify a batch of texts.
+
+    With a cascade model loaded, texts the first stage is confident about are
+    answered by it and only the rest are encoded and run through the head.
+
+    Args:
+        texts (List[str]): The input texts to classify.
+
+    Returns:
+        np.ndarray: Class probabilities of shape (len(texts), num_classes).
+    """
+    models = registry.get()
+    if models.fast is None:
+        return full_proba(texts, models)
+    return cascade.predict_proba(texts, models.fast, lambda rest: full_proba(rest, models))
+
 def predict(text: str) -> int:
     """
     Predict the label for the given text using a pre-trained model.
@@ -32,8 +330,37 @@ def predict(text: str) -> int:
     Returns:
         str: The predicted label.
     """
-    embedding = get_embeddings(text)
-    prediction = model.predict(embedding)
+    prediction = predict_proba([text])
     pred_idx = int(np.argmax(prediction[0]))  # → 3
 
-    return pred_idx
\ No newline at end of file
+    return pred_idx
+
+def explain_batch(texts: List[str]) -> List[Dict[str, float]]:
+    """
+    Cosine similarity of each text to each label's prototype phrases.
+
+    Costs the (usually cached) embeddings of the texts plus one product with
+    the precomputed prototype matrix.
+
+    Args:
+        texts (List[str]): The input texts.
+
+    Returns:
+        List[Dict[str, float]]: Per text, the similarity per prototype label, highest first.
+
+    Raises:
+        PrototypesNotLoadedError: If the prototype matrix could not be built.
+    """
+    models = registry.get()
+    if models.prototypes is None:
+        raise PrototypesNotLoadedError("No prototype matrix is loaded")
+    embeddings = encode(texts, models.encoder, f"{models.encoder_key}/{MAX_SEQ_LENGTH}/{TRUNCATION}")
+    names = models.prototypes.names
+    return [
+        {names[i]: float(row[i]) for i in np.argsort(-row)}
+        for row in models.prototypes.scores(embeddings)
+    ]
+
+def explain(text: str) -> Dict[str, float]:
+    """Similarity of one text to each prototype label, highest first; see `explain_batch`."""
+    return explain_batch([text])[0]
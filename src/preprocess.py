@@ -1,90 +1,93 @@
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer, util
 import torch
-import yaml
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 import argparse
+import json
 
-def load_embeddings(file_path: str = "../data/processed/email_embeddings.pt") -> torch.Tensor:
+try:
+    from .embeddings import load_data
+    from .prototypes import load_prototype_matrix
+except ImportError:  # run as a script from src/
+    from embeddings import load_data
+    from prototypes import load_prototype_matrix
+
+def load_embeddings(file_path: str = "../data/processed/email_embeddings.pt") -> Union[torch.Tensor, np.ndarray]:
     """
     Load embeddings from a file.
 
+    `.npy` files written by `embeddings.py --stream` are memory-mapped rather
+    than read, so only the rows that are touched get paged in.
+
     Args:
         file_path (str): Path to the file containing embeddings.
 
     Returns:
-        torch.Tensor: Loaded embeddings.
+        Union[torch.Tensor, np.ndarray]: Loaded embeddings.
     """
+    if file_path.endswith(".npy"):
+        manifest_file = file_path + ".manifest.json"
+        if Path(manifest_file).exists() and not json.loads(Path(manifest_file).read_text()).get("complete"):
+            raise ValueError(f"{file_path} is only partially written; rerun embeddings.py --stream to finish it")
+        return np.load(file_path, mmap_mode="r")
     return torch.load(file_path)
 
 
-def load_raw_prototypes(
-        path: str = "config/prototypes.yaml"
-) -> Dict[str, List[str]]:
-    """
-    Load label→example‑texts mapping from a YAML or JSON file.
-    """
-    p = Path(path)
-    if not p.exists():
-        raise FileNotFoundError(f"Could not find prototypes file at {path}")
-    if p.suffix in {".yaml", ".yml"}:
-        return yaml.safe_load(p.read_text())
-    elif p.suffix == ".json":
-        import json
-        return json.loads(p.read_text())
-    else:
-        raise ValueError("Unsupported format: use .yaml/.yml or .json")
-
-
-def build_prototypes(
-        raw_prototypes: Dict[str, List[str]],
-        model_name: str = "all-MiniLM-L6-v2",
-) -> Dict[str, torch.Tensor]:
-    """
-    Given a dict of label→example texts, compute the mean SBERT embedding
-    for each label.
-    """
-    model: SentenceTransformer = SentenceTransformer(model_name)
-    return {
-        label: torch.tensor(np.mean(
-            model.encode(texts, convert_to_tensor=False), axis=0
-        ))
-        for label, texts in raw_prototypes.items()
-    }
-
-
 def label_embeddings(
         embeddings: Union[torch.Tensor, np.ndarray],
         prototypes: Dict[str, torch.Tensor],
-        threshold: float = 0.4
-) -> List[str]:
+        threshold: float = 0.4,
+        chunk_size: int = 65536,
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
     """
     For each embedding in `embeddings`, compute its cosine similarity
     to each prototype and pick the best label (or 'other' if below threshold).
+
+    Similarities come from one matrix product of the L2-normalized embeddings
+    against the stacked prototype matrix, `chunk_size` rows at a time so memory
+    stays bounded on large mailboxes.
+
+    Returns:
+        labels: best label per embedding, or 'other'.
+        scores: (N, L) cosine similarities, columns in `prototypes` order.
+        margin: best minus second-best similarity per embedding.
     """
-    # ensure embeddings is a Tensor
-    embs = embeddings if isinstance(embeddings, torch.Tensor) else torch.tensor(embeddings)
-
-    labels = []
-    for emb in embs:
-        # compute all sims for this one embedding
-        scores = {
-            label: util.cos_sim(emb, proto).item()
-            for label, proto in prototypes.items()
-        }
-        best_label, best_score = max(scores.items(), key=lambda kv: kv[1])
-        labels.append(best_label if best_score > threshold else "other")
-    return labels
-
-
-def label_data(df: pd.DataFrame, embeddings: torch.Tensor) -> pd.DataFrame:
-    raw_prototypes = load_raw_prototypes()
-    prototypes = build_prototypes(raw_prototypes)
-    labels = label_embeddings(embeddings, prototypes, threshold=0.4)
+    names = list(prototypes.keys())
+    protos = torch.stack([torch.as_tensor(prototypes[name]) for name in names]).float()
+    protos = torch.nn.functional.normalize(protos, p=2, dim=1)
+
+    scores = np.empty((len(embeddings), len(names)), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = embeddings[start:start + chunk_size]
+        # copy one chunk at a time so memory-mapped inputs are never read in full
+        chunk = chunk.float() if isinstance(chunk, torch.Tensor) else torch.tensor(np.asarray(chunk, dtype=np.float32))
+        chunk = torch.nn.functional.normalize(chunk, p=2, dim=1)
+        scores[start:start + chunk_size] = (chunk @ protos.T).cpu().numpy()
+
+    # argmax keeps the first label on ties, like max() over the prototype dict did
+    best = scores.argmax(axis=1)
+    best_scores = scores[np.arange(len(scores)), best]
+    if len(names) > 1:
+        runner_up = np.partition(scores, -2, axis=1)[:, -2]
+    else:
+        runner_up = np.zeros(len(scores), dtype=np.float32)
+    margin = best_scores - runner_up
+
+    labels = [names[i] if score > threshold else "other" for i, score in zip(best, best_scores)]
+    return labels, scores, margin
+
+
+def label_data(df: pd.DataFrame, embeddings: torch.Tensor, model_name: str = "all-MiniLM-L6-v2",
+               encoder_backend: str = "torch") -> pd.DataFrame:
+    # encoded once per prototypes file, model and backend, then read from the cache
+    prototypes = load_prototype_matrix(model_name=model_name, backend=encoder_backend).as_dict()
+    labels, scores, margin = label_embeddings(embeddings, prototypes, threshold=0.4)
 
     df['label'] = labels
+    # keep the evidence so weak labels can be filtered downstream
+    df['label_score'] = scores.max(axis=1)
+    df['label_margin'] = margin
     return df
 
 
@@ -102,7 +105,9 @@ def preprocess_data(df: pd.DataFrame, embeddings: torch.Tensor) -> pd.DataFrame:
     if 'message' not in df.columns:
         raise ValueError("DataFrame must contain a 'message' column.")
 
-    df['emb'] = embeddings.tolist() if isinstance(embeddings, torch.Tensor) else embeddings
+    # keep a row pointer into `embeddings` instead of boxing every vector into a list;
+    # save_preprocessed_data gathers the selected rows into a contiguous column
+    df['emb_row'] = np.arange(len(df))
 
     selected = ['academics', 'talks', 'internship', 'club', 'other']
     new_df = df[df['label'].isin(selected)].copy()
@@ -124,40 +129,87 @@ def preprocess_data(df: pd.DataFrame, embeddings: torch.Tensor) -> pd.DataFrame:
         .sample(frac=1, random_state=42) \
         .reset_index(drop=True)
 
+    if isinstance(embeddings, np.memmap):
+        downsamp_df.attrs['embeddings_file'] = embeddings.filename
+
     return downsamp_df
 
-def save_preprocessed_data(df: pd.DataFrame, file_path: str = "../data/processed/processed_data.pkl") -> None:
+def gather_embeddings(embeddings: Union[torch.Tensor, np.ndarray], rows: np.ndarray) -> np.ndarray:
+    """Contiguous float32 matrix of the selected embedding rows."""
+    if isinstance(embeddings, torch.Tensor):
+        embeddings = embeddings.cpu().numpy()
+    return np.ascontiguousarray(embeddings[rows], dtype=np.float32)
+
+
+def save_preprocessed_data(
+        df: pd.DataFrame,
+        file_path: str = "../data/processed/processed_data.parquet",
+        embeddings: Union[torch.Tensor, np.ndarray, None] = None,
+) -> None:
     """
-    Save the preprocessed DataFrame to a CSV file.
+    Save the preprocessed DataFrame.
+
+    `.parquet` output stores the embeddings as a fixed-size float32 list column
+    'emb', which loads back into NumPy without copying (see
+    `train.load_processed_data`). Embeddings that live in a memory-mapped file
+    are not copied; the 'emb_row' pointers and the file path are kept instead.
+    Any other suffix falls back to the legacy pickle with an 'emb' column of lists.
 
     Args:
-        df (pd.DataFrame): DataFrame to save.
+        df (pd.DataFrame): DataFrame to save, with 'emb_row' pointers into `embeddings`.
         file_path (str): Path to save the preprocessed DataFrame.
+        embeddings (Union[torch.Tensor, np.ndarray]): Embeddings 'emb_row' points into.
     """
-    df.to_pickle(file_path)
+    df = df.copy()
+    emb = None
+    if embeddings is not None and not isinstance(embeddings, np.memmap):
+        emb = gather_embeddings(embeddings, df['emb_row'].to_numpy())
+        df = df.drop(columns=['emb_row'])
+
+    if not file_path.endswith(".parquet"):
+        if emb is not None:
+            df['emb'] = list(emb)
+        df.to_pickle(file_path)
+        print(f"Preprocessed data saved to {file_path}")
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if emb is not None:
+        values = pa.array(emb.reshape(-1), type=pa.float32())
+        table = table.append_column('emb', pa.FixedSizeListArray.from_arrays(values, emb.shape[1]))
+    metadata = dict(table.schema.metadata or {})
+    if 'embeddings_file' in df.attrs:
+        metadata[b'embeddings_file'] = df.attrs['embeddings_file'].encode()
+    pq.write_table(table.replace_schema_metadata(metadata), file_path)
     print(f"Preprocessed data saved to {file_path}")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Preprocess email data and generate labels.")
-    parser.add_argument('--input_file', type=str, required=True, help='Path to the input CSV file containing email messages.')
-    parser.add_argument('--output_file', type=str, default='../data/processed/processed_data.pkl', help='Path to save the preprocessed data.')
+    parser.add_argument('--input_file', type=str, required=True, help='Messages embeddings.py encoded: CSV, .csv.gz, or Parquet file/directory.')
+    parser.add_argument('--output_file', type=str, default='../data/processed/processed_data.parquet', help='Path to save the preprocessed data (.parquet, or .pkl for the legacy format).')
+    parser.add_argument('--embeddings_file', type=str, default='../data/processed/email_embeddings.pt', help='Embeddings from embeddings.py (.pt, or .npy from --stream).')
+    parser.add_argument('--model_name', type=str, default='all-MiniLM-L6-v2', help='SentenceTransformer the embeddings were made with; prototypes are encoded with it.')
+    parser.add_argument('--encoder_backend', type=str, default='torch', help='Backend the embeddings were made on (torch, onnx or onnx-int8).')
 
     args = parser.parse_args()
 
     # Load the raw data
-    df = pd.read_csv(args.input_file)
+    df = load_data(args.input_file)
 
     # Load embeddings
-    embeddings = load_embeddings()
+    embeddings = load_embeddings(args.embeddings_file)
 
-    labeled_df = label_data(df, embeddings)
+    labeled_df = label_data(df, embeddings, args.model_name, args.encoder_backend)
     processed_data = preprocess_data(labeled_df, embeddings)
 
     print(processed_data.groupby('label').size())
 
     # Save the preprocessed and labeled data
-    save_preprocessed_data(processed_data, args.output_file)
+    save_preprocessed_data(processed_data, args.output_file, embeddings)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
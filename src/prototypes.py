@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import yaml
+
+# Label -> example phrases used for weak labeling and for explanations at serve time
+PROTOTYPES_PATH = os.environ.get(
+    "PROTOTYPES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "prototypes.yaml")
+)
+# Encoded prototype matrices, one file per (prototypes file content, model name, encoder backend)
+PROTOTYPE_CACHE_DIR = os.environ.get(
+    "PROTOTYPE_CACHE_DIR", os.path.join(os.path.dirname(PROTOTYPES_PATH), ".prototype_cache")
+)
+
+
+def parse_prototypes(raw: bytes, suffix: str) -> Dict[str, List[str]]:
+    """Label -> example texts from the bytes of a .yaml/.yml or .json file."""
+    if suffix in {".yaml", ".yml"}:
+        return yaml.safe_load(raw)
+    elif suffix == ".json":
+        return json.loads(raw)
+    else:
+        raise ValueError("Unsupported format: use .yaml/.yml or .json")
+
+
+def cache_key(raw: bytes, model_name: str, backend: str = "torch") -> str:
+    """Hash of the prototypes file content and the encoder, on its backend, that embeds it."""
+    return hashlib.sha256(model_name.encode("utf-8") + b"\0" + backend.encode("utf-8") + b"\0" + raw).hexdigest()
+
+
+class PrototypeMatrix:
+    """
+    Mean embedding of each label's example phrases, stacked and L2-normalized.
+
+    Cosine similarity against every label is then a single matrix product
+    with the normalized embeddings, which is cheap enough to run per request.
+    """
+
+    def __init__(self, names: List[str], matrix: np.ndarray, key: str = ""):
+        self.names = list(names)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.key = key
+
+    @classmethod
+    def from_embeddings(cls, names: List[str], means: np.ndarray, key: str = "") -> "PrototypeMatrix":
+        means = np.asarray(means, dtype=np.float32)
+        norms = np.linalg.norm(means, axis=1, keepdims=True)
+        return cls(names, means / np.maximum(norms, 1e-12), key)
+
+    def scores(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            embeddings (np.ndarray): Embeddings of shape (N, D), normalized or not.
+
+        Returns:
+            np.ndarray: (N, L) cosine similarities, columns in `names` order.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return (embeddings / np.maximum(norms, 1e-12)) @ self.matrix.T
+
+    def as_dict(self) -> Dict[str, np.ndarray]:
+        """Label -> unit prototype vector, the form `preprocess.label_embeddings` takes."""
+        return dict(zip(self.names, self.matrix))
+
+    def save(self, path: str) -> None:
+        # written to a temporary file first, so a concurrent reader never sees half a matrix
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, names=np.array(self.names), matrix=self.matrix, key=np.array(self.key))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PrototypeMatrix":
+        with np.load(path, allow_pickle=False) as data:
+            return cls([str(name) for name in data["names"]], data["matrix"], str(data["key"]))
+
+
+def load_prototype_matrix(
+        path: str = PROTOTYPES_PATH,
+        model_name: str = "all-MiniLM-L6-v2",
+        cache_dir: Optional[str] = PROTOTYPE_CACHE_DIR,
+        encoder=None,
+        backend: str = "torch",
+) -> PrototypeMatrix:
+    """
+    Load the prototype matrix for `path` and `model_name`, encoding it only on a cache miss.
+
+    The cache file is named after the backend and a hash of the prototypes file
+    content, model name and backend, so editing the phrases or switching
+    encoders builds a new matrix while unchanged inputs cost one file read.
+    An int8 ONNX encoder embeds slightly differently from the fp32 one, so each
+    backend gets its own matrix.
+
+    Args:
+        path (str): Prototypes file (.yaml/.yml or .json).
+        model_name (str): SentenceTransformer the matrix belongs to.
+        cache_dir (str): Where matrices are kept; None always rebuilds.
+        encoder: Already loaded encoder for `model_name` on `backend`; one is loaded on a miss otherwise.
+        backend (str): Encoder backend (see encoders.ENCODER_BACKENDS).
+
+    Returns:
+        PrototypeMatrix: The normalized prototype matrix.
+    """
+    p = Path(path)
+    if not p.exists():
+        raise FileNotFoundError(f"Could not find prototypes file at {path}")
+    raw = p.read_bytes()
+    key = cache_key(raw, model_name, backend)
+    cache_file = os.path.join(cache_dir, f"prototypes-{backend}-{key[:16]}.npz") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        cached = PrototypeMatrix.load(cache_file)
+        if cached.key == key:
+            return cached
+
+    raw_prototypes = parse_prototypes(raw, p.suffix)
+    if encoder is None:
+        try:
+            from .encoders import load_encoder
+        except ImportError:  # run as a script from src/
+            from encoders import load_encoder
+        encoder = load_encoder(model_name, backend)
+    names = list(raw_prototypes.keys())
+    phrases = [text for name in names for text in raw_prototypes[name]]
+    # every phrase in one encode call, then averaged per label
+    encoded = np.asarray(encoder.encode(phrases, convert_to_tensor=False), dtype=np.float32)
+    bounds = np.cumsum([0] + [len(raw_prototypes[name]) for name in names])
+    means = np.stack([encoded[start:end].mean(axis=0) for start, end in zip(bounds[:-1], bounds[1:])])
+
+    matrix = PrototypeMatrix.from_embeddings(names, means, key)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        matrix.save(cache_file)
+    return matrix
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the cached prototype matrix ahead of time.")
+    parser.add_argument("--prototypes", default=PROTOTYPES_PATH, help="Prototypes file (.yaml or .json)")
+    parser.add_argument("--model_name", default="all-MiniLM-L6-v2", help="SentenceTransformer model name")
+    parser.add_argument("--encoder_backend", default="torch", help="Encoder backend: torch, onnx or onnx-int8")
+    parser.add_argument("--cache_dir", default=PROTOTYPE_CACHE_DIR, help="Where to store the matrix")
+    args = parser.parse_args()
+
+    matrix = load_prototype_matrix(args.prototypes, args.model_name, args.cache_dir, backend=args.encoder_backend)
+    print(f"{len(matrix.names)} prototypes of dimension {matrix.matrix.shape[1]}, key {matrix.key[:16]}")
+
+
+if __name__ == "__main__":
+    main()
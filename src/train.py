@@ -2,8 +2,21 @@ import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
+import tensorflow as tf
 from tensorflow.keras import layers, Sequential
 import argparse
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from contextlib import contextmanager
+
+try:
+    from .head import export_keras_head, save_classes
+except ImportError:  # run as a script from src/
+    from head import export_keras_head, save_classes
 
 
 def load_data_from_pickle(file_path: str) -> pd.DataFrame:
@@ -22,18 +35,217 @@ def load_data_from_pickle(file_path: str) -> pd.DataFrame:
         raise ValueError("DataFrame must contain a 'message' column.")
     return df
 
-def get_train_test_data(df: pd.DataFrame) -> (pd.DataFrame, pd.Series):
+def fixed_size_list_to_numpy(column) -> np.ndarray:
+    """
+    View a fixed-size-list Arrow column as an (N, D) NumPy array without copying.
+
+    Args:
+        column: pyarrow ChunkedArray or FixedSizeListArray of float32.
+
+    Returns:
+        np.ndarray: Read-only array backed by the Arrow buffer.
+    """
+    if hasattr(column, 'combine_chunks'):
+        # a single-chunk column (one row group) is combined without copying
+        column = column.combine_chunks()
+    values = column.flatten().to_numpy(zero_copy_only=True)
+    return values.reshape(-1, column.type.list_size)
+
+def load_processed_data(file_path: str, columns: list = None) -> (pd.DataFrame, np.ndarray):
+    """
+    Load the output of preprocess.py, reading only the columns training needs.
+
+    For Parquet, the label column and the embeddings are projected out of the
+    file; embeddings come back as one contiguous array shared with the Arrow
+    buffer, and the frame gets 'emb_row' pointers into it. Files written with
+    memory-mapped embeddings return the memory map instead. Pickles are read
+    in full for backwards compatibility.
+
+    Args:
+        file_path (str): .parquet or .pkl file written by preprocess.py.
+        columns (list): Extra columns to read besides the label and embeddings.
+
+    Returns:
+        pd.DataFrame: The rows, with 'label' and 'emb' or 'emb_row'.
+        np.ndarray: Embeddings 'emb_row' points into, or None for pickles.
+    """
+    if not file_path.endswith(".parquet"):
+        return load_data_from_pickle(file_path), None
+
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(file_path)
+    wanted = ['label'] + list(columns or [])
+    if 'emb' in schema.names:
+        table = pq.read_table(file_path, columns=wanted + ['emb'])
+        embeddings = fixed_size_list_to_numpy(table.column('emb'))
+        df = table.drop_columns(['emb']).to_pandas()
+        df['emb_row'] = np.arange(len(df))
+        return df, embeddings
+
+    table = pq.read_table(file_path, columns=wanted + ['emb_row'])
+    metadata = schema.metadata or {}
+    if b'embeddings_file' not in metadata:
+        raise ValueError(f"{file_path} has neither an 'emb' column nor an embeddings file reference.")
+    embeddings = np.load(metadata[b'embeddings_file'].decode(), mmap_mode='r')
+    return table.to_pandas(), embeddings
+
+def load_features(df: pd.DataFrame, embeddings: np.ndarray = None) -> np.ndarray:
+    """
+    Build the (N, D) feature matrix for the rows of `df`.
+
+    Rows either carry their vector in an 'emb' column, or point into an
+    embeddings array through 'emb_row' (a Parquet 'emb' column, or a memory-mapped
+    file from `embeddings.py --stream`). For memory maps only the referenced rows
+    are read from disk.
+
+    Args:
+        df (pd.DataFrame): DataFrame with an 'emb' or an 'emb_row' column.
+        embeddings (np.ndarray): Embeddings 'emb_row' indexes into. Defaults to the
+            file recorded in `df.attrs['embeddings_file']`.
+
+    Returns:
+        np.ndarray: float32 features.
+    """
+    if 'emb' in df.columns:
+        return np.vstack(df['emb'].values)
+    if 'emb_row' not in df.columns:
+        raise ValueError("DataFrame must contain an 'emb' or an 'emb_row' column.")
+    if embeddings is None:
+        embeddings = np.load(df.attrs['embeddings_file'], mmap_mode='r')
+    rows = df['emb_row'].to_numpy()
+    if len(rows) == len(embeddings) and np.array_equal(rows, np.arange(len(rows))):
+        # rows are the whole array in order, e.g. straight from Parquet: no copy needed
+        return np.asarray(embeddings, dtype=np.float32)
+    return gather_rows(embeddings, rows)
+
+def gather_rows(embeddings: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Read `embeddings[rows]` as float32, touching the array in ascending row order.
+
+    For a memory map this turns a random gather into a forward scan, then the
+    result is put back in the order of `rows`.
+    """
+    order = np.argsort(rows, kind='stable')
+    X = np.empty((len(rows), embeddings.shape[1]), dtype=np.float32)
+    X[order] = embeddings[rows[order]]
+    return X
+
+def split_indices(y: np.ndarray, test_size: float = 0.2, random_state: int = 42) -> (np.ndarray, np.ndarray):
+    """
+    Stratified train/test split of row positions, so features never need to be in memory.
+
+    Uses the same `train_test_split` call as `get_train_test_data`, hence the same split.
+
+    Args:
+        y (np.ndarray): Encoded labels, one per row.
+        test_size (float): Fraction of rows held out.
+        random_state (int): Seed of the split.
+
+    Returns:
+        np.ndarray: Positions of the training rows.
+        np.ndarray: Positions of the test rows.
+    """
+    train_idx, test_idx = train_test_split(
+        np.arange(len(y)),
+        test_size=test_size,
+        random_state=random_state,
+        stratify=y
+    )
+    return train_idx, test_idx
+
+def make_dataset(embeddings: np.ndarray, rows: np.ndarray, y: np.ndarray, positions: np.ndarray,
+                 batch_size: int = 32, shuffle: bool = False, shuffle_buffer: int = None, seed: int = 42) -> tf.data.Dataset:
+    """
+    Stream (features, label) batches for `positions` from an on-disk embeddings array.
+
+    Only row positions are shuffled and batched; each batch's vectors are read
+    from `embeddings` when the batch is produced, in parallel with training, so
+    memory stays bounded by the prefetched batches rather than the corpus.
+
+    Args:
+        embeddings (np.ndarray): (M, D) embeddings, usually a memory map.
+        rows (np.ndarray): Row in `embeddings` of every example.
+        y (np.ndarray): Encoded label of every example.
+        positions (np.ndarray): Examples to include, e.g. from `split_indices`.
+        batch_size (int): Size of each batch.
+        shuffle (bool): Reshuffle the examples every epoch.
+        shuffle_buffer (int): Shuffle buffer size; defaults to every position,
+            which is a full shuffle and costs only 8 bytes per example.
+        seed (int): Shuffle seed.
+
+    Returns:
+        tf.data.Dataset: Batches of (float32 (B, D), int64 (B,)).
+    """
+    dim = embeddings.shape[1]
+    rows = np.asarray(rows)
+    y = np.asarray(y, dtype=np.int64)
+
+    def read_batch(batch_positions):
+        return gather_rows(embeddings, rows[batch_positions]), y[batch_positions]
+
+    def load(batch_positions):
+        X, labels = tf.numpy_function(read_batch, [batch_positions], (tf.float32, tf.int64))
+        X.set_shape((None, dim))
+        labels.set_shape((None,))
+        return X, labels
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(positions, dtype=np.int64))
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer or len(positions), seed=seed, reshuffle_each_iteration=True)
+    return (
+        dataset
+        .batch(batch_size)
+        .map(load, num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+def get_train_test_datasets(df: pd.DataFrame, embeddings: np.ndarray = None, batch_size: int = 32, shuffle_buffer: int = None):
+    """
+    Streaming counterpart of `get_train_test_data`: same labels and split, tf.data input.
+
+    Args:
+        df (pd.DataFrame): DataFrame with 'label' and 'emb_row' (or 'emb') columns.
+        embeddings (np.ndarray): Embeddings 'emb_row' points into.
+        batch_size (int): Size of each batch.
+        shuffle_buffer (int): Shuffle buffer size of the training set.
+
+    Returns:
+        list: Training and test datasets.
+        int: Number of classes.
+        LabelEncoder: Fitted label encoder.
+        int: Embedding dimension.
+    """
+    if 'emb_row' in df.columns:
+        if embeddings is None:
+            embeddings = np.load(df.attrs['embeddings_file'], mmap_mode='r')
+        rows = df['emb_row'].to_numpy()
+    else:
+        # legacy frames hold their vectors in memory already
+        embeddings = load_features(df)
+        rows = np.arange(len(df))
+
+    le = LabelEncoder()
+    y = le.fit_transform(df['label'].values)
+    train_idx, test_idx = split_indices(y)
+
+    train_ds = make_dataset(embeddings, rows, y, train_idx, batch_size, shuffle=True, shuffle_buffer=shuffle_buffer)
+    test_ds = make_dataset(embeddings, rows, y, test_idx, batch_size)
+    return [train_ds, test_ds], len(le.classes_), le, embeddings.shape[1]
+
+def get_train_test_data(df: pd.DataFrame, embeddings: np.ndarray = None) -> (pd.DataFrame, pd.Series):
     """
     Prepare the data for training by encoding labels and splitting into features and target.
 
     Args:
         df (pd.DataFrame): DataFrame containing the data.
+        embeddings (np.ndarray): Memory-mapped embeddings for frames that store 'emb_row'.
 
     Returns:
         pd.DataFrame: Features DataFrame.
         pd.Series: Target Series.
     """
-    X = np.vstack(df['emb'].values)  # shape (N, D)
+    X = load_features(df, embeddings)  # shape (N, D)
     y_raw = df['label'].values
 
     # Encode labels
@@ -51,28 +263,31 @@ def get_train_test_data(df: pd.DataFrame) -> (pd.DataFrame, pd.Series):
 
     return [X_train, X_test], [y_train, y_test], num_classes, le, shape
 
-def build_model(input_shape: int, num_classes: int) -> Sequential:
+def build_model(input_shape: int, num_classes: int, units: tuple = (256, 128), dropout: float = 0.4, learning_rate: float = 0.001) -> Sequential:
     """
     Build a simple neural network model for classification.
 
     Args:
         input_shape (int): The shape of the input features.
         num_classes (int): The number of classes for classification.
+        units (tuple): Width of each hidden Dense layer.
+        dropout (float): Dropout rate after each hidden layer.
+        learning_rate (float): Adam learning rate.
 
     Returns:
         Sequential: Compiled Keras model.
     """
+    hidden = []
+    for width in units:
+        hidden += [layers.Dense(width, activation='relu'), layers.Dropout(dropout)]
     model = Sequential([
         layers.Input(shape=(input_shape,)),  # SBERT embedding size
-        layers.Dense(256, activation='relu'),
-        layers.Dropout(0.4),
-        layers.Dense(128, activation='relu'),
-        layers.Dropout(0.4),
+        *hidden,
         layers.Dense(num_classes, activation='softmax')
     ])
 
     model.compile(
-        optimizer='adam',
+        optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
         loss='sparse_categorical_crossentropy',
         metrics=[
             'accuracy',
@@ -106,20 +321,230 @@ def train_model(model: Sequential, X_train: np.ndarray, y_train: np.ndarray, X_t
     model.save(model_name)
     print('Trained model saved as', model_name)
 
+def train_model_on_datasets(model: Sequential, train_ds: tf.data.Dataset, test_ds: tf.data.Dataset, model_name: str, epochs: int = 10) -> None:
+    """
+    Train the model on batched datasets from `get_train_test_datasets`.
+
+    Args:
+        model (Sequential): The Keras model to train.
+        train_ds (tf.data.Dataset): Training batches.
+        test_ds (tf.data.Dataset): Validation batches.
+        model_name (str): Name of the model to save.
+        epochs (int): Number of epochs to train.
+    """
+    model.fit(
+        train_ds,
+        validation_data=test_ds,
+        epochs=epochs,
+        verbose=1
+    )
+
+    model.save(model_name)
+    print('Trained model saved as', model_name)
+
+def sweep_configs(units: list, dropout: list, learning_rate: list) -> list:
+    """Every combination of the given hidden-layer widths, dropout rates and learning rates."""
+    return [
+        {'units': tuple(u), 'dropout': d, 'learning_rate': lr}
+        for u, d, lr in itertools.product(units, dropout, learning_rate)
+    ]
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+@contextmanager
+def _thread_env(threads: int):
+    """
+    Set the math-library thread caps in this process's environment while workers are spawned.
+
+    The caps are read when numpy and TensorFlow are imported, which in a spawned
+    worker happens while unpickling the task functions, before any initializer
+    runs; children only see them if they inherit them from the parent.
+    """
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+def _limit_threads(threads: int) -> None:
+    """Pool initializer: cap TensorFlow's thread pools, which have not started yet in a fresh worker."""
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def time_per_1k(head, X: np.ndarray, repeats: int = 5) -> float:
+    """Median milliseconds for the NumPy head to classify 1000 embeddings in one batch."""
+    batch = np.resize(X, (1000, X.shape[1])).astype(np.float32)
+    head.predict_on_batch(batch)  # warm-up
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        head.predict_on_batch(batch)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+def run_config(index: int, config: dict, features_file: str, rows: np.ndarray, y: np.ndarray, train_idx: np.ndarray,
+               test_idx: np.ndarray, num_classes: int, output_dir: str, epochs: int, batch_size: int) -> dict:
+    """
+    Train and score one sweep configuration; runs inside a pool worker.
+
+    The features are memory-mapped from `features_file`, so every worker shares
+    the page cache instead of holding its own copy.
+
+    Returns:
+        dict: The configuration with accuracy, latency per 1k predictions and model size.
+    """
+    embeddings = np.load(features_file, mmap_mode='r')
+    train_ds = make_dataset(embeddings, rows, y, train_idx, batch_size, shuffle=True)
+    test_ds = make_dataset(embeddings, rows, y, test_idx, batch_size)
+
+    model = build_model(embeddings.shape[1], num_classes, **config)
+    model.fit(train_ds, epochs=epochs, verbose=0)
+    _, accuracy = model.evaluate(test_ds, verbose=0)
+
+    name = os.path.join(output_dir, f"config_{index}")
+    model.save(name + ".keras")
+    head = export_keras_head(model, name + ".npz")
+    X_test = gather_rows(embeddings, rows[test_idx[:1000]])
+
+    return {
+        'config': index,
+        'units': '-'.join(str(u) for u in config['units']),
+        'dropout': config['dropout'],
+        'learning_rate': config['learning_rate'],
+        'accuracy': float(accuracy),
+        'ms_per_1k': time_per_1k(head, X_test),
+        'size_kb': os.path.getsize(name + ".npz") / 1024,
+        'model': name + ".npz",
+    }
+
+def pareto_front(board: pd.DataFrame) -> pd.Series:
+    """True for rows no other row beats on both accuracy and latency."""
+    acc = board['accuracy'].to_numpy()
+    ms = board['ms_per_1k'].to_numpy()
+    dominated = [
+        ((acc >= a) & (ms <= m) & ((acc > a) | (ms < m))).any()
+        for a, m in zip(acc, ms)
+    ]
+    return ~pd.Series(dominated, index=board.index)
+
+def sweep(df: pd.DataFrame, embeddings: np.ndarray, configs: list, output_dir: str, epochs: int = 10,
+          batch_size: int = 32, workers: int = 2, threads: int = 1) -> pd.DataFrame:
+    """
+    Train `configs` in parallel worker processes and rank them.
+
+    Args:
+        df (pd.DataFrame): Preprocessed rows, as for `get_train_test_data`.
+        embeddings (np.ndarray): Embeddings 'emb_row' points into.
+        configs (list): Keyword arguments for `build_model`, from `sweep_configs`.
+        output_dir (str): Where models, shared features and the leaderboard go.
+        epochs (int): Epochs per configuration.
+        batch_size (int): Training batch size.
+        workers (int): Configurations trained at once.
+        threads (int): Math-library threads per worker.
+
+    Returns:
+        pd.DataFrame: The leaderboard, best accuracy first.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if 'emb_row' in df.columns and isinstance(embeddings, np.memmap) and embeddings.filename:
+        features_file = embeddings.filename
+        rows = df['emb_row'].to_numpy()
+    else:
+        # workers can only share a file, so write the features out once
+        features_file = os.path.join(output_dir, "features.npy")
+        np.save(features_file, load_features(df, embeddings))
+        rows = np.arange(len(df))
+
+    le = LabelEncoder()
+    y = le.fit_transform(df['label'].values)
+    train_idx, test_idx = split_indices(y)
+
+    # TensorFlow is not fork-safe once initialised, so workers start fresh
+    context = multiprocessing.get_context('spawn')
+    # workers are spawned on demand while tasks are submitted, so the caps stay set until the pool is done
+    with _thread_env(threads), \
+            ProcessPoolExecutor(workers, mp_context=context, initializer=_limit_threads, initargs=(threads,)) as pool:
+        futures = [
+            pool.submit(run_config, i, config, features_file, rows, y, train_idx, test_idx,
+                        len(le.classes_), output_dir, epochs, batch_size)
+            for i, config in enumerate(configs)
+        ]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            print(f"Finished {len(results)}/{len(configs)} configurations")
+
+    for result in results:
+        save_classes(result['model'], le.classes_)
+    board = pd.DataFrame(results).sort_values(['accuracy', 'ms_per_1k'], ascending=[False, True])
+    board['pareto'] = pareto_front(board)
+    board.to_csv(os.path.join(output_dir, "leaderboard.csv"), index=False)
+    return board
+
+def sweep_main(argv: list) -> None:
+    parser = argparse.ArgumentParser(prog="train.py sweep", description="Train classifier head configurations in parallel and rank them.")
+    parser.add_argument('--input_file', type=str, required=True, help='Path to the preprocessed .parquet (or legacy .pkl) file.')
+    parser.add_argument('--embeddings_file', type=str, default=None, help='Memory-mapped .npy embeddings, if the data stores emb_row pointers.')
+    parser.add_argument('--output_dir', type=str, default='../models/sweep', help='Directory for the models and leaderboard.csv.')
+    parser.add_argument('--units', nargs='+', default=['256,128'], help='Hidden layer widths to try, each as a comma-separated list, e.g. 256,128 128 64,32.')
+    parser.add_argument('--dropout', nargs='+', type=float, default=[0.4], help='Dropout rates to try.')
+    parser.add_argument('--learning_rate', nargs='+', type=float, default=[0.001], help='Adam learning rates to try.')
+    parser.add_argument('--epochs', type=int, default=10, help='Epochs per configuration.')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size for training.')
+    parser.add_argument('--threads', type=int, default=1, help='Math-library threads per worker.')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel workers (default: cores / threads).')
+
+    args = parser.parse_args(argv)
+
+    df, embeddings = load_processed_data(args.input_file)
+    if args.embeddings_file:
+        embeddings = np.load(args.embeddings_file, mmap_mode='r')
+
+    units = [[int(u) for u in spec.split(',')] for spec in args.units]
+    configs = sweep_configs(units, args.dropout, args.learning_rate)
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+    print(f"Sweeping {len(configs)} configurations on {workers} workers x {args.threads} threads")
+
+    board = sweep(df, embeddings, configs, args.output_dir, args.epochs, args.batch_size, workers, args.threads)
+    print(board.drop(columns=['model']).to_string(index=False))
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        sweep_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="Train a classification model on email data.")
-    parser.add_argument('--input_file', type=str, required=True, help='Path to the input pickle file containing email data.')
+    parser.add_argument('--input_file', type=str, required=True, help='Path to the preprocessed .parquet (or legacy .pkl) file.')
     parser.add_argument('--model_name', type=str, default='email_classifier.keras', help='Name of the model to save.')
     parser.add_argument('--epochs', type=int, default=10, help='Number of epochs to train the model.')
     parser.add_argument('--batch_size', type=int, default=32, help='Batch size for training.')
+    parser.add_argument('--embeddings_file', type=str, default=None, help='Memory-mapped .npy embeddings, if the data stores emb_row pointers.')
+    parser.add_argument('--stream', action='store_true', help='Stream batches from the embeddings through tf.data instead of loading them into memory.')
+    parser.add_argument('--shuffle_buffer', type=int, default=None, help='Shuffle buffer size with --stream (default: full shuffle).')
 
     args = parser.parse_args()
 
-    df = load_data_from_pickle(args.input_file)
-    X, y, num_classes, le, shape = get_train_test_data(df)
+    df, embeddings = load_processed_data(args.input_file)
+    if args.embeddings_file:
+        embeddings = np.load(args.embeddings_file, mmap_mode='r')
+
+    if args.stream:
+        datasets, num_classes, le, shape = get_train_test_datasets(df, embeddings, args.batch_size, args.shuffle_buffer)
+        model = build_model(input_shape=shape, num_classes=num_classes)
+        train_model_on_datasets(model, datasets[0], datasets[1], args.model_name, epochs=args.epochs)
+        save_classes(args.model_name, le.classes_)
+        return
+
+    X, y, num_classes, le, shape = get_train_test_data(df, embeddings)
 
     model = build_model(input_shape=shape, num_classes=num_classes)
     train_model(model, X[0], y[0], X[1], y[1], args.model_name, epochs=args.epochs, batch_size=args.batch_size)
+    save_classes(args.model_name, le.classes_)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,91 @@
+# tests/test_api.py
+import re
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# the registry loads lazily, so importing the API needs no real model
+os.environ.setdefault("MODEL_PATH", "unused.npz")
+
+from src import api, inference
+from src.batching import QueueFullError
+from src.prototypes import PrototypeMatrix
+
+
+class WhitespaceTokenizer:
+    def __call__(self, texts, **kwargs):
+        return {"offset_mapping": [[m.span() for m in re.finditer(r"\S+", t)] for t in texts]}
+
+
+class FakeEncoder:
+    """Embeds a text as (word count, character count)."""
+    max_seq_length = 64
+    tokenizer = WhitespaceTokenizer()
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, **kwargs):
+        return np.array([[len(t.split()), len(t)] for t in texts], dtype=np.float32)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    prototypes = PrototypeMatrix.from_embeddings(["short", "long"], np.array([[1.0, 3.0], [1.0, 0.1]]))
+    models = inference.LoadedModels(FakeEncoder(), None, "fake", "torch", "unused.npz", prototypes=prototypes)
+    monkeypatch.setattr(inference.registry, "_models", models)
+    return TestClient(api.app, raise_server_exceptions=False)
+
+
+def test_explain_goes_through_its_batcher(client):
+    before = api.explain_batcher.stats()["items"]
+    resp = client.post("/explain", json={"text": "hi"})
+    assert resp.status_code == 200
+    assert resp.json()["closest_prototype"] == "short"
+    assert list(resp.json()["prototype_scores"]) == ["short", "long"]
+    assert api.explain_batcher.stats()["items"] == before + 1
+
+
+def test_explain_errors(client, monkeypatch):
+    # only a missing prototype matrix is "unavailable"
+    monkeypatch.setattr(inference.registry, "_models", inference.registry._models._replace(prototypes=None))
+    resp = client.post("/explain", json={"text": "hi"})
+    assert resp.status_code == 503 and "prototype" in resp.json()["detail"]
+
+    def full(texts):
+        raise QueueFullError("full")
+
+    monkeypatch.setattr(api.explain_batcher, "submit", full)
+    resp = client.post("/explain", json={"text": "hi"})
+    assert resp.status_code == 503 and resp.headers["Retry-After"] == str(api.RETRY_AFTER_SECONDS)
+
+    monkeypatch.undo()
+    monkeypatch.setattr(inference.registry, "_models", inference.LoadedModels(
+        None, None, "fake", "torch", "unused.npz", prototypes=PrototypeMatrix(["a"], np.ones((1, 2)))))
+    # an encoder failure is a server error, not a 503 telling clients to retry
+    assert client.post("/explain", json={"text": "not in the embedding cache"}).status_code == 500
+
+
+def test_ready_reports_why_loading_failed(monkeypatch):
+    registry = inference.ModelRegistry("missing.npz", "fake", "torch", None)
+
+    def load_classifier(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(inference, "registry", registry)
+    monkeypatch.setattr(inference, "load_encoder", lambda name, backend: FakeEncoder())
+    monkeypatch.setattr(inference, "load_classifier", load_classifier)
+    client = TestClient(api.app, raise_server_exceptions=False)
+
+    assert client.get("/ready").json() == {"ready": False, "error": None}
+    with pytest.raises(FileNotFoundError):
+        registry.load()
+    resp = client.get("/ready")
+    assert resp.status_code == 503 and "missing.npz" in resp.json()["error"]
+
+    resp = client.post("/reload", json={"model_path": "other.npz"})
+    assert resp.status_code == 500 and "other.npz" in resp.json()["detail"]
@@ -24,3 +24,28 @@ def test_predict_endpoint():
     if "id" in data:
         assert isinstance(data["id"], int)
         assert data["id"] == 2  # Assuming the text is classified as "Internships"
+
+def test_predict_batch_endpoint():
+    texts = [
+        "Hello! I'm interested in internship opportunities.",
+        "Join our club for the orientation event this weekend.",
+        "Hello! I'm interested in internship opportunities.",
+    ]
+    resp = client.post("/predict_batch", json={"texts": texts})
+    assert resp.status_code == 200
+
+    predictions = resp.json()["predictions"]
+    assert len(predictions) == len(texts)
+    for item in predictions:
+        assert isinstance(item["prediction"], str)
+        assert isinstance(item["id"], int)
+        assert abs(sum(item["probabilities"].values()) - 1.0) < 1e-3
+    # results come back in input order
+    assert predictions[0] == predictions[2]
+    assert predictions[0]["id"] == 2
+
+
+def test_predict_batch_rejects_oversized_batch():
+    from src.api import MAX_PREDICT_BATCH
+    resp = client.post("/predict_batch", json={"texts": ["x"] * (MAX_PREDICT_BATCH + 1)})
+    assert resp.status_code == 413
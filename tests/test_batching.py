@@ -0,0 +1,95 @@
+# tests/test_batching.py
+import threading
+
+import numpy as np
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.batching import MicroBatcher, QueueFullError
+
+
+def fake_handler(calls):
+    def handler(texts):
+        calls.append(list(texts))
+        # one row per text, the row encodes the text length so callers can check the split
+        return np.array([[len(t), 0.0] for t in texts])
+    return handler
+
+
+def test_concurrent_requests_are_coalesced():
+    calls = []
+    batcher = MicroBatcher(fake_handler(calls), max_batch_size=8, max_wait_ms=200)
+    gate = threading.Event()
+    results = {}
+
+    def worker(i):
+        gate.wait()
+        results[i] = batcher.submit(["x" * i]).result(timeout=5)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(1, 5)]
+    for t in threads:
+        t.start()
+    gate.set()
+    for t in threads:
+        t.join()
+    batcher.stop()
+
+    assert sum(len(c) for c in calls) == 4
+    assert len(calls) < 4
+    for i, rows in results.items():
+        assert rows.shape == (1, 2)
+        assert rows[0, 0] == i
+
+
+def test_batch_respects_max_size_and_order():
+    calls = []
+    batcher = MicroBatcher(fake_handler(calls), max_batch_size=3, max_wait_ms=50)
+    futures = [batcher.submit(["a", "bb"]), batcher.submit(["ccc", "dddd"])]
+    first, second = [f.result(timeout=5) for f in futures]
+    batcher.stop()
+
+    assert all(len(c) <= 3 for c in calls)
+    assert first[:, 0].tolist() == [1, 2]
+    assert second[:, 0].tolist() == [3, 4]
+
+    stats = batcher.stats()
+    assert stats["items"] == 4
+    assert stats["batches"] == 2
+    assert stats["batch_size_histogram"] == {"2": 2}
+
+
+def test_handler_errors_reach_every_caller():
+    def failing(texts):
+        raise RuntimeError("boom")
+
+    batcher = MicroBatcher(failing, max_batch_size=4, max_wait_ms=1)
+    future = batcher.submit(["hello"])
+    with pytest.raises(RuntimeError):
+        future.result(timeout=5)
+    batcher.stop()
+
+
+def test_full_queue_rejects_new_requests():
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow(texts):
+        started.set()
+        release.wait(timeout=5)
+        return np.zeros((len(texts), 2))
+
+    batcher = MicroBatcher(slow, max_batch_size=1, max_wait_ms=0, max_queue=1)
+    running = batcher.submit(["a"])
+    # wait until the worker has picked up the first request
+    assert started.wait(timeout=5)
+    queued = batcher.submit(["b"])
+    with pytest.raises(QueueFullError):
+        batcher.submit(["c"])
+    release.set()
+    running.result(timeout=5)
+    queued.result(timeout=5)
+    batcher.stop()
+    assert batcher.stats()["rejected"] == 1
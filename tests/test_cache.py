@@ -0,0 +1,76 @@
+# tests/test_cache.py
+import numpy as np
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.cache import EmbeddingCache, SqliteEmbeddingStore, content_key
+
+
+def vec(value):
+    return np.full(4, value, dtype=np.float32)
+
+
+def test_content_key_normalizes_whitespace_and_includes_model():
+    assert content_key("Mid-sem  exam\n schedule ", "m") == content_key("Mid-sem exam schedule", "m")
+    assert content_key("Mid-sem exam schedule", "m") != content_key("Mid-sem exam schedule", "other")
+
+
+def test_lru_eviction_and_counters():
+    cache = EmbeddingCache(max_entries=2)
+    cache.put_many({"a": vec(1), "b": vec(2)})
+    assert set(cache.get_many(["a"])) == {"a"}  # touch a so b is least recently used
+    cache.put_many({"c": vec(3)})
+
+    found = cache.get_many(["a", "b", "c"])
+    assert set(found) == {"a", "c"}
+
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+
+
+def test_persistent_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = EmbeddingCache(max_entries=10, store=SqliteEmbeddingStore(path))
+    cache.put_many({"a": vec(1.5)})
+    cache.store.close()
+
+    reopened = EmbeddingCache(max_entries=10, store=SqliteEmbeddingStore(path))
+    found = reopened.get_many(["a", "missing"])
+    np.testing.assert_array_equal(found["a"], vec(1.5))
+    assert reopened.stats()["disk_hits"] == 1
+    assert reopened.stats()["misses"] == 1
+    # promoted into memory, so the next lookup is a memory hit
+    reopened.get_many(["a"])
+    assert reopened.stats()["hits"] == 1
+
+
+def test_sweep_drops_unmarked_keys(tmp_path):
+    store = SqliteEmbeddingStore(str(tmp_path / "store.sqlite"))
+    store.put_many({"a": vec(1), "b": vec(2), "c": vec(3)})
+    store.mark_live(["a"])
+    store.mark_live(["c"])
+    assert store.sweep() == 1
+    store.compact()
+    assert set(store.get_many(["a", "b", "c"])) == {"a", "c"}
+    assert len(store) == 2
+
+
+def test_sweep_by_origin_and_old_stores_are_migrated(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "store.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+    conn.execute("INSERT INTO embeddings VALUES ('old', ?)", (vec(1).tobytes(),))
+    conn.commit()
+    conn.close()
+
+    store = SqliteEmbeddingStore(path)
+    store.put_many({"a": vec(2), "b": vec(3)}, origin="offline")
+    store.mark_live(["a"])
+    assert store.sweep(origin="offline") == 1
+    assert set(store.get_many(["old", "a", "b"])) == {"old", "a"}
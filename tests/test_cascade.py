@@ -0,0 +1,103 @@
+# tests/test_cascade.py
+import numpy as np
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.cascade import Cascade, HashedLinearModel, confident, evaluate
+from src.head import save_classes
+
+TEXTS = ["club orientation tonight", "join the club event", "club fest registrations",
+         "summer internship opening", "apply for the internship", "internship deadline friday",
+         "seminar by guest speaker", "research seminar talk", "invitation to seminar"] * 3
+LABELS = np.array([0, 0, 0, 2, 2, 2, 3, 3, 3] * 3)
+CLASSES = ["club", "academics", "internship", "talks"]
+
+
+def test_hashed_model_learns_and_roundtrips(tmp_path):
+    # class 1 never occurs but keeps its column, like a label missing from a small export
+    model = HashedLinearModel.fit(TEXTS, LABELS, CLASSES, n_features=2 ** 12)
+    probs = model.predict_proba(["club event tonight", "internship applications", "unrelated"])
+    assert probs.shape == (3, 4)
+    assert probs[:2].argmax(axis=1).tolist() == [0, 2]
+    assert probs[:, 1].max() < 1e-6
+
+    path = str(tmp_path / "fast.npz")
+    model.save(path)
+    loaded = HashedLinearModel.load(path)
+    assert loaded.classes == CLASSES
+    np.testing.assert_allclose(loaded.predict_proba(TEXTS), model.predict_proba(TEXTS), rtol=1e-5)
+
+
+def test_confident_uses_threshold_and_margin():
+    probs = np.array([[0.95, 0.05], [0.6, 0.4], [0.5, 0.5]])
+    assert confident(probs, 0.9).tolist() == [True, False, False]
+    assert confident(probs, 0.5).tolist() == [True, True, True]
+    assert confident(probs, 0.5, min_margin=0.1).tolist() == [True, True, False]
+
+
+class FixedModel:
+    def __init__(self, probs):
+        self.probs = probs
+
+    def predict_proba(self, texts):
+        return np.array([self.probs[t] for t in texts])
+
+
+def test_cascade_sends_only_ambiguous_rows_to_the_full_path():
+    fast = FixedModel({"easy": [0.99, 0.01], "hard": [0.55, 0.45]})
+    calls = []
+
+    def full(texts):
+        calls.append(list(texts))
+        return np.array([[0.0, 1.0]] * len(texts))
+
+    cascade = Cascade(threshold=0.9)
+    probs = cascade.predict_proba(["easy", "hard", "easy"], fast, full)
+    assert calls == [["hard"]]
+    assert probs.argmax(axis=1).tolist() == [0, 1, 0]
+    stats = cascade.stats()
+    assert stats["short_circuit_fraction"] == pytest.approx(2 / 3)
+    assert stats["estimated_accuracy_loss"] is None
+
+    # shadowing every short-circuited row measures how often the first stage disagrees
+    shadowed = Cascade(threshold=0.9, shadow_rate=1.0)
+    probs = shadowed.predict_proba(["easy", "hard"], fast, full)
+    assert probs.argmax(axis=1).tolist() == [1, 1]
+    stats = shadowed.stats()
+    assert stats["shadow_disagreement"] == 1.0
+    assert stats["estimated_accuracy_loss"] == pytest.approx(0.5)
+
+    shadowed.reset()
+    assert shadowed.stats()["requests"] == 0 and shadowed.stats()["shadow_disagreement"] is None
+
+
+def test_registry_checks_cascade_classes_against_the_head(tmp_path, monkeypatch):
+    monkeypatch.setenv("MODEL_PATH", "unused.npz")
+    from src import inference
+
+    fast = HashedLinearModel(np.zeros((2, 8)), np.zeros(2), ["club", "talks"], n_features=8)
+    head = str(tmp_path / "head.npz")
+    # without recorded classes only the count can be checked
+    inference.check_cascade_classes(fast, "fast.npz", head, 2)
+    with pytest.raises(ValueError, match="2 classes"):
+        inference.check_cascade_classes(fast, "fast.npz", head, 3)
+
+    save_classes(head, ["club", "talks"])
+    inference.check_cascade_classes(fast, "fast.npz", head, 2)
+    save_classes(head, ["talks", "club"])
+    with pytest.raises(ValueError, match="predicts"):
+        inference.check_cascade_classes(fast, "fast.npz", head, 2)
+
+
+def test_evaluate_reports_loss_per_threshold():
+    fast = np.array([[0.95, 0.05], [0.7, 0.3], [0.2, 0.8]])
+    full = np.array([[0.9, 0.1], [0.1, 0.9], [0.1, 0.9]])
+    y = np.array([0, 1, 1])
+    low, high = evaluate(fast, full, y, [0.6, 0.9])
+    assert low["short_circuit_fraction"] == pytest.approx(1.0)
+    assert low["accuracy_loss"] == pytest.approx(1 / 3)
+    assert high["short_circuit_fraction"] == pytest.approx(1 / 3)
+    assert high["accuracy_loss"] == 0
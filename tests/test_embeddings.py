@@ -0,0 +1,160 @@
+# tests/test_embeddings.py
+import re
+
+import numpy as np
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.embeddings import encode_bucketed, length_buckets, truncate_texts
+
+
+class WhitespaceTokenizer:
+    """One token per word, with the offset mapping a fast tokenizer would return."""
+
+    def __call__(self, texts, **kwargs):
+        return {"offset_mapping": [[m.span() for m in re.finditer(r"\S+", t)] for t in texts]}
+
+
+class FakeModel:
+    max_seq_length = 8
+    tokenizer = WhitespaceTokenizer()
+
+    def __init__(self):
+        self.batches = []
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        self.batches.append(list(texts))
+        return np.array([[len(t.split()), len(t)] for t in texts], dtype=np.float32)
+
+
+def test_truncate_head_and_head_tail():
+    text = "w1 w2 w3 w4 w5 w6 w7 w8"
+    tok = WhitespaceTokenizer()
+
+    head, lengths = truncate_texts([text, "short"], tok, 4, "head")
+    assert head == ["w1 w2 w3 w4", "short"]
+    assert lengths == [4, 1]
+
+    head_tail, _ = truncate_texts([text], tok, 4, "head_tail", head_ratio=0.5)
+    assert head_tail == ["w1 w2 w7 w8"]
+
+    with pytest.raises(ValueError):
+        truncate_texts([text], tok, 4, "middle")
+
+
+def test_length_buckets_respect_size_and_token_budget():
+    lengths = [5, 1, 6, 1, 2]
+    assert [b.tolist() for b in length_buckets(lengths, batch_size=2)] == [[1, 3], [4, 0], [2]]
+    # a budget of 6 padded tokens fits three 2-token texts but only one 6-token text
+    assert [b.tolist() for b in length_buckets(lengths, batch_size=8, max_batch_tokens=6)] == [[1, 3, 4], [0], [2]]
+
+
+def test_encode_bucketed_restores_order_and_truncates():
+    model = FakeModel()
+    texts = ["a b c d e f g h i j", "a", "a b c", "a b"]
+    emb = encode_bucketed(model, texts, batch_size=2)
+
+    # max_seq_length 8 leaves 6 tokens after [CLS] and [SEP]
+    assert emb[:, 0].tolist() == [6, 1, 3, 2]
+    assert all(len(b) <= 2 for b in model.batches)
+    # the shortest texts share the first batch
+    assert sorted(model.batches[0]) == ["a", "a b"]
+
+
+def test_stream_embeddings_resumes_after_crash(tmp_path, monkeypatch):
+    import pandas as pd
+    from src import embeddings
+
+    csv = tmp_path / "mail.csv"
+    pd.DataFrame({"message": ["a", "a b", "a b c", "a b c d", "a b c d e"]}).to_csv(csv, index=False)
+    out = str(tmp_path / "emb.npy")
+
+    class CrashingModel(FakeModel):
+        calls = 0
+
+        def encode(self, texts, batch_size=32, **kwargs):
+            CrashingModel.calls += 1
+            if CrashingModel.calls == 2:
+                raise RuntimeError("killed")
+            return super().encode(texts, batch_size, **kwargs)
+
+    monkeypatch.setattr(embeddings, "SentenceTransformer", lambda name: CrashingModel())
+    with pytest.raises(RuntimeError):
+        embeddings.stream_embeddings(str(csv), out, "fake", chunk_size=2)
+    assert embeddings.read_manifest(out)["completed_rows"] == 2
+
+    monkeypatch.setattr(embeddings, "SentenceTransformer", lambda name: FakeModel())
+    result = embeddings.stream_embeddings(str(csv), out, "fake", chunk_size=2)
+
+    assert isinstance(result, np.memmap)
+    assert result[:, 0].tolist() == [1, 2, 3, 4, 5]
+    assert embeddings.read_manifest(out)["complete"] is True
+
+
+def test_stream_embeddings_refuses_to_resume_on_changed_input(tmp_path, monkeypatch):
+    import pandas as pd
+    from src import embeddings
+
+    csv = tmp_path / "mail.csv"
+    pd.DataFrame({"message": ["a", "a b", "a b c"]}).to_csv(csv, index=False)
+    out = str(tmp_path / "emb.npy")
+    monkeypatch.setattr(embeddings, "SentenceTransformer", lambda name: FakeModel())
+    embeddings.stream_embeddings(str(csv), out, "fake", chunk_size=2)
+    manifest = embeddings.read_manifest(out)
+    manifest.update(complete=False, completed_rows=2)
+    embeddings.write_manifest(out, manifest)
+
+    with pytest.raises(ValueError, match="max_seq_length, truncation"):
+        embeddings.stream_embeddings(str(csv), out, "fake", chunk_size=2, max_seq_length=4, truncation="head_tail")
+
+    # appended to since the run began
+    pd.DataFrame({"message": ["a", "a b", "a b c", "new mail"]}).to_csv(csv, index=False)
+    with pytest.raises(ValueError, match="changed since .* --fresh"):
+        embeddings.stream_embeddings(str(csv), out, "fake", chunk_size=2)
+
+    result = embeddings.stream_embeddings(str(csv), out, "fake", chunk_size=2, fresh=True)
+    assert result[:, 0].tolist() == [1, 2, 3, 2]
+
+
+def test_store_reuses_known_messages(tmp_path, monkeypatch):
+    import pandas as pd
+    from src import embeddings
+    from src.cache import SqliteEmbeddingStore
+
+    monkeypatch.setattr(embeddings, "SentenceTransformer", lambda name: FakeModel())
+    store = SqliteEmbeddingStore(str(tmp_path / "store.sqlite"))
+
+    first = {}
+    embeddings.get_embeddings(pd.DataFrame({"message": ["a", "a b", "a"]}), "fake", store=store, stats=first)
+    assert first == {"reused": 0, "computed": 2}
+    store.sweep()
+
+    second = {}
+    emb = embeddings.get_embeddings(pd.DataFrame({"message": ["a b", "a b c"]}), "fake", store=store, stats=second)
+    assert second == {"reused": 1, "computed": 1}
+    assert emb[:, 0].tolist() == [2, 3]
+    # "a" is not in the second export anymore; the serving cache's entry is not this job's to drop
+    store.put_many({"served": np.ones(2, dtype=np.float32)})
+    assert store.sweep(origin=embeddings.STORE_ORIGIN) == 1
+    assert len(store) == 3
+
+
+def test_parquet_part_directory_is_read_in_order(tmp_path):
+    import pandas as pd
+    from src import embeddings
+
+    directory = tmp_path / "mails.parquet"
+    directory.mkdir()
+    pd.DataFrame({'message': ['a', 'b', 'c']}).to_parquet(directory / "part-0000000001.parquet")
+    pd.DataFrame({'message': ['d', 'e']}).to_parquet(directory / "part-0000000009.parquet")
+
+    assert embeddings.count_rows(str(directory), chunk_size=2) == 5
+    chunks = [c['message'].tolist() for c in embeddings.read_chunks(str(directory), chunk_size=2)]
+    assert chunks == [['a', 'b'], ['c'], ['d', 'e']]
+    assert embeddings.load_data(str(directory))['message'].tolist() == ['a', 'b', 'c', 'd', 'e']
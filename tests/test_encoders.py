@@ -0,0 +1,36 @@
+# tests/test_encoders.py
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import encoders
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    calls = []
+
+    def fake_sentence_transformer(model_name, **kwargs):
+        calls.append((model_name, kwargs))
+        return object()
+
+    monkeypatch.setattr(encoders, "SentenceTransformer", fake_sentence_transformer)
+    return calls
+
+
+@pytest.mark.parametrize("backend, kwargs", [
+    ("torch", {}),
+    ("onnx", {"backend": "onnx"}),
+    ("onnx-int8", {"backend": "onnx", "model_kwargs": {"file_name": encoders.QUANTIZED_FILE_NAME}}),
+])
+def test_backend_selects_sentence_transformer_kwargs(loaded, backend, kwargs):
+    encoders.load_encoder("models/minilm", backend)
+    assert loaded == [("models/minilm", kwargs)]
+
+
+def test_unknown_backend_is_rejected(loaded):
+    with pytest.raises(ValueError, match="Unknown encoder backend 'tensorrt'"):
+        encoders.load_encoder("models/minilm", "tensorrt")
+    assert loaded == []
@@ -0,0 +1,184 @@
+# tests/test_extract_mails.py
+import csv
+import re
+import socketserver
+import threading
+from email.message import EmailMessage
+
+import pandas as pd
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+
+import extract_mails
+
+
+def make_message(i):
+    msg = EmailMessage()
+    msg['From'] = f"sender{i}@example.com"
+    msg['To'] = "me@example.com"
+    msg['Subject'] = f"Subject {i}"
+    msg.set_content(f"Body {i}")
+    return msg.as_bytes()
+
+
+class FakeMailbox:
+    """Just enough IMAP4rev1 for imaplib: LOGIN, EXAMINE, UID SEARCH, UID FETCH, LOGOUT."""
+
+    def __init__(self, uidvalidity=7):
+        self.uidvalidity = uidvalidity
+        self.messages = {}  # uid -> raw
+        self.connections = 0
+        self.fetches = []
+
+
+def serve(mailbox):
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, line):
+            self.wfile.write(line if isinstance(line, bytes) else line.encode() + b"\r\n")
+
+        def handle(self):
+            mailbox.connections += 1
+            self.send("* OK fake IMAP ready")
+            for line in self.rfile:
+                tag, command, *rest = line.decode().rstrip("\r\n").split(" ", 2)
+                args = rest[0] if rest else ""
+                command = command.upper()
+                if command == "CAPABILITY":
+                    self.send("* CAPABILITY IMAP4rev1")
+                elif command in ("EXAMINE", "SELECT"):
+                    self.send(f"* {len(mailbox.messages)} EXISTS")
+                    self.send(f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid")
+                elif command == "UID":
+                    self.uid(*args.split(" ", 1))
+                elif command == "LOGOUT":
+                    self.send("* BYE")
+                    self.send(f"{tag} OK LOGOUT completed")
+                    return
+                self.send(f"{tag} OK {command} completed")
+
+        def uid(self, command, args):
+            uids = sorted(mailbox.messages)
+            if command.upper() == "SEARCH":
+                low = int(re.search(r"UID (\d+):\*", args).group(1))
+                # like real servers, "n:*" includes the newest message even below n
+                found = [u for u in uids if u >= low] or uids[-1:]
+                self.send("* SEARCH " + " ".join(map(str, found)))
+                return
+            uid_set, _ = args.split(" ", 1)
+            mailbox.fetches.append(uid_set)
+            wanted = set()
+            for part in uid_set.split(","):
+                first, _, last = part.partition(":")
+                wanted.update(range(int(first), int(last or first) + 1))
+            for seq, uid in enumerate(uids, start=1):
+                if uid in wanted:
+                    raw = mailbox.messages[uid]
+                    self.send(f"* {seq} FETCH (UID {uid} RFC822 {{{len(raw)}}}\r\n".encode() + raw + b")\r\n")
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def mailbox():
+    box = FakeMailbox()
+    box.messages = {uid: make_message(uid) for uid in (1, 2, 3, 5, 8, 9, 10)}
+    server = serve(box)
+    box.connect = lambda: extract_mails.connect("127.0.0.1", "me", "pw", port=server.server_address[1], use_ssl=False)
+    yield box
+    server.shutdown()
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return list(csv.DictReader(f))
+
+
+def test_uid_set_compacts_ranges():
+    assert extract_mails.uid_set([1, 2, 3, 5, 8, 9]) == "1:3,5,8:9"
+
+
+class ScriptedImap:
+    def __init__(self, data):
+        self.data = data
+
+    def uid(self, command, *args):
+        return 'OK', self.data
+
+
+def test_fetch_batch_finds_uids_after_the_literal(capsys):
+    data = [(b'1 (UID 3 RFC822 {1}', b'a'), b')', (b'2 (RFC822 {1}', b'b'), b' UID 5)']
+    assert extract_mails.fetch_batch(ScriptedImap(data), [3, 5, 7]) == [(3, b'a'), (5, b'b')]
+    # UID 7 was expunged since the search: reported, not silently dropped
+    assert "7 were not returned" in capsys.readouterr().out
+
+    with pytest.raises(ValueError, match="without a UID"):
+        extract_mails.fetch_batch(ScriptedImap([(b'1 (RFC822 {1}', b'a'), b')']), [3])
+    with pytest.raises(ValueError, match="not requested"):
+        extract_mails.fetch_batch(ScriptedImap([(b'1 (UID 4 RFC822 {1}', b'a'), b')']), [3])
+
+
+def test_parallel_batched_extraction(mailbox, tmp_path):
+    out = str(tmp_path / "mails.csv")
+    written = extract_mails.extract(mailbox.connect, out, batch_size=3, connections=2, parse_workers=2)
+
+    assert written == 7
+    rows = read_csv(out)
+    assert [r['sender'] for r in rows] == [f"sender{u}@example.com" for u in (1, 2, 3, 5, 8, 9, 10)]
+    assert rows[0]['message'].startswith("Subject 1\n\nBody 1")
+    assert sorted(mailbox.fetches) == ["10", "1:3", "5,8:9"]  # batches race across connections
+
+
+def test_incremental_run_fetches_only_new_mail(mailbox, tmp_path):
+    out = str(tmp_path / "mails.csv")
+    extract_mails.extract(mailbox.connect, out, batch_size=50, connections=1)
+    assert extract_mails.extract(mailbox.connect, out, batch_size=50, connections=1) == 0
+
+    mailbox.messages[12] = make_message(12)
+    assert extract_mails.extract(mailbox.connect, out, batch_size=50, connections=1) == 1
+    assert len(read_csv(out)) == 8
+    assert mailbox.fetches[-1] == "12"
+
+    # a new UIDVALIDITY invalidates the stored UIDs, so everything is downloaded again
+    mailbox.uidvalidity += 1
+    assert extract_mails.extract(mailbox.connect, out, batch_size=50, connections=1) == 8
+    assert len(read_csv(out)) == 8
+
+
+@pytest.mark.parametrize("name", ["mails.csv.gz", "mails.parquet"])
+def test_compressed_outputs_resume(mailbox, tmp_path, name):
+    out = str(tmp_path / name)
+    extract_mails.extract(mailbox.connect, out, batch_size=2, connections=2)
+    mailbox.messages[12] = make_message(12)
+    assert extract_mails.extract(mailbox.connect, out, batch_size=2, connections=2) == 1
+
+    df = pd.read_csv(out) if name.endswith(".gz") else pd.read_parquet(out)
+    assert df['sender'].tolist() == [f"sender{u}@example.com" for u in (1, 2, 3, 5, 8, 9, 10, 12)]
+
+
+def test_interrupted_csv_is_truncated_to_the_checkpoint(mailbox, tmp_path):
+    out = str(tmp_path / "mails.csv")
+    extract_mails.extract(mailbox.connect, out, batch_size=50, connections=1)
+    with open(out, "a") as f:
+        f.write("half a row from a crashed run")
+    mailbox.messages[12] = make_message(12)
+    extract_mails.extract(mailbox.connect, out, batch_size=50, connections=1)
+
+    assert [r['sender'] for r in read_csv(out)][-2:] == ["sender10@example.com", "sender12@example.com"]
+
+
+def test_parquet_resume_removes_half_written_parts(mailbox, tmp_path):
+    out = tmp_path / "mails.parquet"
+    extract_mails.extract(mailbox.connect, str(out), batch_size=50, connections=1)
+    # a crash during the atomic write leaves the temporary file behind, even for old UIDs
+    (out / "part-0000000001.parquet.tmp").write_bytes(b"truncated")
+    mailbox.messages[12] = make_message(12)
+    extract_mails.extract(mailbox.connect, str(out), batch_size=50, connections=1)
+
+    assert not list(out.glob("*.tmp"))
+    assert len(pd.read_parquet(out)) == 8
@@ -0,0 +1,40 @@
+# tests/test_head.py
+import numpy as np
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.head import NumpyHead, export_keras_head
+
+
+def test_numpy_head_forward_pass(tmp_path):
+    rng = np.random.default_rng(0)
+    w1, b1 = rng.standard_normal((4, 3)).astype(np.float32), rng.standard_normal(3).astype(np.float32)
+    w2, b2 = rng.standard_normal((3, 2)).astype(np.float32), rng.standard_normal(2).astype(np.float32)
+    path = tmp_path / "head.npz"
+    np.savez(path, num_layers=np.array(2),
+             kernel_0=w1, bias_0=b1, activation_0=np.array("relu"),
+             kernel_1=w2, bias_1=b2, activation_1=np.array("softmax"))
+
+    x = rng.standard_normal((5, 4)).astype(np.float32)
+    logits = np.maximum(x @ w1 + b1, 0) @ w2 + b2
+    expected = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+
+    probs = NumpyHead.load(str(path)).predict_on_batch(x)
+    np.testing.assert_allclose(probs, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_export_matches_keras(tmp_path):
+    pytest.importorskip("tensorflow")
+    from src.train import build_model
+
+    model = build_model(input_shape=16, num_classes=5)
+    head = export_keras_head(model, str(tmp_path / "head.npz"))
+    reloaded = NumpyHead.load(str(tmp_path / "head.npz"))
+
+    x = np.random.default_rng(1).standard_normal((32, 16)).astype(np.float32)
+    expected = np.asarray(model.predict_on_batch(x))
+    np.testing.assert_allclose(head.predict_on_batch(x), expected, atol=1e-5)
+    np.testing.assert_allclose(reloaded.predict_on_batch(x), expected, atol=1e-5)
@@ -0,0 +1,125 @@
+# tests/test_inference.py
+import re
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# the registry loads lazily, so importing inference needs no real model
+os.environ.setdefault("MODEL_PATH", "unused.npz")
+
+from src import inference
+
+
+class WhitespaceTokenizer:
+    def __call__(self, texts, **kwargs):
+        return {"offset_mapping": [[m.span() for m in re.finditer(r"\S+", t)] for t in texts]}
+
+
+class FakeEncoder:
+    max_seq_length = 64
+    tokenizer = WhitespaceTokenizer()
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, **kwargs):
+        return np.array([[len(t.split()), len(t)] for t in texts], dtype=np.float32)
+
+
+class FakeHead:
+    """Always predicts the class named in its path, e.g. 'head-1' -> class 1."""
+
+    def __init__(self, path):
+        self.column = int(path.rsplit("-", 1)[1])
+
+    def predict_on_batch(self, x):
+        probs = np.zeros((len(x), 2), dtype=np.float32)
+        probs[:, self.column] = 1.0
+        return probs
+
+
+@pytest.fixture
+def fake_loaders(monkeypatch):
+    loads = []
+
+    def load_encoder(name, backend):
+        loads.append(name)
+        time.sleep(0.05)  # long enough for requests to overlap a reload
+        return FakeEncoder()
+
+    def load_classifier(path):
+        if not os.path.basename(path).startswith("head-"):
+            raise FileNotFoundError(path)
+        return FakeHead(path)
+
+    def no_prototypes(**kwargs):
+        raise OSError("no prototypes in tests")
+
+    monkeypatch.setattr(inference, "load_encoder", load_encoder)
+    monkeypatch.setattr(inference, "load_classifier", load_classifier)
+    monkeypatch.setattr(inference, "load_prototype_matrix", no_prototypes)
+    return loads
+
+
+def test_background_load_makes_the_registry_ready(fake_loaders):
+    registry = inference.ModelRegistry("head-0", "enc", "torch", None)
+    assert not registry.ready
+    thread = threading.Thread(target=registry.load)
+    thread.start()
+    thread.join()
+    assert registry.ready and registry.load_error is None
+    assert registry.get().model_path == "head-0" and fake_loaders == ["enc"]
+
+
+def test_hot_swap_under_concurrent_requests(fake_loaders):
+    registry = inference.ModelRegistry("head-0", "enc", "torch", None)
+    registry.load()
+    answers, errors = [], []
+    swapped, stop = threading.Event(), threading.Event()
+
+    def client():
+        while not stop.is_set():
+            try:
+                after_swap = swapped.is_set()
+                models = registry.get()
+                probs = inference.full_proba([f"mail {len(answers)}"], models)
+                answers.append((after_swap, models.model_path, int(probs.argmax())))
+            except Exception as e:
+                errors.append(e)
+
+    clients = [threading.Thread(target=client) for _ in range(4)]
+    for t in clients:
+        t.start()
+    registry.load(model_path="head-1")
+    swapped.set()
+    time.sleep(0.05)
+    stop.set()
+    for t in clients:
+        t.join()
+
+    assert not errors
+    # every answer comes from one complete pair, and requests that start after the swap get the new one
+    assert all((path, column) in {("head-0", 0), ("head-1", 1)} for _, path, column in answers)
+    # the old pair kept answering while the new one loaded
+    assert any(path == "head-0" for _, path, _ in answers)
+    assert any(after for after, _, _ in answers)
+    assert all(path == "head-1" for after, path, _ in answers if after)
+
+
+def test_failed_reload_keeps_serving_and_records_the_error(fake_loaders):
+    registry = inference.ModelRegistry("missing.npz", "enc", "torch", None)
+    with pytest.raises(FileNotFoundError):
+        registry.load()
+    assert not registry.ready and "FileNotFoundError" in registry.load_error
+
+    registry.load(model_path="head-1")
+    assert registry.load_error is None
+    with pytest.raises(FileNotFoundError):
+        registry.load(model_path="other.npz")
+    assert registry.get().model_path == "head-1" and registry.model_path == "head-1"
+    assert "other.npz" in registry.load_error
@@ -0,0 +1,57 @@
+# tests/test_preprocess.py
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from sentence_transformers import util
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.preprocess import label_embeddings
+
+
+def loop_labels(embeddings, prototypes, threshold):
+    # the original per-embedding implementation, kept as the reference
+    labels = []
+    for emb in embeddings:
+        scores = {label: util.cos_sim(emb, proto).item() for label, proto in prototypes.items()}
+        best_label, best_score = max(scores.items(), key=lambda kv: kv[1])
+        labels.append(best_label if best_score > threshold else "other")
+    return labels
+
+
+def test_vectorized_labels_match_loop():
+    rng = np.random.default_rng(0)
+    embeddings = torch.tensor(rng.standard_normal((500, 16)), dtype=torch.float32)
+    prototypes = {name: torch.tensor(rng.standard_normal(16), dtype=torch.float32)
+                  for name in ["club", "talks", "internship", "academics"]}
+
+    labels, scores, margin = label_embeddings(embeddings, prototypes, threshold=0.1, chunk_size=64)
+
+    assert labels == loop_labels(embeddings, prototypes, threshold=0.1)
+    assert scores.shape == (500, 4)
+    expected = util.cos_sim(embeddings, torch.stack(list(prototypes.values()))).numpy()
+    np.testing.assert_allclose(scores, expected, atol=1e-5)
+    top2 = np.sort(scores, axis=1)[:, -2:]
+    np.testing.assert_allclose(margin, top2[:, 1] - top2[:, 0], atol=1e-6)
+    assert (margin >= 0).all()
+
+
+def test_parquet_roundtrip_keeps_selected_embeddings(tmp_path):
+    pytest.importorskip("tensorflow")
+    from src.preprocess import save_preprocessed_data
+    from src.train import load_features, load_processed_data
+
+    rng = np.random.default_rng(1)
+    embeddings = torch.tensor(rng.standard_normal((10, 8)), dtype=torch.float32)
+    df = pd.DataFrame({'label': ['club', 'talks'] * 5, 'emb_row': np.arange(10)})
+    selected = df.iloc[[7, 2, 5]]
+
+    path = str(tmp_path / "processed.parquet")
+    save_preprocessed_data(selected, path, embeddings)
+    loaded, matrix = load_processed_data(path)
+
+    assert loaded['label'].tolist() == ['talks', 'club', 'talks']
+    np.testing.assert_array_equal(load_features(loaded, matrix), embeddings.numpy()[[7, 2, 5]])
@@ -0,0 +1,51 @@
+# tests/test_prototypes.py
+import numpy as np
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.prototypes import load_prototype_matrix
+
+
+class CountingEncoder:
+    """Embeds a phrase as (word count, character count)."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, texts, **kwargs):
+        self.calls += 1
+        return np.array([[len(t.split()), len(t)] for t in texts], dtype=np.float32)
+
+
+def test_matrix_is_cached_until_phrases_model_or_backend_change(tmp_path):
+    path = tmp_path / "prototypes.yaml"
+    path.write_text("club:\n  - join the club\n  - club\ntalks:\n  - guest talk\n")
+    cache = str(tmp_path / "cache")
+    encoder = CountingEncoder()
+
+    first = load_prototype_matrix(str(path), "m1", cache, encoder=encoder)
+    assert first.names == ["club", "talks"]
+    np.testing.assert_allclose(np.linalg.norm(first.matrix, axis=1), 1.0, rtol=1e-6)
+    # club is the mean of (3, 13) and (1, 4)
+    np.testing.assert_allclose(first.matrix[0], np.array([2, 8.5]) / np.hypot(2, 8.5), rtol=1e-6)
+
+    again = load_prototype_matrix(str(path), "m1", cache, encoder=encoder)
+    assert encoder.calls == 1
+    np.testing.assert_array_equal(again.matrix, first.matrix)
+
+    load_prototype_matrix(str(path), "m2", cache, encoder=encoder)
+    path.write_text("club:\n  - join the club\ntalks:\n  - guest talk\n")
+    edited = load_prototype_matrix(str(path), "m1", cache, encoder=encoder)
+    assert encoder.calls == 3
+    assert edited.key != first.key
+
+    # the same model on another backend gets its own matrix next to the first
+    onnx = load_prototype_matrix(str(path), "m1", cache, encoder=encoder, backend="onnx-int8")
+    assert encoder.calls == 4 and onnx.key != edited.key
+    load_prototype_matrix(str(path), "m1", cache, encoder=encoder)
+    assert encoder.calls == 4
+
+    scores = edited.scores(np.array([[3.0, 13.0]]))
+    assert scores.shape == (1, 2) and scores[0].argmax() == 0
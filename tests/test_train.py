@@ -0,0 +1,70 @@
+# tests/test_train.py
+import numpy as np
+import pandas as pd
+import pytest
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip("tensorflow")
+from src.train import _thread_env, make_dataset, pareto_front, split_indices, sweep_configs
+
+
+def test_split_indices_is_stratified_and_disjoint():
+    y = np.array([0] * 50 + [1] * 30 + [2] * 20)
+    train_idx, test_idx = split_indices(y)
+
+    assert len(test_idx) == 20
+    assert set(train_idx).isdisjoint(test_idx)
+    assert set(train_idx) | set(test_idx) == set(range(100))
+    assert np.bincount(y[test_idx]).tolist() == [10, 6, 4]
+
+
+def test_dataset_streams_every_selected_row_from_memmap(tmp_path):
+    path = str(tmp_path / "emb.npy")
+    embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(40, 4))
+    embeddings[:] = np.arange(40)[:, None]
+    embeddings.flush()
+    embeddings = np.load(path, mmap_mode='r')
+
+    # example i lives at row 39 - i and has label i % 3
+    rows = np.arange(40)[::-1]
+    y = np.arange(40) % 3
+    positions = np.arange(0, 40, 2)
+
+    seen = []
+    for X, labels in make_dataset(embeddings, rows, y, positions, batch_size=6, shuffle=True):
+        assert X.dtype.name == 'float32' and X.shape[1] == 4
+        for vec, label in zip(X.numpy(), labels.numpy()):
+            example = 39 - int(vec[0])
+            assert label == example % 3
+            seen.append(example)
+
+    assert sorted(seen) == positions.tolist()
+
+
+def test_sweep_grid_and_pareto_front():
+    configs = sweep_configs([[256, 128], [64]], [0.2, 0.4], [0.001])
+    assert len(configs) == 4
+    assert configs[0] == {'units': (256, 128), 'dropout': 0.2, 'learning_rate': 0.001}
+
+    board = pd.DataFrame({'accuracy': [0.90, 0.88, 0.85, 0.80], 'ms_per_1k': [2.0, 0.5, 1.0, 0.5]})
+    assert pareto_front(board).tolist() == [True, True, False, False]
+
+
+def _child_threads():
+    return os.environ.get('OMP_NUM_THREADS')
+
+
+def test_sweep_workers_inherit_thread_caps(monkeypatch):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    monkeypatch.setenv('OMP_NUM_THREADS', '8')
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+    with _thread_env(2), ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # set before the worker starts, so numpy and TensorFlow read it at import
+        assert pool.submit(_child_threads).result() == '2'
+    assert os.environ['OMP_NUM_THREADS'] == '8'
+    assert 'MKL_NUM_THREADS' not in os.environ